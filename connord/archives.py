@@ -0,0 +1,134 @@
+# vim: set fileencoding=utf-8 :
+
+# connord - connect to nordvpn servers
+# Copyright (C) 2019  Mael Stor <maelstor@posteo.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Read single members of zip archives without extracting them"""
+
+import os
+import struct
+import threading
+import zlib
+from collections import namedtuple
+from zipfile import ZipFile, BadZipFile, ZIP_STORED, ZIP_DEFLATED
+from connord import ConnordError
+
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+_LOCAL_SIGNATURE = b"PK\x03\x04"
+
+Member = namedtuple(
+    "Member", ["offset", "compress_type", "compress_size", "file_size", "crc"]
+)
+
+_INDEXES = {}
+_LOCK = threading.Lock()
+
+
+class ArchiveError(ConnordError):
+    """Raised if a member can't be read from an archive"""
+
+
+def get_index(zip_file):
+    """Return the index of the members of zip_file. The index is read from the
+    central directory once and kept in memory until the archive changes.
+
+    :param zip_file: path to the zip archive
+    :returns: dictionary of member name to Member
+    :raises: OSError if the archive can't be read
+             ArchiveError if the archive is corrupt
+    """
+    stat = os.stat(zip_file)
+    key = (stat.st_mtime_ns, stat.st_size)
+    with _LOCK:
+        cached = _INDEXES.get(zip_file)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    try:
+        with ZipFile(zip_file, "r") as zip_stream:
+            index = {
+                info.filename: Member(
+                    info.header_offset,
+                    info.compress_type,
+                    info.compress_size,
+                    info.file_size,
+                    info.CRC,
+                )
+                for info in zip_stream.infolist()
+                if not info.is_dir()
+            }
+    except BadZipFile as error:
+        raise ArchiveError("Corrupt archive {!r}: {}".format(zip_file, error))
+
+    with _LOCK:
+        _INDEXES[zip_file] = (key, index)
+    return index
+
+
+def clear_cache():
+    """Forget all indexes"""
+    with _LOCK:
+        _INDEXES.clear()
+
+
+def read_member(zip_file, name):
+    """Read a single member of zip_file seeking directly to its offset
+
+    :param zip_file: path to the zip archive
+    :param name: the name of the member
+    :returns: the content as bytes
+    :raises: KeyError if there is no such member
+             ArchiveError if the member can't be read
+    """
+    member = get_index(zip_file)[name]
+    with open(zip_file, "rb") as zip_fd:
+        zip_fd.seek(member.offset)
+        header = _LOCAL_HEADER.unpack(zip_fd.read(_LOCAL_HEADER.size))
+        if header[0] != _LOCAL_SIGNATURE:
+            raise ArchiveError("Bad local header of {!r} in {!r}".format(name, zip_file))
+
+        # skip the file name and the extra field
+        zip_fd.seek(header[-2] + header[-1], os.SEEK_CUR)
+        data = zip_fd.read(member.compress_size)
+
+    if member.compress_type == ZIP_STORED:
+        content = data
+    elif member.compress_type == ZIP_DEFLATED:
+        try:
+            content = zlib.decompress(data, -zlib.MAX_WBITS)
+        except zlib.error as error:
+            raise ArchiveError("Corrupt member {!r}: {}".format(name, error))
+    else:
+        raise ArchiveError(
+            "Unsupported compression of {!r}: {}".format(name, member.compress_type)
+        )
+
+    if zlib.crc32(content) != member.crc:
+        raise ArchiveError("Bad crc of {!r} in {!r}".format(name, zip_file))
+
+    return content
+
+
+def find_member(zip_files, name):
+    """Return the first archive of zip_files which contains the member name or
+    None. Archives which can't be read are skipped."""
+    for zip_file in zip_files:
+        try:
+            if name in get_index(zip_file):
+                return zip_file
+        except (OSError, ArchiveError):
+            continue
+
+    return None
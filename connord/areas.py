@@ -17,57 +17,34 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """Manage location database and formatting of areas"""
 
-import time
-import requests
-from cachetools import cached, LRUCache
-import cachetools.func
+from bisect import bisect_left
 from connord import ConnordError
 from connord.printer import Printer
+from connord import geocoding
 from connord import servers
 from connord import sqlite
 from connord.formatter import Formatter
+from connord.table import ServerTable
+
+# the locations of the database and the indexes built from them
+__LOCATIONS_CACHE = {}
 
 
 class AreaError(ConnordError):
     """Thrown within this module"""
 
 
-API_URL = "https://nominatim.openstreetmap.org"
-
-
-@cached(cache=LRUCache(maxsize=50))
 def query_location(latitude, longitude):
-    """Query location given with latitude and longitude coordinates
-    from remote nominatim api. The values are cached to reduce queries.
-    The nominatim api restricts queries to 1/sec.
-
+    """Query a single location given with latitude and longitude coordinates from
+    the remote nominatim api. Use geocoding.reverse_many to query many locations
+    within the rate limit of the api.
 
     :param latitude: string with the latitude in float notation
     :param longitude: string with the longitude in float notation
     :returns: dictionary of the response in json
+    :raises: GeocodingError
     """
-    header = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 6.1; Win64; x64; rv:60.0) "
-        "Gecko/20100101 Firefox/60.0"
-    }
-
-    endpoint = "reverse"
-    flags = {
-        "lat": latitude,
-        "lon": longitude,
-        "format": "jsonv2",
-        "addressdetails": "1",
-        "accept-language": "en",
-        "zoom": "18",
-    }
-    url = "{}/{}.php?".format(API_URL, endpoint)
-    for k, v in flags.items():
-        url += "{}={}&".format(k, v)
-
-    url = url.rstrip("&")
-    with requests.get(url, headers=header, timeout=1) as response:
-        time.sleep(1)
-        return response.json()
+    return geocoding.NominatimBackend(timeout=1).reverse(latitude, longitude)
 
 
 def init_database(connection):
@@ -80,61 +57,85 @@ def init_database(connection):
         sqlite.create_location_table(connection)
 
 
+def _to_location(server, latitude, longitude, location_d):
+    """Return a row for the locations table built from the server and the reverse
+    geocoded location_d"""
+    display_name = location_d["display_name"]
+    city_keys = ["city", "town", "village", "residential", "state"]
+    for key in city_keys:
+        try:
+            city = location_d["address"][key]
+            break
+        except KeyError:
+            continue
+    else:
+        city = "Unknown"
+
+    country = server["country"]
+    country_code = server["flag"].lower()
+    return (
+        latitude,
+        longitude,
+        display_name,
+        city,
+        country,
+        country_code,
+        None,  # map
+    )
+
+
 def update_database():
-    """Updates the location database with least possible online queries."""
+    """Updates the location database with least possible online queries. The
+    existing locations are read once and all new locations are inserted in a single
+    transaction."""
     connection = sqlite.create_connection()
     with connection:
         init_database(connection)
 
-    servers_ = servers.get_servers()
+    existing = sqlite.get_location_keys(connection)
+    missing = {}
+    for server in servers.get_servers():
+        angulars = get_server_angulars(server)
+        if angulars not in existing and angulars not in missing:
+            missing[angulars] = server
+
+    if not missing:
+        return
+
+    geocoding_config = geocoding.get_geocoding_config()
+    backend = geocoding.get_backend(geocoding_config)
     printer = Printer()
     progress_bar = printer.incremental_bar(
-        "Updating location database", max=len(servers_)
+        "Updating location database", max=len(missing)
     )
 
-    for server in servers_:
-        longitude = str(server["location"]["long"])
-        latitude = str(server["location"]["lat"])
-
-        connection = sqlite.create_connection()
-        with connection:
-            if sqlite.location_exists(connection, latitude, longitude):
-                progress_bar.next()
-                continue
-            else:
-                location_d = query_location(latitude, longitude)
-
-        display_name = location_d["display_name"]
-        city_keys = ["city", "town", "village", "residential", "state"]
-        for key in city_keys:
-            try:
-                city = location_d["address"][key]
-                break
-            except KeyError:
-                continue
-        else:
-            city = "Unknown"
-
-        country = server["country"]
-        country_code = server["flag"].lower()
-        location = (
-            latitude,
-            longitude,
-            display_name,
-            city,
-            country,
-            country_code,
-            None,  # map
+    try:
+        results, errors = geocoding.reverse_many(
+            missing,
+            backend,
+            rate=geocoding_config["rate"],
+            burst=geocoding_config["burst"],
+            workers=geocoding_config["workers"],
+            retries=geocoding_config["retries"],
+            backoff=geocoding_config["backoff"],
+            callback=progress_bar.next,
+        )
+    finally:
+        progress_bar.finish()
+
+    locations = [
+        _to_location(missing[angulars], *angulars, location_d)
+        for angulars, location_d in results.items()
+    ]
+    sqlite.create_locations(connection, locations)
+    clear_cache()
+
+    if errors:
+        printer.error(
+            "Could not resolve {} of {} locations: {}".format(
+                len(errors), len(missing), next(iter(errors.values()))
+            )
         )
-
-        connection = sqlite.create_connection()
-        with connection:
-            sqlite.create_location(connection, location)
-
-        # if not printer.quiet:
-        progress_bar.next()
-
-    progress_bar.finish()
 
 
 def get_server_angulars(server):
@@ -162,21 +163,13 @@ def verify_areas(areas_):
             "Expected areas to be <class 'list'>: But found {!s}".format(type(areas_))
         )
 
-    locations = get_locations()
-    translation_table = get_translation_table()
+    area_index = get_area_index()
 
     areas_not_found = []
     # side effect: get rid of double entries in areas_ from command-line
-    areas_found = {area: list() for area in areas_}
-    for area in areas_found.keys():
-        for location in locations:
-            city = location["city"]
-            city_trans = city.translate(translation_table)
-            city_lower = city_trans.lower()
-            if city_lower.startswith(area):
-                areas_found[area].append(city)
-
-        if not areas_found[area]:
+    areas_found = {area: area_index.find(area) for area in areas_}
+    for area, cities in areas_found.items():
+        if not cities:
             areas_not_found.append(area)
 
     if areas_not_found:
@@ -206,10 +199,110 @@ def get_translation_table():
     return str.maketrans("áãčëéşșť", "aaceesst")
 
 
+__TRANSLATION_TABLE = get_translation_table()
+
+
+def normalize(name):
+    """Return the lowercase name with special characters translated"""
+    return name.lower().translate(__TRANSLATION_TABLE)
+
+
+def _common_prefix_length(first, second):
+    """Return the length of the common prefix of two strings"""
+    length = 0
+    for first_char, second_char in zip(first, second):
+        if first_char != second_char:
+            break
+        length += 1
+
+    return length
+
+
+class AreaIndex:
+    """Sorted index of the normalized city names of the locations. Answers which
+    cities start with a prefix with a binary search."""
+
+    def __init__(self, locations):
+        """Init
+
+        :param locations: list of locations with the keys 'latitude', 'longitude'
+                          and 'city'
+        """
+        cities = {}
+        angulars = {}
+        for location in locations:
+            name = normalize(location["city"])
+            cities.setdefault(name, [])
+            if location["city"] not in cities[name]:
+                cities[name].append(location["city"])
+            angulars.setdefault(name, set()).add(
+                (location["latitude"], location["longitude"])
+            )
+
+        # dictionaries keep the order of the locations
+        self.order = {name: position for position, name in enumerate(cities)}
+        self.names = sorted(cities)
+        self.cities = cities
+        self.angulars = angulars
+        self.min_ids = self._get_min_ids()
+
+    def _get_min_ids(self):
+        """Return the shortest unambiguous prefix of every name. In sorted order a
+        name shares its longest common prefixes with its neighbours, so a prefix
+        one character longer than both is unique."""
+        min_ids = {}
+        names = self.names
+        for position, name in enumerate(names):
+            if len(self.cities[name]) > 1:
+                # different spellings of the same name can't be told apart
+                min_ids[name] = name
+                continue
+
+            common = 0
+            if position > 0:
+                common = _common_prefix_length(names[position - 1], name)
+            if position + 1 < len(names):
+                common = max(common, _common_prefix_length(name, names[position + 1]))
+
+            min_ids[name] = name[: common + 1]
+
+        return min_ids
+
+    def get_min_id(self, city):
+        """Return the minimum string which identifies the city unambiguously"""
+        name = normalize(city)
+        return self.min_ids.get(name, name)
+
+    def find_names(self, prefix):
+        """Return the normalized names starting with the normalized prefix in
+        sorted order"""
+        prefix = normalize(prefix)
+        start = bisect_left(self.names, prefix)
+        end = start
+        while end < len(self.names) and self.names[end].startswith(prefix):
+            end += 1
+
+        return self.names[start:end]
+
+    def find(self, prefix):
+        """Return the cities starting with prefix in the order of the locations"""
+        names = sorted(self.find_names(prefix), key=self.order.get)
+        return [city for name in names for city in self.cities[name]]
+
+    def get_angulars(self, areas_):
+        """Return the set of (latitude, longitude) of all locations in areas_"""
+        angulars = set()
+        for area in areas_:
+            for name in self.find_names(area):
+                angulars.update(self.angulars[name])
+
+        return angulars
+
+
 def filter_servers(servers_, areas_):
     """Filter servers by areas
 
-    :param servers_: list of servers as dictionary
+    :param servers_: list of servers as dictionary or a ServerTable
     :param areas_: list of areas as string
     :returns: servers which match the list of areas
     :raises: TypeError when servers_ is None
@@ -221,27 +314,20 @@ def filter_servers(servers_, areas_):
     if areas_ is None or not areas_ or not servers_:
         return servers_
 
-    translation_table = get_translation_table()
-    areas_lower = [str.lower(area) for area in areas_]
-    areas_trans = [area.translate(translation_table) for area in areas_lower]
+    is_table = isinstance(servers_, ServerTable)
+    if is_table:
+        angulars = set(servers_.column("angulars"))
+    else:
+        angulars = {get_server_angulars(server) for server in servers_}
 
-    filtered_servers = []
-    connection = sqlite.create_connection()
-    with connection:
-        for server in servers_:
-            lat, lon = get_server_angulars(server)
-            if not sqlite.location_exists(connection, lat, lon):
-                update_database()
+    if not angulars.issubset(get_location_index()):
+        update_database()
 
-            city = sqlite.get_city(connection, lat, lon)
-            city = city.translate(translation_table)
-            city = city.lower()
-            for area in areas_trans:
-                if city.startswith(area):
-                    filtered_servers.append(server)
-                    break
+    selected = get_area_index().get_angulars(areas_)
+    if is_table:
+        return servers_.filter_values("angulars", selected)
 
-    return filtered_servers
+    return [server for server in servers_ if get_server_angulars(server) in selected]
 
 
 def get_min_id(city):
@@ -251,36 +337,83 @@ def get_min_id(city):
     :param city: the area/city as string
     :returns: the minimum string
     """
+    return get_area_index().get_min_id(city)
 
-    min_id = ""
-    translation_table = get_translation_table()
-    for char in city:
-        char = char.translate(translation_table)
-        min_id += char.lower()
-        try:
-            verify_areas([min_id])
-            break
-        except AreaError:
-            continue
 
-    return min_id
-
-
-@cachetools.func.ttl_cache(ttl=60, maxsize=1)
 def get_locations():
     """Return all locations found in the database. If the database does not exist
-    update the database
+    update the database. The locations are kept in memory until locations are
+    added to or removed from the database, also by other processes.
 
     :returns: a list of all locations
     """
     connection = sqlite.create_connection()
     with connection:
+        version = sqlite.get_locations_version(connection)
+        try:
+            cached_version, locations = __LOCATIONS_CACHE["locations"]
+            if version is not None and cached_version == version:
+                return locations
+        except KeyError:
+            pass
+
         locations = sqlite.get_locations(connection)
         if not locations:
             update_database()
-            return sqlite.get_locations(connection)
+            locations = sqlite.get_locations(connection)
+            version = sqlite.get_locations_version(connection)
+
+    __LOCATIONS_CACHE["locations"] = (version, locations)
+    return locations
+
+
+def _get_derived(name, get_source, build):
+    """Return build(source) for the source returned by get_source. The result is
+    kept until get_source returns a new object.
+
+    :param name: the key of the result in the cache
+    """
+    source = get_source()
+    try:
+        cached_source, derived = __LOCATIONS_CACHE[name]
+        if cached_source is source:
+            return derived
+    except KeyError:
+        pass
+
+    derived = build(source)
+    __LOCATIONS_CACHE[name] = (source, derived)
+    return derived
+
+
+def _build_location_index(locations):
+    return {
+        (location["latitude"], location["longitude"]): location
+        for location in locations
+    }
+
+
+def get_location_index():
+    """Return all locations found in the database keyed by (latitude, longitude)
+    as stored in the database.
+
+    :returns: a dictionary
+    """
+    return _get_derived("location_index", get_locations, _build_location_index)
+
+
+def get_area_index():
+    """Return the AreaIndex of all locations found in the database"""
+    return _get_derived(
+        "area_index",
+        get_location_index,
+        lambda location_index: AreaIndex(location_index.values()),
+    )
+
 
-        return locations
+def clear_cache():
+    """Clear the cached locations. Needed after the database was updated."""
+    __LOCATIONS_CACHE.clear()
 
 
 class AreasPrettyFormatter(Formatter):
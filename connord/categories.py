@@ -20,6 +20,7 @@
 
 from connord import ConnordError
 from connord.formatter import Formatter
+from connord.table import ServerTable
 
 CATEGORIES = {
     "double": "Double VPN",
@@ -30,6 +31,22 @@ CATEGORIES = {
     "onion": "Onion Over VPN",
 }
 
+# Stable bit positions of the categories in a category mask. Don't reorder the bits
+# but append new categories.
+CATEGORY_BITS = {
+    "double": 1 << 0,
+    "dedicated": 1 << 1,
+    "standard": 1 << 2,
+    "p2p": 1 << 3,
+    "obfuscated": 1 << 4,
+    "onion": 1 << 5,
+}
+
+# The same bits keyed by the category descriptions used by the nordvpn api
+DESCRIPTION_BITS = {
+    description: CATEGORY_BITS[category] for category, description in CATEGORIES.items()
+}
+
 
 class CategoriesError(ConnordError):
     """Throw within this module"""
@@ -98,19 +115,60 @@ def map_categories_reverse(categories):
     return mapped_categories
 
 
+def get_mask(categories):
+    """Return the category mask of a list of categories like 'p2p'
+
+    :raises: KeyError if a category is unknown
+    """
+    mask = 0
+    for category in categories:
+        mask |= CATEGORY_BITS[category]
+
+    return mask
+
+
+def encode_categories(server_categories):
+    """Return the category mask of the categories list of a server. Categories
+    unknown to DESCRIPTION_BITS are ignored."""
+    mask = 0
+    for category in server_categories:
+        mask |= DESCRIPTION_BITS.get(category["name"], 0)
+
+    return mask
+
+
+def get_server_mask(server):
+    """Return the category mask of a server. Uses the mask precomputed by
+    servers.get_servers if present."""
+    try:
+        return server["categories_mask"]
+    except KeyError:
+        return encode_categories(server["categories"])
+
+
+def decode_categories(mask):
+    """Return the list of categories like 'p2p' set in mask"""
+    return [category for category, bit in CATEGORY_BITS.items() if mask & bit]
+
+
 def has_category(server, category):
     """Return true if a server has category in categories."""
-    for category_ in server["categories"]:
-        if category_["name"] == category:
-            return True
+    try:
+        bit = DESCRIPTION_BITS[category]
+    except KeyError:
+        for category_ in server["categories"]:
+            if category_["name"] == category:
+                return True
+
+        return False
 
-    return False
+    return bool(get_server_mask(server) & bit)
 
 
 def filter_servers(servers, categories=None):
     """Filter a list of servers by type (category).
 
-    :servers: List of servers (parsed from nordvpn api to json).
+    :servers: List of servers (parsed from nordvpn api to json) or a ServerTable.
     :categories: List of categories (categories). If None or empty the default
             'standard' is applied.
     :returns: The filtered list.
@@ -119,21 +177,11 @@ def filter_servers(servers, categories=None):
     if categories is None or not categories:
         categories = ["standard"]
 
-    mapped_categories = map_categories(categories)
-
-    filtered_servers = []
-    servers = servers.copy()
-    for server in servers:
-        append = True
-        for mapped_category in mapped_categories:
-            if not has_category(server, mapped_category):
-                append = False
-                break
-
-        if append:
-            filtered_servers.append(server)
+    mask = get_mask(categories)
+    if isinstance(servers, ServerTable):
+        return servers.filter_mask("categories", mask)
 
-    return filtered_servers
+    return [server for server in servers if get_server_mask(server) & mask == mask]
 
 
 class CategoriesPrettyFormatter(Formatter):
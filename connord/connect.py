@@ -19,77 +19,170 @@
 
 
 import subprocess
-from multiprocessing.pool import ThreadPool
-from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from math import inf
 import time
 import os
-import re
 import signal
 from connord import ConnordError
 from connord.printer import Printer
 from connord import iptables
 from connord import servers
 from connord import load
+from connord import management
 from connord import countries
 from connord import areas
 from connord import categories
 from connord import features
+from connord import history
+from connord import ovpn
+from connord import probe
 from connord import resources
+from connord import sqlite
 from connord import update
 
 
+PROBE_DEFAULTS = {
+    "method": "auto",
+    "servers": 200,
+    "samples": 3,
+    "interval": 0.2,
+    "timeout": 1.0,
+    "deadline": 5.0,
+}
+RANKING_DEFAULTS = {"median": 1.0, "p95": 0.0, "jitter": 1.0, "loss": 5.0, "load": 1.0}
+# seconds openvpn may take to bring the tunnel up
+STARTUP_TIMEOUT = 60
+RACE_DEFAULTS = {"candidates": 0, "timeout": 20.0}
+# options of config.yml which a racing openvpn doesn't get
+RACE_EXCLUDED_OPTIONS = (
+    "daemon",
+    "scripts",
+    "script-security",
+    "writepid",
+    "management",
+    "up",
+    "down",
+    "ipchange",
+    "route-up",
+    "route-pre-down",
+    "log",
+    "log-append",
+    "status",
+)
+
+
 class ConnectError(ConnordError):
     """Thrown within this module"""
 
 
-def ping(server):
+def get_probe_config():
+    """Return the 'probe' section of the configuration merged with the defaults"""
+    return resources.get_config_section("probe", PROBE_DEFAULTS)
+
+
+def get_ranking_config():
+    """Return the 'ranking' section of the configuration merged with the defaults"""
+    return resources.get_config_section("ranking", RANKING_DEFAULTS)
+
+
+def ping_servers_parallel(servers_, probe_config=None):
     """
-    Ping a server
-    :param dict server: A server as dictionary
-    :returns: copy of server with additional key 'ping'
+    Measure the latency to a list of servers concurrently
+    :param list servers_: List of servers
+    :param dict probe_config: the probe configuration. Read from config.yml if None.
+    :returns: List of copies of the servers with the additional key 'latency'
+              holding the statistics of the samples and 'ping' the median
     """
+    if probe_config is None:
+        probe_config = get_probe_config()
+
+    samples = probe.probe_samples(
+        [server["ip_address"] for server in servers_],
+        samples=probe_config["samples"],
+        interval=probe_config["interval"],
+        method=probe_config["method"],
+        timeout=probe_config["timeout"],
+        deadline=probe_config["deadline"],
+    )
 
-    server_copy = server.copy()
-    pattern = re.compile(r"rtt .* = ([\d\.]+)/([\d\.]+)/([\d\.]+)/.* ms")
-    ip_address = server["ip_address"]
-    with subprocess.Popen(
-        ["ping", "-q", "-n", "-c", "1", "-l", "1", "-W", "1", ip_address],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    ) as ping_:
-
-        out, _ = ping_.communicate()
-        mat = pattern.search(out.decode())
-        if mat:
-            server_copy["ping"] = float(mat.group(2))
-        else:
-            server_copy["ping"] = float("inf")
-
-        printer = Printer()
+    printer = Printer()
+    pinged_servers = []
+    for server in servers_:
+        server_copy = server.copy()
+        latency = probe.get_stats(samples[server["ip_address"]])
+        server_copy["latency"] = latency
+        server_copy["ping"] = latency["median"]
         printer.info(
-            "{:6}: ping: {}".format(server_copy["domain"], server_copy["ping"])
+            "{:6}: ping: {} jitter: {} loss: {:.0%}".format(
+                server_copy["domain"],
+                server_copy["ping"],
+                latency["jitter"],
+                latency["loss"],
+            )
         )
-        return server_copy
+        pinged_servers.append(server_copy)
+
+    return pinged_servers
+
 
+def get_score(server, weights):
+    """Return the score of a probed server. Lower is better.
 
-def ping_servers_parallel(servers_):
+    :param server: a server with the key 'latency' as set by ping_servers_parallel
+    :param weights: dictionary of weights for the latency statistics 'median',
+                    'p95', 'jitter' in ms, 'loss' in percent and the 'load'
+    :returns: the weighted sum or inf if the server didn't answer at all
     """
-    Ping a list of servers
-    :param list servers_: List of servers
-    :returns: List of servers with ping time
+    latency = server["latency"]
+    if latency["median"] == inf:
+        return inf
+
+    return (
+        weights["median"] * latency["median"]
+        + weights["p95"] * latency["p95"]
+        + weights["jitter"] * latency["jitter"]
+        + weights["loss"] * latency["loss"] * 100
+        + weights["load"] * server["load"]
+    )
+
+
+def prerank_servers(servers_, averages, weights, count):
+    """Select the servers to probe by the moving averages of earlier probes.
+
+    :param servers_: list of servers
+    :param averages: dictionary of domain to averaged latency statistics
+    :param weights: the ranking weights
+    :param count: the count of servers to select. 0 selects all servers.
+    :returns: the count best known servers filled up with unknown servers in the
+              given order or all servers if none of them is known
     """
-    worker_count = cpu_count() + 1
-    with ThreadPool(processes=worker_count) as pool:
-        results = []
-        for server in servers_:
-            results.append(pool.apply_async(ping, (server,)))
+    known = [server for server in servers_ if server["domain"] in averages]
+    if not count or not known:
+        return servers_
+
+    known = sorted(
+        known,
+        key=lambda server: get_score(
+            dict(server, latency=averages[server["domain"]]), weights
+        ),
+    )
+    unknown = [server for server in servers_ if server["domain"] not in averages]
+    return (known + unknown)[:count]
 
-        pinged_servers = []
-        for result in results:
-            pinged_servers.append(result.get())
 
-        return pinged_servers
+def rank_servers(servers_, weights=None):
+    """Sort probed servers by their score
+
+    :param servers_: list of servers as returned by ping_servers_parallel
+    :param weights: the ranking weights. Read from config.yml if None.
+    :returns: a new sorted list of servers
+    """
+    if weights is None:
+        weights = get_ranking_config()
+
+    return sorted(servers_, key=lambda server: get_score(server, weights))
 
 
 # pylint: disable=too-many-arguments
@@ -97,7 +190,7 @@ def filter_servers(
     servers_, netflix, countries_, areas_, features_, categories_, load_, match
 ):
     """Filter servers by keys from command-line options
-    :param servers_: a list of servers given as dictionary
+    :param servers_: a list of servers given as dictionary or a ServerTable
     :param netflix: Boolean if servers should be filtered to netflix optimized servers
     :param countries_: a list of countries each given as string
     :param areas_: a list of areas each given as string
@@ -107,7 +200,6 @@ def filter_servers(
     :param match: may be 'max', 'min' or 'equal'
     :returns: the filtered list of servers
     """
-    servers_ = servers_.copy()
     if load_:
         servers_ = load.filter_servers(servers_, load_, match)
     if netflix:
@@ -125,17 +217,37 @@ def filter_servers(
 
 
 def filter_best_servers(servers_):
-    """Filter servers by lowest load and ping
+    """Filter servers by lowest load and rank them by latency and load
 
     :param servers_: list of servers each given as dictionary
     :returns: the filtered list of servers
     """
-    servers_ = servers_.copy()
+    probe_config = get_probe_config()
+    weights = get_ranking_config()
+    history_config = history.get_history_config()
     servers_ = sorted(servers_, key=lambda k: k["load"])
-    if len(servers_) > 10:
-        servers_ = servers_[:10]
-    servers_ = ping_servers_parallel(servers_)
-    servers_ = sorted(servers_, key=lambda k: k["ping"])
+    if len(servers_) > probe_config["servers"]:
+        servers_ = servers_[: probe_config["servers"]]
+
+    # the history only saves probing time so don't fail without it
+    connection = sqlite.create_connection()
+    try:
+        averages = history.get_averages(connection, history_config["max_age"])
+    except sqlite.SqliteError:
+        averages = {}
+    servers_ = prerank_servers(
+        servers_, averages, weights, history_config["candidates"]
+    )
+
+    servers_ = ping_servers_parallel(servers_, probe_config)
+    try:
+        history.record(connection, servers_, history_config)
+    except sqlite.SqliteError:
+        pass
+    finally:
+        connection.close()
+
+    servers_ = rank_servers(servers_, weights)
     return servers_
 
 
@@ -199,7 +311,7 @@ def connect(
     if "best" not in domain:
         return connect_to_specific_server(domain, openvpn, daemon, protocol)
 
-    servers_ = servers.get_servers()
+    servers_ = servers.get_server_table()
     servers_ = filter_servers(
         servers_, netflix, countries_, areas_, features_, categories_, load_, match
     )
@@ -207,6 +319,23 @@ def connect(
     best_servers = filter_best_servers(servers_)
     max_retries = 3
     printer = Printer()
+
+    race_config = get_race_config()
+    if race_config["candidates"] > 1:
+        candidates = [
+            server
+            for server in best_servers[: race_config["candidates"]]
+            if server["ping"] != inf
+            and not categories.has_category(server, "Obfuscated Servers")
+        ]
+        printer.info(
+            "Racing {}".format(", ".join(server["domain"] for server in candidates))
+        )
+        winner = race_servers(candidates, openvpn, protocol, race_config["timeout"])
+        if winner is not None:
+            best_servers = [winner] + [
+                server for server in best_servers if server is not winner
+            ]
     for i, server in enumerate(best_servers):
         if i == max_retries:
             raise ConnectError("Maximum retries reached.")
@@ -238,6 +367,91 @@ def connect(
     raise ConnectError("No server found to establish a connection.")
 
 
+def get_race_config():
+    """Return the 'race' section of the configuration merged with the defaults"""
+    return resources.get_config_section("race", RACE_DEFAULTS)
+
+
+def race_servers(servers_, openvpn, protocol, timeout):
+    """Establish tunnels to all servers at once without applying routes or scripts
+    and return the server which is up first. All tunnels are torn down.
+
+    :param servers_: list of servers
+    :param openvpn: options to pass-through to openvpn as string
+    :param protocol: may be 'udp' or 'tcp'
+    :param timeout: seconds to wait for the first tunnel
+    :returns: the first server which is up or None
+    """
+    commands = []
+    for server in servers_:
+        openvpn_cmd = OpenvpnCommand(server, openvpn, False, protocol)
+        try:
+            openvpn_cmd.forge_race(
+                resources.get_stats_file("race-{}.sock".format(server["domain"]))
+            )
+        except resources.ResourceNotFoundError:
+            continue
+        commands.append(openvpn_cmd)
+
+    if not commands:
+        return None
+
+    processes = []
+    deadline = time.monotonic() + timeout
+
+    def wait_connected(openvpn_cmd, process):
+        client = management.ManagementClient(openvpn_cmd.management_socket)
+        try:
+            client.connect(
+                lambda: process.poll() is None, deadline - time.monotonic()
+            )
+            client.wait_connected(deadline - time.monotonic())
+        finally:
+            client.close()
+
+        return openvpn_cmd.server
+
+    winner = None
+    executor = ThreadPoolExecutor(max_workers=len(commands))
+    try:
+        futures = []
+        for openvpn_cmd in commands:
+            process = subprocess.Popen(
+                openvpn_cmd.cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            processes.append(process)
+            futures.append(executor.submit(wait_connected, openvpn_cmd, process))
+
+        try:
+            for future in as_completed(
+                futures, timeout=max(deadline - time.monotonic(), 0)
+            ):
+                try:
+                    winner = future.result()
+                    break
+                except management.ManagementError:
+                    continue
+        except FuturesTimeoutError:
+            pass
+    finally:
+        # stopping openvpn closes the sockets and releases the waiting threads
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        executor.shutdown(wait=True)
+
+    return winner
+
+
 # TODO: Rename to OpenvpnCommandPanicError
 class OpenvpnCommandPanic(ConnectError):
     """Raised when something went wrong running openvpn"""
@@ -272,6 +486,8 @@ class OpenvpnCommand:
         self.daemon = daemon
         self.protocol = protocol
         self.cmd = ["openvpn"]
+        # the unix socket of the management interface if connord owns it
+        self.management_socket = None
 
     def _add_openvpn_cmd_option(self, flag, *args):
         """Convenience function to add an option to the command list
@@ -404,10 +620,15 @@ class OpenvpnCommand:
         if self.daemon:
             self._add_openvpn_cmd_option("--daemon")
 
-    def _forge_config(self):
-        """Add the openvpn options from 'config.yml' to the openvpn command"""
+    def _forge_config(self, exclude=()):
+        """Add the openvpn options from 'config.yml' to the openvpn command
+
+        :param exclude: options to leave out
+        """
         openvpn_config = resources.get_config()["openvpn"]
         for k, v in openvpn_config.items():
+            if k in exclude:
+                continue
             if isinstance(v, bool) or v in ("true", "True", "false", "False"):
                 self._forge_bool(k, v)
             elif isinstance(v, list):
@@ -424,33 +645,82 @@ class OpenvpnCommand:
 
         return "--{}".format(flag) in self.cmd
 
+    def _get_ovpn_template_file(self):
+        """Return the template of the ovpn config in 'template' mode or None if
+        there is no template or the config of the server differs from it.
+        Obfuscated servers aren't in the archive the template is made from."""
+        if resources.get_configurations_config()["mode"] != "template":
+            return None
+        if categories.has_category(self.server, "Obfuscated Servers"):
+            return None
+
+        template_file = resources.get_ovpn_template_file(self.protocol)
+        if not os.path.exists(template_file):
+            return None
+
+        try:
+            mismatches = resources.read_ovpn_template_mismatches(self.protocol)
+        except resources.ResourceNotFoundError:
+            # the template wasn't verified against all configs
+            return None
+
+        if self.domain in mismatches:
+            return None
+
+        return template_file
+
+    @staticmethod
+    def _strip_flags(lines, flags):
+        """Yield the lines of an ovpn config which don't set one of flags"""
+        for line in lines:
+            words = line.split(None, 1)
+            if words:
+                flag = words[0] if words[0].startswith("--") else "--" + words[0]
+                if flag in flags:
+                    continue
+
+            yield line
+
     def forge_ovpn_config(self, config_file=None):
         """Remove all openvpn command-line arguments from the ovpn config file
-        to prevent overriding the command-line. Use final temporary file as
-        value for the --config flag
+        to prevent overriding the command-line. The result is cached per source
+        file and command-line flags and used as value for the --config flag
 
         :param config_file: path to an optional configuration file
         """
+        template_file = None
         if not config_file:
-            config_file = resources.get_ovpn_config(self.domain, self.protocol)
-
-        config_tmp = resources.get_ovpn_tmp_path()
-
-        with open(config_file, "r") as config_fd:
-            lines = config_fd.readlines()
-        with open(config_tmp, "w") as config_fd:
-            for line in lines:
-                if line != "\n":
-                    # TODO: improve to flag = line.split(None, 1)[0]
-                    fake_line = line.rstrip() + " $"
-                    flag, _ = fake_line.split(maxsplit=1)
-                    if not self.has_flag(flag):
-                        config_fd.write(line)
+            template_file = self._get_ovpn_template_file()
+            config_file = template_file or resources.get_ovpn_config(
+                self.domain, self.protocol
+            )
+
+        flags = {arg for arg in self.cmd if arg.startswith("--")}
+        stat = os.stat(config_file)
+        key = [config_file, stat.st_mtime_ns, stat.st_size, sorted(flags)]
+        if template_file:
+            key.append([self.server["ip_address"], self.domain])
+
+        forged_file = resources.get_forged_ovpn_file(key)
+        if os.path.exists(forged_file):
+            resources.mark_used(forged_file)
+        else:
+            with open(config_file, "r") as config_fd:
+                if template_file:
+                    lines = ovpn.render(config_fd.read(), self.server).splitlines(True)
                 else:
-                    config_fd.write(line)
+                    lines = config_fd
 
-        os.chmod(config_tmp, mode=0o640)
-        self._add_openvpn_cmd_option("--config", config_tmp)
+                resources.write_atomic(
+                    forged_file, self._strip_flags(lines, flags), permissions=0o640
+                )
+
+            cache_size = resources.get_configurations_config()["cache"]
+            resources.remove_least_recently_used(
+                os.path.dirname(forged_file), cache_size
+            )
+
+        self._add_openvpn_cmd_option("--config", forged_file)
 
     def forge(self):
         """The high-level command to assemble the openvpn cmd. Adds the --config
@@ -472,11 +742,33 @@ class OpenvpnCommand:
             self.cmd.remove(config_file)
             self.forge_ovpn_config(config_file=config_file)
 
+        if not self.has_flag("--management"):
+            self.management_socket = resources.get_stats_file("openvpn.sock")
+            self._add_openvpn_cmd_option(
+                "--management", self.management_socket, "unix"
+            )
+
         if not self.has_flag("--writepid"):
             pid_dir = resources.get_stats_dir(create=True)
             pid_file = pid_dir + "/openvpn.pid"
             self._add_openvpn_cmd_option("--writepid", pid_file)
 
+    def forge_race(self, management_socket):
+        """Assemble a command which only establishes the tunnel to validate the
+        server. Routes, addresses and scripts aren't applied.
+
+        :param management_socket: path of the socket for the management interface
+        :raises: ResourceNotFoundError if there is no ovpn config for the server
+        """
+        self._forge_command_line()
+        self._forge_config(exclude=RACE_EXCLUDED_OPTIONS)
+        self._add_openvpn_cmd_option("--route-noexec")
+        self._add_openvpn_cmd_option("--ifconfig-noexec")
+        self._add_openvpn_cmd_option("--script-security", "1")
+        self.management_socket = management_socket
+        self._add_openvpn_cmd_option("--management", management_socket, "unix")
+        self.forge_ovpn_config()
+
     def is_daemon(self):
         """Return true if --daemon flag is in the current openvpn command"""
         return "--daemon" in self.cmd
@@ -501,62 +793,83 @@ class OpenvpnCommand:
             process.kill()
 
         self.cleanup()
-        resources.remove_ovpn_tmp_file()
         raise OpenvpnCommandPanic(problem)
 
+    def _wait_for_scripts(self, process, scripts, deadline):
+        """Wait until the scripts of the 'up' and 'always' stages created their
+        files.
+
+        :raises: OpenvpnCommandPanic if openvpn stops or the deadline is reached
+        """
+        while True:
+            try:
+                for script in scripts:
+                    if script["stage"] in ("up", "always"):
+                        resources.get_stats_file(
+                            stats_name=script["creates"], create=False
+                        )
+                return
+            except resources.ResourceNotFoundError:
+                pass
+
+            if not self.is_running(process):
+                self.panic(process, "Openvpn process stopped unexpected.")
+            if time.monotonic() >= deadline:
+                self.panic(process, "Timeout reached.")
+
+            time.sleep(0.05)
+
+    def _wait_connected(self, process, deadline):
+        """Wait until openvpn reports the tunnel up on its management interface
+
+        :raises: OpenvpnCommandPanic if openvpn fails or the deadline is reached
+        """
+        client = management.ManagementClient(self.management_socket)
+        try:
+            client.connect(
+                lambda: self.is_running(process), deadline - time.monotonic()
+            )
+            client.wait_connected(deadline - time.monotonic())
+        except management.ManagementError as error:
+            self.panic(process, str(error))
+        finally:
+            client.close()
+
     def run(self):
         """High-level command to run openvpn with the assembled command-line.
-        Shuts down openvpn after a timeout. Waits this time for openvpn to startup
-        and writes the environment files from the scripts. As soon as they are
-        present iptables rules are applied. If something goes wrong call the panic
-        method
+        Shuts down openvpn after a timeout. Waits this time until openvpn reports
+        the tunnel up on its management interface and the scripts created their
+        environment files. Then iptables rules are applied. If something goes
+        wrong call the panic method
 
         :returns: True if everything went fine or running in daemon mode.
         """
 
         config_dict = resources.get_config()["openvpn"]
         self.cleanup()
+        # the management socket is created in the stats directory
+        resources.get_stats_dir(create=True)
 
         printer = Printer()
         printer.info("Running openvpn with '{}'".format(self.cmd))
         with subprocess.Popen(self.cmd) as ovpn:
             # give openvpn a maximum of 60 seconds to startup. A lower value is bad if
             # asked for username/password.
-            # pylint: disable=unused-variable
-            for i in range(300):
-                try:
-                    if self.is_running(ovpn):
-                        # delay initialization of iptables until resource files are
-                        # created. If none are created the delay still applies as normal
-                        # timeout
-                        time.sleep(0.2)
-                        for script in config_dict["scripts"]:
-                            stage = script["stage"]
-                            if stage in ("up", "always"):
-                                resources.get_stats_file(
-                                    stats_name=script["creates"], create=False
-                                )
-
-                    else:
-                        self.panic(ovpn, "Openvpn process stopped unexpected.")
-
-                    if iptables.apply_config_dir(self.server, self.protocol):
-                        resources.write_stats(self.server, stats_name="server")
-
-                        stats_dict = resources.get_stats()
-                        stats_dict["last_server"] = {}
-                        stats_dict["last_server"]["domain"] = self.domain
-                        stats_dict["last_server"]["protocol"] = self.protocol
-                        resources.write_stats(stats_dict)
-                    else:
-                        self.panic(ovpn, "Applying iptables failed.")
-
-                    break
-                except resources.ResourceNotFoundError:
-                    pass
-            ### for
+            deadline = time.monotonic() + STARTUP_TIMEOUT
+            if self.management_socket:
+                self._wait_connected(ovpn, deadline)
+            self._wait_for_scripts(ovpn, config_dict["scripts"], deadline)
+
+            if iptables.apply_config_dir(self.server, self.protocol):
+                resources.write_stats(self.server, stats_name="server")
+
+                stats_dict = resources.get_stats()
+                stats_dict["last_server"] = {}
+                stats_dict["last_server"]["domain"] = self.domain
+                stats_dict["last_server"]["protocol"] = self.protocol
+                resources.write_stats(stats_dict)
             else:
-                self.panic(ovpn, "Timeout reached.")
+                self.panic(ovpn, "Applying iptables failed.")
 
             if self.is_running(ovpn):
                 ovpn.wait()
@@ -577,7 +890,6 @@ def run_openvpn(server, openvpn, daemon, protocol):
         time.sleep(1)
 
     if not openvpn_cmd.is_daemon():
-        resources.remove_ovpn_tmp_file()
         openvpn_cmd.cleanup()
 
     return retval
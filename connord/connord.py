@@ -25,23 +25,24 @@ import re
 import time
 import errno
 
-from requests.exceptions import RequestException
-
-from connord import update
-from connord import version
-from connord import listings
-from connord import connect
-from connord import iptables
+from connord import ConnordError
 from connord import user
-from connord import servers
-from connord import resources
-from connord import areas
-from connord import countries
-from connord import features
-from connord import categories
+from connord.lazy import lazy_import
 from connord.printer import Printer
-from connord import sqlite
-from .features import FeatureError
+
+# Commands import only the modules they use. Some of them load libiptc, jinja2
+# or requests which would slow down every invocation.
+update = lazy_import("connord.update")
+version = lazy_import("connord.version")
+listings = lazy_import("connord.listings")
+connect = lazy_import("connord.connect")
+iptables = lazy_import("connord.iptables")
+resources = lazy_import("connord.resources")
+areas = lazy_import("connord.areas")
+countries = lazy_import("connord.countries")
+features = lazy_import("connord.features")
+categories = lazy_import("connord.categories")
+daemon = lazy_import("connord.daemon")
 
 
 # pylint: disable=too-few-public-methods
@@ -99,7 +100,7 @@ class FeatureType:
     def __call__(self, value):
         try:
             features.verify_features([value])
-        except FeatureError:
+        except features.FeatureError:
             raise argparse.ArgumentTypeError(
                 "'{}' is an unrecognized feature.".format(value)
             )
@@ -468,6 +469,13 @@ def parse_args(argv):
         "-6", dest="ipv6", action="store_true", help="Apply the ipv6 configuration."
     )
     command.add_parser("version", help="Show version")
+    command.add_parser("status", help="Show the status of the connection.")
+    description = (
+        "Run connord in the foreground and answer commands on a unix socket. "
+        "While the daemon is running the 'list', 'connect', 'kill', 'status' and "
+        "'iptables reload' commands are handed over to it."
+    )
+    command.add_parser("daemon", help="Run the connord daemon.", description=description)
 
     return parser.parse_args(argv)
 
@@ -669,75 +677,104 @@ def process_kill_cmd(args):
         connect.kill_openvpn(ovpn_pid)
 
 
-# This function has a high complexity score but it's kept simple though
-# pylint: disable=too-many-branches
-def main():  # noqa: C901
-    """Entry Point for the program. A first level argument processing method.
-    All Exceptions that lead to an exit of the program are catched here.
+def is_request_error(error):
+    """Return True if error was raised by requests. Doesn't import requests."""
+    requests = sys.modules.get("requests")
+    return requests is not None and isinstance(error, requests.RequestException)
 
-    :raises: SystemExit either 0 or 1
+
+def run_command(args):
+    """Run the command given on the command-line
+
+    :param object args: Namespace object holding the command-line arguments
     """
+    if args.command == "update":
+        update.update(force=args.force)
+    elif args.command == "version":
+        version.print_version()
+    elif args.command == "list":
+        process_list_cmd(args)
+    elif args.command == "connect":
+        process_connect_cmd(args)
+    elif args.command == "kill":
+        process_kill_cmd(args)
+    elif args.command == "iptables":
+        process_iptables_cmd(args)
+    elif args.command == "status":
+        daemon.print_status()
+    elif args.command == "daemon":
+        daemon.serve(parse_args, execute)
+    else:
+        # This should only happen when someone tampers with sys.argv
+        raise NotImplementedError("Could not process command-line arguments.")
 
-    if not sys.argv[1:]:
-        sys.argv.extend(["-h"])
 
-    args = parse_args(sys.argv[1:])
-    # TODO: recognize configuration in config.yml
-    printer = Printer(verbose=args.verbose, quiet=args.quiet)
+def execute(args):
+    """Run the command of args. All Exceptions that lead to an exit of the program
+    are catched here.
 
+    :param object args: Namespace object holding the command-line arguments
+    :returns: the exit status 0 or 1
+    """
+    printer = Printer()
     try:
-        if args.command == "update":
-            update.update(force=args.force)
-        elif args.command == "version":
-            version.print_version()
-        elif args.command == "list":
-            process_list_cmd(args)
-        elif args.command == "connect":
-            process_connect_cmd(args)
-        elif args.command == "kill":
-            process_kill_cmd(args)
-        elif args.command == "iptables":
-            process_iptables_cmd(args)
-        else:
-            # This should only happen when someone tampers with sys.argv
-            raise NotImplementedError("Could not process command-line arguments.")
-        sys.exit(0)
+        run_command(args)
+        return 0
     except PermissionError:
         printer.error(
             'Permission Denied: You need to run "connord {}" as root'.format(
                 args.command
             )
         )
-    except resources.ResourceNotFoundError as error:
-        printer.error(str(error))
-    except resources.MalformedResourceError as error:
-        printer.error(str(error))
-    except areas.AreaError as error:
-        printer.error(str(error))
-    except iptables.IptablesError as error:
-        printer.error(str(error))
-    except countries.CountryError as error:
-        printer.error(str(error))
-    except FeatureError as error:
-        printer.error(str(error))
-    except servers.DomainNotFoundError as error:
-        printer.error(str(error))
-    except servers.MalformedDomainError as error:
-        printer.error(str(error))
-    except connect.ConnectError as error:
-        printer.error(str(error))
-    except update.UpdateError as error:
-        printer.error(str(error))
-    except RequestException as error:
-        printer.error(str(error))
-    except sqlite.SqliteError as error:
+    except ConnordError as error:
         printer.error(str(error))
     except IOError as error:
+        if is_request_error(error):
+            printer.error(str(error))
         # Don't handle broken pipe
-        if error.errno != errno.EPIPE:
+        elif error.errno != errno.EPIPE:
             raise
     except KeyboardInterrupt:
         time.sleep(0.5)
-        sys.exit(0)
+        return 0
+
+    return 1
+
+
+def main():
+    """Entry Point for the program. A first level argument processing method.
+    Commands are handed over to the daemon if it's running.
 
-    sys.exit(1)
+    :raises: SystemExit either 0 or 1
+    """
+
+    if not sys.argv[1:]:
+        sys.argv.extend(["-h"])
+
+    args = parse_args(sys.argv[1:])
+    # TODO: recognize configuration in config.yml
+    printer = Printer(verbose=args.verbose, quiet=args.quiet)
+
+    if daemon.is_forwarded(args):
+        try:
+            response = daemon.forward(sys.argv[1:])
+            if response is not None and response.get("question"):
+                # the daemon can't ask so ask here and send the answer along
+                sys.stdout.write(response["stdout"])
+                if not sys.stdin.isatty():
+                    sys.stderr.write(response["stderr"])
+                    sys.exit(response["status"])
+                if not printer.yes_no(response["question"]):
+                    sys.exit(0)
+
+                response = daemon.forward(sys.argv[1:], confirm=True)
+        except ConnordError as error:
+            printer.error(str(error))
+            sys.exit(1)
+
+        if response is not None:
+            sys.stdout.write(response["stdout"])
+            sys.stderr.write(response["stderr"])
+            sys.exit(response["status"])
+
+    sys.exit(execute(args))
@@ -26,6 +26,7 @@
 
 from connord import ConnordError
 from connord.formatter import Formatter
+from connord.table import ServerTable
 
 COUNTRIES = {
     "ae": "United Arab Emirates",
@@ -151,6 +152,9 @@ def filter_servers(servers, countries=None):
 
     countries_lower = [str.lower(country) for country in countries]
 
+    if isinstance(servers, ServerTable):
+        return servers.filter_values("flag", countries_lower)
+
     # TODO: test if list comprehension is faster
     filtered_servers = []
     servers = servers.copy()
@@ -0,0 +1,422 @@
+# vim: set fileencoding=utf-8 :
+
+# connord - connect to nordvpn servers
+# Copyright (C) 2019  Mael Stor <maelstor@posteo.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Long-running connord process answering commands on a unix socket.
+
+The daemon keeps the caches of the server list, the parsed configuration, the
+archive indexes and the rendered iptables rules warm between commands. The
+command-line hands the supported commands over to it if it's running. A request
+is a json line {"argv": [...], "confirm": false} and the answer a json line with
+the 'status', 'stdout' and 'stderr' of the command. The daemon never asks the
+user. If a command needs a confirmation which wasn't given with 'confirm' it
+fails and the answer holds the 'question'.
+"""
+
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from connord import ConnordError
+from connord import resources
+from connord import user
+from connord.printer import Printer
+
+DAEMON_DEFAULTS = {"socket": "/run/connord.sock", "timeout": 120.0}
+
+
+class DaemonError(ConnordError):
+    """Raised within this module"""
+
+
+def get_daemon_config():
+    """Return the 'daemon' section of the configuration merged with the defaults"""
+    return resources.get_config_section("daemon", DAEMON_DEFAULTS)
+
+
+def is_forwarded(args):
+    """Return True if the daemon runs the command of args when it's running"""
+    if args.command in ("list", "connect", "kill", "status"):
+        return True
+
+    return args.command == "iptables" and args.iptables_sub == "reload"
+
+
+def needs_root(args):
+    """Return True if only root may run the command of args through the daemon"""
+    if args.command == "list":
+        return args.list_sub == "iptables"
+
+    return args.command != "status"
+
+
+def read_pid():
+    """Return the pid of the openvpn process started by connord or None"""
+    try:
+        return resources.read_pid()
+    except (resources.ResourceNotFoundError, OSError, ValueError):
+        return None
+
+
+def is_alive(pid):
+    """Return True if the process with pid exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def format_status(since=None, started=None):
+    """Return the status of the connection as string
+
+    :param since: time of the last connect through the daemon or None
+    :param started: start time of the daemon or None if not asked by the daemon
+    """
+    lines = []
+    pid = read_pid()
+    if pid is not None and is_alive(pid):
+        lines.append("Openvpn: running (pid {})".format(pid))
+    else:
+        lines.append("Openvpn: not running")
+
+    try:
+        last_server = resources.get_stats()["last_server"]
+        lines.append(
+            "Server:  {} ({})".format(last_server["domain"], last_server["protocol"])
+        )
+    except (resources.ResourceNotFoundError, PermissionError, KeyError, TypeError):
+        lines.append("Server:  None")
+
+    if since is not None:
+        lines.append("Since:   {}".format(time.ctime(since)))
+    if started is not None:
+        lines.append(
+            "Daemon:  running (pid {}) since {}".format(
+                os.getpid(), time.ctime(started)
+            )
+        )
+    else:
+        lines.append("Daemon:  not running")
+
+    return "\n".join(lines) + "\n"
+
+
+def print_status():
+    """Print the status of the connection when no daemon is running"""
+    print(format_status(), end="", file=Printer())
+
+
+class _ThreadStream:
+    """Writes to the stream the current thread captures to or else to the
+    original stream"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    @contextmanager
+    def capture(self):
+        self._local.buffer = io.StringIO()
+        try:
+            yield self._local.buffer
+        finally:
+            self._local.buffer = None
+
+    def _get_stream(self):
+        return getattr(self._local, "buffer", None) or self._stream
+
+    def write(self, data):
+        return self._get_stream().write(data)
+
+    def flush(self):
+        self._get_stream().flush()
+
+    def __getattr__(self, attribute):
+        return getattr(self._stream, attribute)
+
+
+def get_peer_uid(sock):
+    """Return the uid of the process on the other end of a unix socket"""
+    credentials = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _, uid, _ = struct.unpack("3i", credentials)
+    return uid
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # the peer only probed the socket
+            return
+
+        try:
+            request = json.loads(line.decode())
+            argv = request["argv"]
+            confirm = request.get("confirm", False)
+            if not isinstance(argv, list) or not all(isinstance(a, str) for a in argv):
+                raise TypeError(argv)
+            if not isinstance(confirm, bool):
+                raise TypeError(confirm)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            response = {"status": 1, "stdout": "", "stderr": "connord: Bad request.\n"}
+        else:
+            response = self.server.run(argv, get_peer_uid(self.request), confirm)
+
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Runs commands sent to the socket one after another. Only 'status' is
+    answered at any time. Every user may connect to the socket, the commands
+    which need root are refused for other users."""
+
+    daemon_threads = True
+
+    def __init__(self, path, parse_args, execute):
+        """Init
+
+        :param path: the path of the socket
+        :param parse_args: function to parse an argv to args
+        :param execute: function to run the command of args returning the exit
+                        status
+        """
+        self.parse_args = parse_args
+        self.execute = execute
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.since = None
+        self.stdout = _ThreadStream(sys.stdout)
+        self.stderr = _ThreadStream(sys.stderr)
+        self.question = threading.local()
+        super().__init__(path, _RequestHandler)
+
+    def server_bind(self):
+        super().server_bind()
+        # access is checked per command with the credentials of the peer
+        os.chmod(self.server_address, 0o666)
+
+    def run(self, argv, uid=0, confirm=False):
+        """Run the command given with argv
+
+        :param uid: the uid of the user sending the command
+        :param confirm: True if the user confirmed questions in advance
+        :returns: dictionary with the exit 'status' and the output of the command.
+                  If the command failed on a question 'question' holds it.
+        """
+        self.question.value = None
+        with self.stdout.capture() as stdout, self.stderr.capture() as stderr:
+            try:
+                status = self._run(argv, uid, confirm)
+            except Exception as error:  # pylint: disable=broad-except
+                # the client gets what ends a command run without the daemon
+                sys.stderr.write("{}{!s}\n".format(Printer.prefix, error))
+                status = 1
+
+        response = {
+            "status": status,
+            "stdout": stdout.getvalue(),
+            "stderr": stderr.getvalue(),
+        }
+        if self.question.value is not None:
+            response["question"] = self.question.value
+
+        return response
+
+    def _execute(self, args, confirm):
+        """Run execute with the printer set up for args. Questions aren't asked
+        but answered with confirm."""
+        printer = Printer()
+        state = printer.verbose, printer.quiet, printer.interactive, printer.confirmed
+        printer.verbose, printer.quiet = args.verbose, args.quiet
+        printer.interactive, printer.confirmed = False, confirm
+        printer.question = None
+        try:
+            return self.execute(args)
+        finally:
+            # execute reports the PromptError, the client may ask the question
+            self.question.value = printer.question
+            (
+                printer.verbose,
+                printer.quiet,
+                printer.interactive,
+                printer.confirmed,
+            ) = state
+
+    def _run(self, argv, uid, confirm):
+        try:
+            args = self.parse_args(argv)
+        except SystemExit as exit_:
+            return exit_.code or 0
+
+        if not is_forwarded(args):
+            Printer().error("The daemon doesn't run 'connord {}'.".format(args.command))
+            return 1
+
+        if uid != 0 and needs_root(args):
+            Printer().error(
+                'Permission Denied: You need to run "connord {}" as root'.format(
+                    args.command
+                )
+            )
+            return 1
+
+        if args.command == "status":
+            print(format_status(self.since, self.started), end="", file=Printer())
+            return 0
+
+        if args.command == "connect":
+            # openvpn forks into the background once the tunnel is up, so the
+            # daemon can answer further commands
+            args.daemon = True
+
+        with self.lock:
+            status = self._execute(args, confirm)
+
+        if args.command == "connect" and status == 0:
+            self.since = time.time()
+        elif args.command == "kill":
+            self.since = None
+
+        return status
+
+
+def _stop(signum, frame):  # pylint: disable=unused-argument
+    raise KeyboardInterrupt()
+
+
+def _remove_stale_socket(path):
+    """Remove the socket at path if no daemon answers on it
+
+    :raises: DaemonError if a daemon is running
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except FileNotFoundError:
+        return
+    except ConnectionRefusedError:
+        os.remove(path)
+        return
+    finally:
+        sock.close()
+
+    raise DaemonError("A daemon is already listening on '{}'.".format(path))
+
+
+@user.needs_root
+def serve(parse_args, execute, path=None):
+    """Run the daemon until it receives SIGTERM or SIGINT. A connected openvpn
+    keeps running when the daemon stops.
+
+    :param parse_args: function to parse an argv to args
+    :param execute: function to run the command of args returning the exit status
+    :param path: the path of the socket. Defaults to the configured socket.
+    :raises: DaemonError if a daemon is already running
+    """
+    if path is None:
+        path = get_daemon_config()["socket"]
+
+    _remove_stale_socket(path)
+    umask = os.umask(0o177)
+    try:
+        server = DaemonServer(path, parse_args, execute)
+    finally:
+        os.umask(umask)
+
+    printer = Printer()
+    stdout, stderr = sys.stdout, sys.stderr
+    signal.signal(signal.SIGTERM, _stop)
+    sys.stdout, sys.stderr = server.stdout, server.stderr
+    try:
+        printer.info("Listening on '{}'".format(path))
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+
+    return True
+
+
+def _connect(path):
+    """Return a socket connected to the daemon at path or None if none listens"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError, PermissionError):
+        sock.close()
+        return None
+
+    return sock
+
+
+def forward(argv, path=None, timeout=None, confirm=False):
+    """Hand the command-line over to a running daemon. Without path the default
+    socket is tried first, so the configuration is only read if a daemon answers
+    or the socket is configured elsewhere.
+
+    :param argv: the command-line arguments without the program name
+    :param path: the path of the socket. Defaults to the configured socket.
+    :param timeout: seconds to wait for the answer. Defaults to the configured
+                    timeout.
+    :param confirm: True to answer the questions of the command with yes
+    :returns: dictionary with the exit 'status', 'stdout' and 'stderr' of the
+              command and the 'question' the command failed on if any or None if
+              no daemon is reachable
+    :raises: DaemonError if the daemon doesn't answer properly
+    """
+    daemon_config = None
+    sock = _connect(path or DAEMON_DEFAULTS["socket"])
+    if sock is None and path is None:
+        daemon_config = get_daemon_config()
+        if daemon_config["socket"] != DAEMON_DEFAULTS["socket"]:
+            sock = _connect(daemon_config["socket"])
+
+    if sock is None:
+        return None
+
+    if timeout is None:
+        timeout = (daemon_config or get_daemon_config())["timeout"]
+
+    with sock:
+        sock.settimeout(timeout)
+        try:
+            request = {"argv": argv, "confirm": confirm}
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile("rb") as sock_fd:
+                response = json.loads(sock_fd.readline().decode())
+            if not {"status", "stdout", "stderr"}.issubset(response):
+                raise ValueError(response)
+        except (OSError, ValueError, TypeError) as error:
+            raise DaemonError("The daemon didn't answer properly: {}".format(error))
+
+    return response
@@ -20,6 +20,7 @@
 
 from connord import ConnordError
 from connord.formatter import Formatter
+from connord.table import ServerTable
 
 FEATURES = {
     "ikev2": "IKEv2/IPSec Protocol",
@@ -42,6 +43,29 @@ FEATURES = {
     "openvpn_tcp_tls_crypt": "TCP TLS encryption",
 }
 
+# Stable bit positions of the features in a feature mask. Don't reorder the bits
+# but append new features.
+FEATURE_BITS = {
+    "ikev2": 1 << 0,
+    "openvpn_udp": 1 << 1,
+    "openvpn_tcp": 1 << 2,
+    "socks": 1 << 3,
+    "proxy": 1 << 4,
+    "pptp": 1 << 5,
+    "l2tp": 1 << 6,
+    "openvpn_xor_udp": 1 << 7,
+    "openvpn_xor_tcp": 1 << 8,
+    "proxy_cybersec": 1 << 9,
+    "proxy_ssl": 1 << 10,
+    "proxy_ssl_cybersec": 1 << 11,
+    "ikev2_v6": 1 << 12,
+    "openvpn_udp_v6": 1 << 13,
+    "openvpn_tcp_v6": 1 << 14,
+    "wireguard_udp": 1 << 15,
+    "openvpn_udp_tls_crypt": 1 << 16,
+    "openvpn_tcp_tls_crypt": 1 << 17,
+}
+
 
 class FeatureError(ConnordError):
     """
@@ -74,11 +98,49 @@ def verify_features(features):
     return True
 
 
+def get_mask(features):
+    """Return the feature mask of a list of features
+
+    :raises: KeyError if a feature is unknown
+    """
+    mask = 0
+    for feature in features:
+        mask |= FEATURE_BITS[feature]
+
+    return mask
+
+
+def encode_features(server_features):
+    """Return the feature mask of the features dictionary of a server. Features
+    unknown to FEATURE_BITS are ignored."""
+    mask = 0
+    for feature, enabled in server_features.items():
+        if enabled:
+            mask |= FEATURE_BITS.get(feature, 0)
+
+    return mask
+
+
+def get_server_mask(server):
+    """Return the feature mask of a server. Uses the mask precomputed by
+    servers.get_servers if present."""
+    try:
+        return server["features_mask"]
+    except KeyError:
+        return encode_features(server["features"])
+
+
+def decode_features(mask):
+    """Return the list of features set in mask"""
+    return [feature for feature, bit in FEATURE_BITS.items() if mask & bit]
+
+
 def filter_servers(servers, features=None):
     """
     Filter a list of servers by feature.
 
-    :param servers: List of servers as parsed from nordvpn api in json format
+    :param servers: List of servers as parsed from nordvpn api in json format or a
+                    ServerTable
     :param features: List of features to filter the server list. If None or
                      empty the default 'openvpn_udp' is applied.
     :returns: The filtered list
@@ -87,19 +149,11 @@ def filter_servers(servers, features=None):
     if features is None or not features:
         features = ["openvpn_udp"]
 
-    filtered_servers = []
-    servers = servers.copy()
-    for server in servers:
-        append = True
-        for feature in features:
-            if not server["features"][feature]:
-                append = False
-                break
-
-        if append:
-            filtered_servers.append(server)
+    mask = get_mask(features)
+    if isinstance(servers, ServerTable):
+        return servers.filter_mask("features", mask)
 
-    return filtered_servers
+    return [server for server in servers if get_server_mask(server) & mask == mask]
 
 
 class FeaturesPrettyFormatter(Formatter):
@@ -0,0 +1,254 @@
+# vim: set fileencoding=utf-8 :
+
+# connord - connect to nordvpn servers
+# Copyright (C) 2019  Mael Stor <maelstor@posteo.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Reverse geocoding of server locations with exchangeable backends"""
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from connord import ConnordError
+from connord import resources
+
+API_URL = "https://nominatim.openstreetmap.org"
+GEOCODING_DEFAULTS = {
+    "backend": "nominatim",
+    "url": API_URL,
+    "snapshot": None,
+    "rate": 1.0,
+    "burst": 1,
+    "workers": 4,
+    "retries": 3,
+    "backoff": 1.0,
+    "timeout": 5.0,
+}
+
+
+class GeocodingError(ConnordError):
+    """Thrown within this module"""
+
+    def __init__(self, message, retry=False):
+        """Init
+
+        :param message: the error message
+        :param retry: True if the request may succeed when repeated
+        """
+        super().__init__(message)
+        self.retry = retry
+
+
+class TokenBucket:
+    """Thread-safe token bucket. Callers reserve a token and sleep until it is
+    due, so requests start at the given rate no matter how long each one takes."""
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        """Init
+
+        :param rate: tokens per second
+        :param capacity: maximum count of tokens available at once
+        :param clock: monotonic clock returning seconds
+        :param sleep: function to sleep seconds
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token and block until it is available"""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait > 0:
+            self._sleep(wait)
+
+
+class NominatimBackend:
+    """Queries the reverse endpoint of a nominatim api. May point to a local
+    instance."""
+
+    rate_limited = True
+    header = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 6.1; Win64; x64; rv:60.0) "
+        "Gecko/20100101 Firefox/60.0"
+    }
+
+    def __init__(self, url=API_URL, timeout=5.0):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def reverse(self, latitude, longitude):
+        """Query the location given with latitude and longitude coordinates
+
+        :param latitude: string with the latitude in float notation
+        :param longitude: string with the longitude in float notation
+        :returns: dictionary of the response in json
+        :raises: GeocodingError
+        """
+        flags = {
+            "lat": latitude,
+            "lon": longitude,
+            "format": "jsonv2",
+            "addressdetails": "1",
+            "accept-language": "en",
+            "zoom": "18",
+        }
+        url = "{}/reverse.php?".format(self.url)
+        url += "&".join("{}={}".format(k, v) for k, v in flags.items())
+
+        try:
+            with requests.get(
+                url, headers=self.header, timeout=self.timeout
+            ) as response:
+                if response.status_code == 429 or response.status_code >= 500:
+                    raise GeocodingError(
+                        "{} answered {}".format(self.url, response.status_code),
+                        retry=True,
+                    )
+                response.raise_for_status()
+                return response.json()
+        except requests.HTTPError as error:
+            raise GeocodingError(str(error))
+        except (requests.RequestException, ValueError) as error:
+            raise GeocodingError(str(error), retry=True)
+
+
+class SnapshotBackend:
+    """Answers from a json file mapping 'latitude,longitude' to nominatim
+    responses. Needs no network."""
+
+    rate_limited = False
+
+    def __init__(self, snapshot_file):
+        """Init
+
+        :raises: GeocodingError if the snapshot can't be read
+        """
+        try:
+            with open(snapshot_file, "r") as snapshot_fd:
+                self.locations = json.load(snapshot_fd)
+        except (OSError, ValueError) as error:
+            raise GeocodingError(
+                "Could not read snapshot '{}': {}".format(snapshot_file, error)
+            )
+
+    def reverse(self, latitude, longitude):
+        """Return the location given with latitude and longitude coordinates
+
+        :raises: GeocodingError if the location isn't in the snapshot
+        """
+        try:
+            return self.locations["{},{}".format(latitude, longitude)]
+        except KeyError:
+            raise GeocodingError(
+                "Location not in snapshot: {},{}".format(latitude, longitude)
+            )
+
+
+def get_geocoding_config():
+    """Return the 'geocoding' section of the configuration merged with the
+    defaults"""
+    return resources.get_config_section("geocoding", GEOCODING_DEFAULTS)
+
+
+def get_backend(geocoding_config):
+    """Return the backend configured in geocoding_config
+
+    :raises: GeocodingError if the backend is unknown
+    """
+    backend = geocoding_config["backend"]
+    if backend == "nominatim":
+        return NominatimBackend(geocoding_config["url"], geocoding_config["timeout"])
+    if backend == "snapshot":
+        return SnapshotBackend(geocoding_config["snapshot"])
+
+    raise GeocodingError("Unknown geocoding backend: {!r}".format(backend))
+
+
+# pylint: disable=too-many-arguments
+def reverse_many(
+    coordinates,
+    backend,
+    rate=1.0,
+    burst=1,
+    workers=4,
+    retries=3,
+    backoff=1.0,
+    callback=None,
+):
+    """Reverse geocode many coordinates concurrently. Requests to rate limited
+    backends start at most rate times per second but overlap while waiting for the
+    answers. Failing requests are repeated with exponential backoff if the error
+    may be temporary.
+
+    :param coordinates: iterable of (latitude, longitude) tuples. Duplicates are
+                        queried once.
+    :param backend: the backend to query
+    :param rate: requests per second
+    :param burst: count of requests which may start at once
+    :param workers: count of concurrent requests
+    :param retries: count of repetitions of a failed request
+    :param backoff: seconds to wait before the first repetition. Doubles with every
+                    further repetition.
+    :param callback: called without arguments after each coordinate is done
+    :returns: tuple (results, errors) of dictionaries mapping coordinates to the
+              response respectively to the GeocodingError of the last try
+    """
+    bucket = TokenBucket(rate, burst) if backend.rate_limited else None
+
+    def reverse(coordinate):
+        attempt = 0
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+            try:
+                return backend.reverse(*coordinate)
+            except GeocodingError as error:
+                if not error.retry or attempt >= retries:
+                    raise
+
+            time.sleep(backoff * 2**attempt)
+            attempt += 1
+
+    results = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(reverse, coordinate): coordinate
+            for coordinate in dict.fromkeys(coordinates)
+        }
+        for future in as_completed(futures):
+            coordinate = futures[future]
+            try:
+                results[coordinate] = future.result()
+            except GeocodingError as error:
+                errors[coordinate] = error
+
+            if callback is not None:
+                callback()
+
+    return results, errors
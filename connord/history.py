@@ -0,0 +1,97 @@
+# vim: set fileencoding=utf-8 :
+
+# connord - connect to nordvpn servers
+# Copyright (C) 2019  Mael Stor <maelstor@posteo.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Persistent latency history of probed servers"""
+
+import time
+from math import inf
+from connord import resources
+from connord import sqlite
+
+HISTORY_DEFAULTS = {"candidates": 20, "max_age": 3600, "alpha": 0.3, "keep": 2592000}
+STATS = ("median", "p95", "jitter", "loss")
+
+
+def get_history_config():
+    """Return the 'history' section of the configuration merged with the defaults"""
+    return resources.get_config_section("history", HISTORY_DEFAULTS)
+
+
+def moving_average(average, latency, alpha):
+    """Return the exponentially weighted moving average of the latency statistics.
+
+    :param average: the previous average as dictionary or None
+    :param latency: the latest statistics as returned by probe.get_stats
+    :param alpha: the weight of the latest statistics between 0 and 1
+    :returns: a new dictionary with the averaged statistics
+    """
+    if average is None:
+        return {stat: latency[stat] for stat in STATS}
+
+    new_average = {"loss": alpha * latency["loss"] + (1 - alpha) * average["loss"]}
+    for stat in ("median", "p95", "jitter"):
+        # a server without any answer keeps its previous times and only the loss
+        # grows
+        if latency[stat] == inf:
+            new_average[stat] = average[stat]
+        elif average[stat] == inf:
+            new_average[stat] = latency[stat]
+        else:
+            new_average[stat] = alpha * latency[stat] + (1 - alpha) * average[stat]
+
+    return new_average
+
+
+def get_averages(connection, max_age):
+    """Return the moving averages not older than max_age seconds
+
+    :returns: dictionary of domain to averaged statistics
+    """
+    with connection:
+        sqlite.create_latency_tables(connection)
+
+    return sqlite.get_latency_averages(connection, since=time.time() - max_age)
+
+
+def record(connection, servers_, history_config, timestamp=None):
+    """Store the latencies of probed servers and update their moving averages.
+
+    :param connection: a database connection
+    :param servers_: list of servers with the key 'latency'
+    :param history_config: the history configuration
+    :param timestamp: the time of the measurement. Defaults to now.
+    """
+    if timestamp is None:
+        timestamp = time.time()
+
+    with connection:
+        sqlite.create_latency_tables(connection)
+
+    averages = sqlite.get_latency_averages(connection)
+    latencies = []
+    new_averages = []
+    for server in servers_:
+        domain = server["domain"]
+        latency = server["latency"]
+        latencies.append((domain, timestamp) + tuple(latency[s] for s in STATS))
+
+        average = moving_average(averages.get(domain), latency, history_config["alpha"])
+        new_averages.append((domain, timestamp) + tuple(average[s] for s in STATS))
+
+    sqlite.create_latencies(connection, latencies)
+    sqlite.replace_latency_averages(connection, new_averages)
+    sqlite.delete_latencies(connection, timestamp - history_config["keep"])
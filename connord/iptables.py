@@ -18,12 +18,16 @@
 
 """Wrapper around iptables"""
 
+import copy
+import hashlib
+import json
 import os
 import re
+import threading
+import cachetools
 import netaddr
 from iptc import Table, Table6
 import iptc
-import yaml
 
 from jinja2 import Environment, FileSystemLoader
 
@@ -35,6 +39,13 @@ from connord import resources
 from connord.formatter import Formatter
 
 
+# jinja2 environments by template directory
+_ENVIRONMENTS = {}
+# parsed configurations by file, file state and render context
+_RENDERED = cachetools.LRUCache(maxsize=32)
+_LOCK = threading.Lock()
+
+
 class IptablesError(ConnordError):
     """Raise within this module"""
 
@@ -133,101 +144,269 @@ def verify_table(table):
     return table in Table.ALL or table in Table6.ALL
 
 
-def flush_tables(ipv6=False):
-    """Flush all tables and apply the default policy ACCEPT to standard tables"""
+def flush_tables(ipv6=False, exclude=()):
+    """Flush all tables and apply the default policy ACCEPT to standard tables
+
+    :param ipv6: if True flush the ipv6 tables
+    :param exclude: names of tables to leave untouched
+    """
     printer = Printer()
     with printer.Do("Flushing all tables: ipv6={!r}".format(ipv6)):
-        iptc.easy.flush_all(ipv6=ipv6)
-
-    with printer.Do("Setting ACCEPT policy in all chains"):
-        policy = iptc.Policy("ACCEPT")
         for table_s in iptc.easy.get_tables(ipv6):
-            for chain_s in iptc.easy.get_chains(table_s, ipv6):
-                iptc.easy.set_policy(table_s, chain_s, policy=policy, ipv6=ipv6)
+            if table_s not in exclude:
+                table = init_table(table_s + "6" if ipv6 else table_s)
+                commit_config(table, {})
 
 
 def reset(fallback=True):
-    """Reset all tables to fallback if True else just flush them"""
-    flush_tables()
-    flush_tables(ipv6=True)
-    if fallback:
-        apply_config_dir(filetype="fallback")
+    """Reset all tables to fallback if True else just flush them. Tables with a
+    fallback file switch to it directly without being flushed in between."""
+    compiled = compile_config_dir(filetype="fallback") if fallback else []
+    flush_tables(
+        exclude=[table.name for table, _, _ in compiled if not is_table_v6(table)]
+    )
+    flush_tables(
+        ipv6=True, exclude=[table.name for table, _, _ in compiled if is_table_v6(table)]
+    )
+    _commit_compiled(compiled)
 
 
-def _apply_config(table, config_d, ipv6):
-    for chain_s in config_d:
-        if not iptc.easy.has_chain(table, chain_s, ipv6=ipv6):
-            iptc.easy.add_chain(table, chain_s, ipv6=ipv6)
+def _raise_malformed(rule_d, table, chain_s):
+    raise IptablesError(
+        "Malformed rule: {}\n  in {}.{}".format(rule_d, table.name, chain_s)
+    )
 
+
+def _encode_rules(table, chain_s, chain_d):
+    """Return the rules of chain_d as iptc rules"""
+    ipv6 = is_table_v6(table)
+    try:
+        rules = chain_d["rules"]
+    except (KeyError, TypeError):
+        return []
+
+    encoded = []
+    for rule_d in rules:
+        if not iptc.easy.test_rule(rule_d, ipv6=ipv6):
+            _raise_malformed(rule_d, table, chain_s)
         try:
-            if config_d[chain_s]["policy"] != "None":
-                policy = iptc.Policy(config_d[chain_s]["policy"])
-                iptc.easy.set_policy(table, chain_s, policy=policy, ipv6=ipv6)
-        except KeyError:
-            pass
+            encoded.append(iptc.easy.encode_iptc_rule(rule_d, ipv6=ipv6))
+        except ValueError:
+            _raise_malformed(rule_d, table, chain_s)
+
+    return encoded
+
+
+def encode_config(table, config_d):
+    """Return the rules of every chain of config_d as iptc rules
+
+    :returns: dictionary of chain name to list of rules
+    :raises: IptablesError if an invalid rule is present
+    """
+    return {
+        chain_s: _encode_rules(table, chain_s, chain_d)
+        for chain_s, chain_d in config_d.items()
+    }
+
+
+def _reconcile_rules(chain, wanted):
+    """Stage the minimal changes by position to turn the rules of chain into the
+    wanted rules. Rules equal at the same position after skipping the common head
+    and tail are left alone.
 
+    :returns: the count of changes
+    """
+    current = chain.rules
+    head = 0
+    while head < min(len(current), len(wanted)) and current[head] == wanted[head]:
+        head += 1
+    tail = 0
+    while (
+        tail < min(len(current), len(wanted)) - head
+        and current[-1 - tail] == wanted[-1 - tail]
+    ):
+        tail += 1
+
+    old = current[head : len(current) - tail]
+    new = wanted[head : len(wanted) - tail]
+    # libiptc deletes the first rule matching a spec, not the one at a position
+    for rule in old[len(new) :]:
+        if any(rule == other for other in current[:head] + new):
+            chain.flush()
+            for rule_ in wanted:
+                chain.append_rule(rule_)
+            return len(current) + len(wanted)
+
+    changes = 0
+    for offset, (old_rule, new_rule) in enumerate(zip(old, new)):
+        if old_rule != new_rule:
+            chain.replace_rule(new_rule, head + offset)
+            changes += 1
+    for offset, new_rule in enumerate(new[len(old) :], start=len(old)):
+        chain.insert_rule(new_rule, head + offset)
+        changes += 1
+    for old_rule in old[len(new) :]:
+        chain.delete_rule(old_rule)
+        changes += 1
+
+    return changes
+
+
+def _reconcile_policy(chain, policy_s):
+    if chain.is_builtin() and chain.get_policy().name == policy_s:
+        return 0
+
+    chain.set_policy(iptc.Policy(policy_s))
+    return 1
+
+
+def _apply_config(table, config_d, wanted=None):
+    """Stage the changes to turn the current state of table into config_d
+    without committing them. Builtin chains missing in config_d are flushed and
+    get the ACCEPT policy, user-defined chains missing in config_d are deleted.
+
+    :param wanted: the rules as returned by encode_config or None
+    :returns: the count of changes
+    """
+    if wanted is None:
+        wanted = encode_config(table, config_d)
+
+    changes = 0
+    for chain_s in config_d:
+        if not table.is_chain(chain_s):
+            table.create_chain(chain_s)
+            changes += 1
+
+    chains = {chain.name: chain for chain in table.chains}
+    chains.update((chain_s, iptc.Chain(table, chain_s)) for chain_s in config_d)
+    obsolete = [
+        chain
+        for chain_s, chain in chains.items()
+        if chain_s not in config_d and not chain.is_builtin()
+    ]
+    for chain_s, chain in chains.items():
+        if chain.is_builtin() or chain_s in config_d:
+            changes += _reconcile_rules(chain, wanted.get(chain_s, []))
+
+    # rules referencing the obsolete chains are gone now
+    for chain in obsolete:
+        chain.flush()
+    for chain in obsolete:
+        chain.delete()
+        changes += 1
+
+    for chain_s, chain in chains.items():
         try:
-            for rule_d in config_d[chain_s]["rules"]:
-                if iptc.easy.test_rule(rule_d, ipv6=ipv6):
-                    try:
-                        iptc.easy.add_rule(table, chain_s, rule_d, ipv6=ipv6)
-                    except ValueError:
-                        raise IptablesError(
-                            "Malformed rule: {}\n  in {}.{}".format(
-                                rule_d, table, chain_s
-                            )
-                        )
-                else:
-                    raise IptablesError(
-                        "Malformed rule: {}\n  in {}.{}".format(rule_d, table, chain_s)
-                    )
-        except KeyError:
-            pass
+            policy_s = config_d[chain_s]["policy"]
+        except (KeyError, TypeError):
+            policy_s = "None"
+
+        if policy_s != "None":
+            changes += _reconcile_policy(chain, policy_s)
+        elif chain.is_builtin():
+            changes += _reconcile_policy(chain, "ACCEPT")
+
+    return changes
+
+
+def commit_config(table, config_d, wanted=None):
+    """Turn table into config_d in a single transaction. Only the chains,
+    policies and rules which differ are touched, so the kernel sees either the
+    old or the new table and a reconnect changes just a few rules.
+
+    :param table: a Table or Table6 object
+    :param config_d: dictionary of chains as returned by read_config
+    :param wanted: the rules of config_d as returned by encode_config or None
+    :returns: the count of changes
+    :raises: IptablesError if an invalid rule is present. The table is left
+             unchanged then.
+    """
+    table.autocommit = False
+    try:
+        table.refresh()
+        changes = _apply_config(table, config_d, wanted)
+        if changes:
+            table.commit()
+    except Exception:
+        # discard everything staged so far
+        table.refresh()
+        raise
+    finally:
+        table.autocommit = True
+
+    return changes
 
 
 @user.needs_root
-def apply_config(config_file, server=None, protocol=None):
-    """Apply a configuration to ip[6]tables (depends on the file name)
+def compile_config(config_file, server=None, protocol=None, context=None):
+    """Render a configuration file for the table named by the file name
 
-    :raises: IptablesError if an invalid rule is present. This leaves the
-             table intact with rules applied so far.
+    :param context: the context returned by get_render_context or None
+    :returns: tuple (table, config_d)
     """
     table = init_table_from_file_name(config_file)
-    table_s = table.name
-    is_ipv6 = is_table_v6(table)
+    return table, read_config(config_file, server, protocol, context)
+
+
+@user.needs_root
+def compile_config_dir(server=None, protocol=None, filetype="rules"):
+    """Render all rules or fallback files of the configuration directory with a
+    shared render context
 
+    :returns: list of tuples (table, file name, config_d)
+    """
+    config_files = resources.list_config_dir(filetype=filetype)
+    if not config_files:
+        return []
+
+    context = get_render_context(server, protocol)
+    compiled = []
+    for config_file in config_files:
+        table, config_d = compile_config(config_file, server, protocol, context)
+        compiled.append((table, os.path.basename(config_file), config_d))
+
+    return compiled
+
+
+def _commit_compiled(compiled):
+    # validate every rule before the first table changes
+    encoded = [encode_config(table, config_d) for table, _, config_d in compiled]
     printer = Printer()
-    with printer.Do("Flushing table '{}', ipv6={!r}".format(table_s, is_ipv6)):
-        iptc.easy.flush_table(table_s, ipv6=is_ipv6)
-        policy = iptc.Policy("ACCEPT")
-        for chain_s in iptc.easy.get_chains(table_s, ipv6=is_ipv6):
-            iptc.easy.set_policy(table_s, chain_s, policy=policy, ipv6=is_ipv6)
+    for (table, config_base, config_d), wanted in zip(compiled, encoded):
+        with printer.Do(
+            "Applying '{}' to table '{}', ipv6={!r}".format(
+                config_base, table.name, is_table_v6(table)
+            )
+        ):
+            commit_config(table, config_d, wanted)
 
-    config_base = os.path.basename(config_file)
-    with printer.Do("Applying '{}'".format(config_base)):
-        config_d = read_config(config_file, server, protocol)
-        _apply_config(table_s, config_d, ipv6=is_ipv6)
 
+@user.needs_root
+def apply_config(config_file, server=None, protocol=None):
+    """Apply a configuration to ip[6]tables (depends on the file name)
+
+    :raises: IptablesError if an invalid rule is present. This leaves the
+             table unchanged.
+    """
+    table, config_d = compile_config(config_file, server, protocol)
+    _commit_compiled([(table, os.path.basename(config_file), config_d)])
     return True
 
 
 @user.needs_root
 def apply_config_dir(server=None, protocol=None, filetype="rules"):
     """High-level command to apply the whole configuration directory with rules or
-    fallback files in it.
+    fallback files in it. All files are rendered and all rules are validated
+    before the first table is touched and each table is replaced in a single
+    transaction.
 
     :param server: If None this applies 0.0.0.0/0 instead
     :param protocol: If None the default 'udp' is taken
     :param filetype: default is rules but may be fallback too.
     :returns: True on success
     """
-    config_files = resources.list_config_dir(filetype=filetype)
-    retval = True
-    for config_file in config_files:
-        if not apply_config(config_file, server, protocol):
-            retval = False
-
-    return retval
+    _commit_compiled(compile_config_dir(server, protocol, filetype))
+    return True
 
 
 @user.needs_root
@@ -240,9 +419,7 @@ def merge_environment(config_data_dict=None):
 
     files = resources.list_stats_dir(filetype="env")
     for file_ in files:
-        with open(file_, "r") as file_fd:
-            yaml_dict = yaml.safe_load(file_fd)
-            env_dict.update(yaml_dict)
+        env_dict.update(resources.read_yaml_file(file_))
 
     if config_data_dict:
         env_dict.update(config_data_dict)
@@ -294,7 +471,67 @@ def get_interface_addresses(iface):
     return default_iface_dict
 
 
-def render_template(config_file, server=None, protocol=None):
+def get_render_context(server=None, protocol=None):
+    """Return the variables available in rules and fallback files. The context is
+    built once per apply operation and shared by all files.
+
+    :param server: if None this defaults to 0.0.0.0/0
+    :param protocol: if None this defaults to 'udp'
+    :returns: dictionary of the config.yml file merged with the connord variables
+              and the environment files
+    """
+    config_data_dict = resources.get_config()
+    if server:
+        config_data_dict["vpn_remote"] = server["ip_address"]
+    else:
+        config_data_dict["vpn_remote"] = "0.0.0.0/0"
+
+    if protocol:
+        config_data_dict["vpn_protocol"] = protocol
+    else:
+        config_data_dict["vpn_protocol"] = "udp"
+        protocol = "udp"
+
+    if protocol == "udp":
+        config_data_dict["vpn_port"] = "1194"
+    elif protocol == "tcp":
+        config_data_dict["vpn_port"] = "443"
+    else:
+        raise TypeError("Unknown protocol '{}'.".format(protocol))
+
+    default_ip, default_iface = get_default_gateway(ipv6=False)
+    if default_iface:
+        try:
+            interface_addresses = get_interface_addresses(default_iface)
+            config_data_dict["gateway"] = {
+                "ip_address": default_ip,
+                "interface": default_iface,
+            }
+            config_data_dict["lan"] = interface_addresses
+        except KeyError:
+            config_data_dict["gateway"] = {}
+            config_data_dict["lan"] = {}
+
+    return merge_environment(config_data_dict)
+
+
+def _get_environment(template_dir):
+    """Return the jinja2 environment of template_dir. The environment keeps the
+    compiled templates and compiles them again when the file changes."""
+    with _LOCK:
+        env = _ENVIRONMENTS.get(template_dir)
+        if env is None:
+            env = Environment(
+                loader=FileSystemLoader(template_dir),
+                trim_blocks=True,
+                lstrip_blocks=True,
+            )
+            _ENVIRONMENTS[template_dir] = env
+
+    return env
+
+
+def render_template(config_file, server=None, protocol=None, context=None):
     """Render a jinja2 template with data from config.yml per default. Adds some
     useful variables to the environment which can be uses in rules and fallback
     files.
@@ -302,64 +539,56 @@ def render_template(config_file, server=None, protocol=None):
     :param config_file: the template
     :param server: if None this defaults to 0.0.0.0/0
     :param protocol: if None this defaults to 'udp'
+    :param context: the context returned by get_render_context. Built from server
+                    and protocol if None.
     :returns: the rendered template as string
     """
-    config_data_file = resources.get_config_file()
-    env = Environment(
-        loader=FileSystemLoader(os.path.dirname(config_data_file)),
-        trim_blocks=True,
-        lstrip_blocks=True,
-    )
-    with open(config_data_file, "r") as config_data:
-        config_data_dict = yaml.safe_load(config_data)
-        if server:
-            config_data_dict["vpn_remote"] = server["ip_address"]
-        else:
-            config_data_dict["vpn_remote"] = "0.0.0.0/0"
+    if context is None:
+        context = get_render_context(server, protocol)
 
-        if protocol:
-            config_data_dict["vpn_protocol"] = protocol
-        else:
-            config_data_dict["vpn_protocol"] = "udp"
-            protocol = "udp"
-
-        if protocol == "udp":
-            config_data_dict["vpn_port"] = "1194"
-        elif protocol == "tcp":
-            config_data_dict["vpn_port"] = "443"
-        else:
-            raise TypeError("Unknown protocol '{}'.".format(protocol))
-
-        default_ip, default_iface = get_default_gateway(ipv6=False)
-        if default_iface:
-            try:
-                interface_addresses = get_interface_addresses(default_iface)
-                config_data_dict["gateway"] = {
-                    "ip_address": default_ip,
-                    "interface": default_iface,
-                }
-                config_data_dict["lan"] = interface_addresses
-            except KeyError:
-                config_data_dict["gateway"] = {}
-                config_data_dict["lan"] = {}
-
-        config_data_dict = merge_environment(config_data_dict)
-        template = env.get_template(os.path.basename(config_file))
-        return template.render(config_data_dict)
+    env = _get_environment(os.path.dirname(resources.get_config_file()))
+    template = env.get_template(os.path.basename(config_file))
+    return template.render(context)
 
 
 @user.needs_root
-def read_config(config_file, server=None, protocol=None):
-    """High-level abstraction for the render_template method
+def read_config(config_file, server=None, protocol=None, context=None):
+    """High-level abstraction for the render_template method. The parsed result is
+    kept until the file or the context changes.
 
     :param config_file: the template
     :param server: the server as dict or None
     :param protocol: the used protocol as string. may be one of 'udp' or 'tcp'
+    :param context: the context returned by get_render_context or None
     :returns: the rendered template file as dictionary
     """
-
-    rendered_template = render_template(config_file, server, protocol)
-    return yaml.safe_load(rendered_template)
+    if context is None:
+        context = get_render_context(server, protocol)
+
+    stat = os.stat(config_file)
+    context_s = json.dumps(context, sort_keys=True, default=str)
+    key = (
+        config_file,
+        stat.st_mtime_ns,
+        stat.st_size,
+        hashlib.sha1(context_s.encode()).hexdigest(),
+    )
+    with _LOCK:
+        config_d = _RENDERED.get(key)
+    if config_d is None:
+        rendered_template = render_template(config_file, context=context)
+        config_d = resources.load_yaml(rendered_template)
+        with _LOCK:
+            _RENDERED[key] = config_d
+
+    return copy.deepcopy(config_d)
+
+
+def clear_cache():
+    """Forget the compiled templates and the rendered configurations"""
+    with _LOCK:
+        _ENVIRONMENTS.clear()
+        _RENDERED.clear()
 
 
 class IptablesPrettyFormatter(Formatter):
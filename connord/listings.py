@@ -18,27 +18,27 @@
 
 """List servers"""
 
-from connord import servers
 from connord import countries
 from connord import categories
 from connord import features
 from connord import load
-from connord import iptables
-from connord import areas
+from connord.lazy import lazy_import
+
+servers = lazy_import("connord.servers")
+iptables = lazy_import("connord.iptables")
+areas = lazy_import("connord.areas")
 
 
 def filter_servers_by_count(servers_, top):
     """
     Filter servers to just show top count results
 
-    :param servers_: List of servers
+    :param servers_: List of servers or a ServerTable
     :param top: Integer to show count servers
     :returns: The filtered servers
     """
 
-    servers_ = servers_.copy()
-    filtered_servers = [server for i, server in enumerate(servers_, 1) if i <= top]
-    return filtered_servers
+    return servers_[:top]
 
 
 def list_iptables(tables, version):
@@ -75,7 +75,6 @@ def filter_servers(
 
     :returns: the filtered servers
     """
-    servers_ = servers_.copy()
     if load_:
         servers_ = load.filter_servers(servers_, load_, match)
     if netflix:
@@ -109,7 +108,7 @@ def list_servers(countries_, areas_, categories_, features_, netflix, load_, mat
     :returns: True
     """
 
-    servers_ = servers.get_servers()
+    servers_ = servers.get_server_table()
     servers_ = filter_servers(
         servers_, netflix, countries_, areas_, features_, categories_, load_, match, top
     )
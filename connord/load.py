@@ -18,6 +18,7 @@
 
 import abc
 from connord import ConnordError
+from connord.table import ServerTable
 
 
 class LoadError(ConnordError):
@@ -76,6 +77,17 @@ class Filter(metaclass=abc.ABCMeta):
 
         return filtered_servers
 
+    def _select(self, predicate):
+        """Select servers where predicate(load) is true
+
+        :param predicate: function taking the load of a server
+        :returns: a ServerTable if servers is a ServerTable else a list
+        """
+        if isinstance(self.servers, ServerTable):
+            return self.servers.filter("load", predicate)
+
+        return [server for server in self.servers if predicate(server["load"])]
+
     @abc.abstractmethod
     def filter_(self, load):
         """
@@ -91,8 +103,7 @@ class LoadFilter(Filter):
     """
 
     def filter_(self, load):
-        filtered_servers = [server for server in self.servers if server["load"] == load]
-        return filtered_servers
+        return self._select(lambda server_load: server_load == load)
 
 
 class MaxLoadFilter(Filter):
@@ -101,8 +112,7 @@ class MaxLoadFilter(Filter):
     """
 
     def filter_(self, load):
-        filtered_servers = [server for server in self.servers if server["load"] <= load]
-        return filtered_servers
+        return self._select(lambda server_load: server_load <= load)
 
 
 class MinLoadFilter(Filter):
@@ -111,8 +121,7 @@ class MinLoadFilter(Filter):
     """
 
     def filter_(self, load):
-        filtered_servers = [server for server in self.servers if server["load"] >= load]
-        return filtered_servers
+        return self._select(lambda server_load: server_load >= load)
 
 
 def filter_servers(servers, load, match="max"):
@@ -0,0 +1,136 @@
+# vim: set fileencoding=utf-8 :
+
+# connord - connect to nordvpn servers
+# Copyright (C) 2019  Mael Stor <maelstor@posteo.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Client of the openvpn management interface to follow the state of openvpn"""
+
+import select
+import socket
+import time
+from connord import ConnordError
+
+
+class ManagementError(ConnordError):
+    """Raised when openvpn fails or doesn't reach a state in time"""
+
+
+def parse_state(line):
+    """Return the state name of a state line of the management interface or None
+
+    :param line: a line like '>STATE:1561975612,CONNECTED,SUCCESS,10.8.0.2,...' or
+                 a line of the answer to the 'state' command without the prefix
+    """
+    if line.startswith(">STATE:"):
+        line = line[len(">STATE:") :]
+
+    fields = line.split(",")
+    if len(fields) > 1 and fields[0].isdigit():
+        return fields[1]
+
+    return None
+
+
+class ManagementClient:
+    """Talks to the management interface of openvpn over a unix socket"""
+
+    def __init__(self, path):
+        """Init
+
+        :param path: the path of the socket given to --management
+        """
+        self.path = path
+        self.sock = None
+        self._buffer = b""
+
+    def connect(self, is_alive, timeout):
+        """Connect as soon as openvpn created the socket
+
+        :param is_alive: function returning False if openvpn stopped
+        :param timeout: seconds to wait for the socket
+        :raises: ManagementError if openvpn stopped or the timeout is reached
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                self.sock = sock
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+
+            if not is_alive():
+                raise ManagementError("Openvpn process stopped unexpected.")
+            if time.monotonic() >= deadline:
+                raise ManagementError("Timeout reached.")
+
+            # openvpn creates the socket right after startup
+            time.sleep(0.01)
+
+    def close(self):
+        """Close the connection. Openvpn keeps running."""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def send(self, command):
+        """Send a command"""
+        self.sock.sendall(command.encode() + b"\n")
+
+    def read_line(self, timeout):
+        """Return the next line without line ending or None if openvpn closed the
+        connection
+
+        :raises: ManagementError if no line arrives within timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+        while b"\n" not in self._buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self.sock], [], [], remaining)[0]:
+                raise ManagementError("Timeout reached.")
+
+            data = self.sock.recv(4096)
+            if not data:
+                return None
+            self._buffer += data
+
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return line.decode(errors="replace").rstrip("\r")
+
+    def wait_connected(self, timeout):
+        """Block until openvpn reports the CONNECTED state
+
+        :raises: ManagementError if openvpn fails, stops or doesn't connect within
+                 timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+        # subscribe first and ask for the current state to not miss a change
+        self.send("state on")
+        self.send("state")
+        while True:
+            line = self.read_line(deadline - time.monotonic())
+            if line is None:
+                raise ManagementError("Openvpn process stopped unexpected.")
+            if line.startswith(">FATAL:"):
+                raise ManagementError(line[len(">FATAL:") :])
+            if line.startswith(">PASSWORD:Verification Failed"):
+                raise ManagementError("Authentication failed.")
+
+            state = parse_state(line)
+            if state == "CONNECTED":
+                return
+            if state == "EXITING":
+                raise ManagementError("Openvpn is exiting.")
@@ -0,0 +1,133 @@
+# vim: set fileencoding=utf-8 :
+
+# connord - connect to nordvpn servers
+# Copyright (C) 2019  Mael Stor <maelstor@posteo.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Synthesize openvpn configurations of servers from a shared template.
+
+The configuration files of all servers of a protocol are equal except for the
+ip address and the domain of the server. A template is made of one configuration
+by replacing both with placeholders and verified against other configurations.
+The servers whose configurations differ from the template nevertheless are
+found with find_mismatches.
+"""
+
+import re
+from string import Template
+from connord import archives
+
+PROTOCOLS = ("udp", "tcp")
+# count of configurations a template is checked against before all
+# configurations are verified
+SAMPLES = 8
+
+_REMOTE = re.compile(r"^remote\s+(\S+)", re.MULTILINE)
+_MEMBER = re.compile(r"^ovpn_(udp|tcp)/(.+)\.(udp|tcp)\.ovpn$")
+
+
+def _ip_pattern(ip_address):
+    return re.compile(r"(?<![\d.]){}(?![\d.])".format(re.escape(ip_address)))
+
+
+def make_template(config, server):
+    """Make a template of the configuration of server
+
+    :param config: the configuration as string
+    :param server: dictionary with 'domain' and 'ip_address' of the server
+    :returns: the template as string
+    :raises: ValueError if the ip address of the server isn't in the configuration
+    """
+    template = config.replace("$", "$$")
+    template, count = _ip_pattern(server["ip_address"]).subn("${ip_address}", template)
+    if not count:
+        raise ValueError(
+            "{} not found in the configuration.".format(server["ip_address"])
+        )
+
+    return template.replace(server["domain"], "${domain}")
+
+
+def render(template, server):
+    """Return the configuration of server rendered from template"""
+    return Template(template).substitute(
+        ip_address=server["ip_address"], domain=server["domain"]
+    )
+
+
+def _get_server(name, config):
+    """Return the server record of a configuration file in an archive or None"""
+    match = _MEMBER.match(name)
+    remote = _REMOTE.search(config)
+    if not match or not remote:
+        return None
+
+    return {"domain": match.group(2), "ip_address": remote.group(1)}
+
+
+def build_template(zip_file, protocol, samples=SAMPLES):
+    """Make the template of the configurations of protocol in zip_file. The
+    template is verified against samples configurations spread over the archive.
+
+    :returns: the template or None if the configurations don't share a template
+    :raises: OSError if the archive can't be read
+             ArchiveError if the archive is corrupt
+    """
+    prefix = "ovpn_{}/".format(protocol)
+    names = sorted(
+        name for name in archives.get_index(zip_file) if name.startswith(prefix)
+    )
+    if not names:
+        return None
+
+    step = max(len(names) // samples, 1)
+    template = None
+    for name in names[::step][:samples]:
+        config = archives.read_member(zip_file, name).decode()
+        server = _get_server(name, config)
+        if server is None:
+            return None
+
+        if template is None:
+            try:
+                template = make_template(config, server)
+            except ValueError:
+                return None
+        elif render(template, server) != config:
+            return None
+
+    return template
+
+
+def find_mismatches(zip_file, protocol, template):
+    """Verify the template against every configuration of protocol in zip_file
+
+    :returns: set of the domains whose configurations differ from the rendered
+              template
+    :raises: OSError if the archive can't be read
+             ArchiveError if the archive is corrupt
+    """
+    prefix = "ovpn_{}/".format(protocol)
+    mismatches = set()
+    for name in archives.get_index(zip_file):
+        match = _MEMBER.match(name)
+        if not name.startswith(prefix) or not match:
+            continue
+
+        config = archives.read_member(zip_file, name).decode(errors="replace")
+        server = _get_server(name, config)
+        if server is None or render(template, server) != config:
+            mismatches.add(match.group(2))
+
+    return mismatches
@@ -4,7 +4,18 @@ import sys
 from progress.bar import IncrementalBar
 from progress.spinner import Spinner
 
-from connord import sqlite
+from connord import ConnordError
+from connord.lazy import lazy_import
+
+sqlite = lazy_import("connord.sqlite")
+
+
+class PromptError(ConnordError):
+    """Raised when a question needs an answer but the user can't be asked"""
+
+    def __init__(self, question):
+        super().__init__("Confirmation needed: {}".format(question))
+        self.question = question
 
 
 class Borg:
@@ -36,8 +47,25 @@ class Printer(Borg):
             self.verbose = verbose
         if "quiet" not in self.__dict__.keys():
             self.quiet = quiet
+        # the daemon can't ask, questions are answered in advance
+        if "interactive" not in self.__dict__.keys():
+            self.interactive = True
+            self.confirmed = False
+            self.question = None
 
     def yes_no(self, question):
+        """Ask question in the terminal. If the printer isn't interactive the
+        question is answered with yes if it was confirmed in advance.
+
+        :raises: PromptError if the printer isn't interactive and nothing was
+                 confirmed. The question is kept in the question attribute.
+        """
+        if not self.interactive:
+            if self.confirmed:
+                return True
+            self.question = question
+            raise PromptError(question)
+
         reply = input(question + " (y/N): ").lower().strip()
         if not reply:
             return False
@@ -0,0 +1,310 @@
+# vim: set fileencoding=utf-8 :
+
+# connord - connect to nordvpn servers
+# Copyright (C) 2019  Mael Stor <maelstor@posteo.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Measure the latency to servers concurrently within one event loop"""
+
+import asyncio
+import os
+import socket
+import struct
+from math import ceil, inf
+from statistics import median
+
+# The openvpn tcp port of NordVPN servers
+TCP_PORT = 443
+METHODS = ("auto", "icmp", "tcp")
+
+_ICMP_ECHO_REQUEST = 8
+_ICMP_ECHO_REPLY = 0
+
+
+def _checksum(data):
+    """Return the internet checksum of data"""
+    if len(data) % 2:
+        data += b"\0"
+
+    total = sum(struct.unpack("!{}H".format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def _icmp_echo_request(ident, sequence):
+    """Return an icmp echo request packet"""
+    header = struct.pack("!BBHHH", _ICMP_ECHO_REQUEST, 0, 0, ident, sequence)
+    payload = b"connord"
+    checksum = _checksum(header + payload)
+    header = struct.pack("!BBHHH", _ICMP_ECHO_REQUEST, 0, checksum, ident, sequence)
+    return header + payload
+
+
+def open_icmp_socket():
+    """Return a non-blocking icmp socket or None if icmp sockets aren't permitted.
+    Tries an unprivileged datagram socket first (see net.ipv4.ping_group_range) and
+    then a raw socket.
+
+    :returns: tuple (socket, is_raw) or (None, False)
+    """
+    for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+        try:
+            sock = socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP)
+        except OSError:
+            continue
+
+        sock.setblocking(False)
+        return sock, sock_type == socket.SOCK_RAW
+
+    return None, False
+
+
+class IcmpProber:
+    """Sends icmp echo requests over a single socket and dispatches the replies to
+    the waiting probes."""
+
+    def __init__(self, loop, sock, is_raw):
+        """Init
+
+        :param loop: the event loop
+        :param sock: a non-blocking icmp socket
+        :param is_raw: True if sock is a raw socket. Raw sockets receive the ip
+                       header and the replies to other processes, too.
+        """
+        self.loop = loop
+        self.sock = sock
+        self.is_raw = is_raw
+        self.ident = os.getpid() & 0xFFFF
+        self.sequence = 0
+        self.waiters = {}
+        loop.add_reader(sock.fileno(), self._read_replies)
+
+    def close(self):
+        """Stop reading and close the socket"""
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+    def _read_replies(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+
+            if self.is_raw:
+                data = data[(data[0] & 0x0F) * 4 :]
+            if len(data) < 8:
+                continue
+
+            icmp_type, _, _, ident, sequence = struct.unpack("!BBHHH", data[:8])
+            if icmp_type != _ICMP_ECHO_REPLY:
+                continue
+            # the kernel rewrites the id of unprivileged datagram sockets
+            if self.is_raw and ident != self.ident:
+                continue
+
+            waiter = self.waiters.pop((address[0], sequence), None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(self.loop.time())
+
+    async def probe(self, ip_address, timeout):
+        """Return the round trip time to ip_address in ms or inf on timeout"""
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        key = (ip_address, self.sequence)
+        waiter = self.loop.create_future()
+        self.waiters[key] = waiter
+        packet = _icmp_echo_request(self.ident, self.sequence)
+
+        start = self.loop.time()
+        try:
+            self.sock.sendto(packet, (ip_address, 0))
+            end = await asyncio.wait_for(waiter, timeout)
+        except (OSError, asyncio.TimeoutError):
+            return inf
+        finally:
+            self.waiters.pop(key, None)
+
+        return (end - start) * 1000
+
+
+async def tcp_probe(loop, ip_address, port, timeout):
+    """Return the time to establish a tcp connection to ip_address:port in ms or inf
+    if the host didn't answer. A refused connection is still an answer."""
+    start = loop.time()
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(ip_address, port), timeout
+        )
+    except ConnectionRefusedError:
+        return (loop.time() - start) * 1000
+    except (OSError, asyncio.TimeoutError):
+        return inf
+
+    end = loop.time()
+    writer.close()
+    return (end - start) * 1000
+
+
+# pylint: disable=too-many-arguments
+async def _probe_all(
+    loop, ip_addresses, samples, interval, method, port, timeout, deadline, limit
+):
+    """Probe all ip_addresses samples times within deadline seconds
+
+    :returns: dictionary of ip address to list of round trip times in ms
+    """
+    prober = None
+    if method in ("auto", "icmp"):
+        sock, is_raw = open_icmp_socket()
+        if sock is not None:
+            prober = IcmpProber(loop, sock, is_raw)
+        elif method == "icmp":
+            raise PermissionError("Not permitted to open an icmp socket.")
+
+    semaphore = asyncio.Semaphore(limit)
+    results = {ip_address: [] for ip_address in ip_addresses}
+
+    async def probe_one(ip_address):
+        for sample in range(samples):
+            if sample:
+                await asyncio.sleep(interval)
+
+            async with semaphore:
+                if prober is not None:
+                    rtt = await prober.probe(ip_address, timeout)
+                else:
+                    rtt = await tcp_probe(loop, ip_address, port, timeout)
+
+            results[ip_address].append(rtt)
+
+    tasks = [loop.create_task(probe_one(ip_address)) for ip_address in results]
+    try:
+        if tasks:
+            await asyncio.wait(tasks, timeout=deadline)
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        if prober is not None:
+            prober.close()
+
+    # samples which couldn't be sent before the deadline count as lost
+    for rtts in results.values():
+        rtts.extend([inf] * (samples - len(rtts)))
+
+    return results
+
+
+# pylint: disable=too-many-arguments
+def probe_samples(
+    ip_addresses,
+    samples=3,
+    interval=0.2,
+    method="auto",
+    port=TCP_PORT,
+    timeout=1.0,
+    deadline=3.0,
+    limit=256,
+):
+    """Measure the latency to many hosts concurrently taking multiple samples per
+    host.
+
+    :param ip_addresses: list of ipv4 addresses as strings
+    :param samples: count of samples per host
+    :param interval: seconds between two samples of the same host
+    :param method: 'icmp' to ping the hosts, 'tcp' to measure the time to connect
+                   to port or 'auto' to use icmp if permitted else tcp.
+    :param port: the port used by the 'tcp' method
+    :param timeout: seconds to wait for a single answer
+    :param deadline: seconds to wait for all answers
+    :param limit: maximum count of probes in flight
+    :returns: dictionary of ip address to list of round trip times in ms. Samples
+              without an answer in time are inf.
+    :raises: ValueError if method is unknown
+             PermissionError if method is 'icmp' and icmp sockets aren't permitted
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown probe method: {!r}".format(method))
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            _probe_all(
+                loop,
+                ip_addresses,
+                samples,
+                interval,
+                method,
+                port,
+                timeout,
+                deadline,
+                limit,
+            )
+        )
+    finally:
+        loop.close()
+
+
+# pylint: disable=too-many-arguments
+def probe(
+    ip_addresses, method="auto", port=TCP_PORT, timeout=1.0, deadline=3.0, limit=256
+):
+    """Measure the latency to many hosts concurrently with a single sample per host.
+    See probe_samples for the parameters.
+
+    :returns: dictionary of ip address to round trip time in ms or inf if the host
+              didn't answer in time.
+    """
+    results = probe_samples(
+        ip_addresses,
+        samples=1,
+        method=method,
+        port=port,
+        timeout=timeout,
+        deadline=deadline,
+        limit=limit,
+    )
+    return {ip_address: rtts[0] for ip_address, rtts in results.items()}
+
+
+def get_stats(rtts):
+    """Summarize the samples of a host
+
+    :param rtts: list of round trip times in ms with inf for lost samples
+    :returns: dictionary with 'min', 'median', 'p95' and 'jitter' in ms and 'loss'
+              as fraction of lost samples. Without any answer all times are inf.
+    """
+    answered = sorted(rtt for rtt in rtts if rtt != inf)
+    loss = (len(rtts) - len(answered)) / len(rtts) if rtts else 1.0
+    if not answered:
+        return {"min": inf, "median": inf, "p95": inf, "jitter": inf, "loss": loss}
+
+    # jitter is the mean difference between consecutive answers in sent order
+    in_order = [rtt for rtt in rtts if rtt != inf]
+    differences = [abs(b - a) for a, b in zip(in_order, in_order[1:])]
+    jitter = sum(differences) / len(differences) if differences else 0.0
+
+    return {
+        "min": answered[0],
+        "median": median(answered),
+        "p95": answered[max(ceil(0.95 * len(answered)) - 1, 0)],
+        "jitter": jitter,
+        "loss": loss,
+    }
@@ -17,23 +17,52 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """Manage all resources of connord in a centralized module"""
 
+import copy
 import os
+import sys
 import getpass
+import hashlib
+import json
 import tempfile
+import threading
+import time
 from shutil import rmtree
 import yaml
-from pkg_resources import resource_filename
 from connord import ConnordError
+from connord import archives
 from connord import user
+from connord.printer import Printer
+
+try:
+    # the libyaml bindings parse and emit many times faster
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
 
 __NORDVPN_DIR = "/etc/openvpn/client/nordvpn"
 __SCRIPTS_DIR = "/etc/openvpn/client/scripts"
 __CONFIG_DIR = "/etc/connord"
 __CONFIG_FILE = __CONFIG_DIR + "/config.yml"
 __RUN_DIR = "/var/run/connord"
+__CACHE_DIR = "/var/cache/connord"
+
+
+def resource_filename(package, resource_name):
+    """Return the path of a resource shipped with package. The package isn't zip
+    safe, so resources are plain files next to the modules. Importing
+    pkg_resources to find them would slow down every start."""
+    package_dir = os.path.dirname(sys.modules[package].__file__)
+    return os.path.join(package_dir, *resource_name.split("/"))
+
 
 __DATABASE_FILE = resource_filename(__name__, "db/connord.sqlite3")
 
+CONFIGURATIONS_DEFAULTS = {"mode": "extract", "cache": 16}
+
+# parsed files by path
+_PARSED = {}
+_PARSED_LOCK = threading.Lock()
+
 
 class ResourceNotFoundError(ConnordError):
     """Raised when a resource is requested but doesn't exist"""
@@ -201,6 +230,12 @@ def get_credentials_file(file_name="credentials", create=True):
     creds_dir = get_credentials_dir()
     creds_file = "{}/{}".format(creds_dir, file_name)
     if not os.path.exists(creds_file):
+        if create and not Printer().interactive:
+            raise ResourceNotFoundError(
+                creds_file,
+                "No credentials found in {!r}. Stop the daemon and connect once "
+                "to enter them.".format(creds_file),
+            )
         if create:
             create_credentials_file(creds_file)
         else:
@@ -255,24 +290,170 @@ def get_ovpn_protocol_dir(protocol="udp"):
     raise ResourceNotFoundError(config_dir)
 
 
+def get_configurations_config():
+    """Return the 'configurations' section of the configuration merged with the
+    defaults"""
+    return get_config_section("configurations", CONFIGURATIONS_DEFAULTS)
+
+
 @user.needs_root
 def get_ovpn_config(domain, protocol="udp"):
     """Returns the configuration file of the corresponding domain with protocol either
-    'udp' or 'tcp'
+    'udp' or 'tcp'. In 'lazy' and 'template' mode the file is read from the
+    archives into the ovpn cache directory.
 
     :raises: ResourceNotFoundError if the file does not exist
     """
-    config_dir = get_ovpn_protocol_dir(protocol)
     if ".nordvpn.com" not in domain:
         domain = "{}.nordvpn.com".format(domain)
 
-    config_file = "{}/{}.{}.ovpn".format(config_dir, domain, protocol)
+    config_name = "{}.{}.ovpn".format(domain, protocol)
+    configurations_config = get_configurations_config()
+    if configurations_config["mode"] in ("lazy", "template"):
+        return get_packed_ovpn_config(
+            "ovpn_{}/{}".format(protocol, config_name), configurations_config["cache"]
+        )
+
+    config_dir = get_ovpn_protocol_dir(protocol)
+    config_file = "{}/{}".format(config_dir, config_name)
     if os.path.exists(config_file):
         return config_file
 
     raise ResourceNotFoundError(config_file)
 
 
+def get_ovpn_template_file(protocol="udp"):
+    """Return the path to the template of the configurations of protocol. Does
+    not check if the file exists.
+    """
+    return get_zip_path("template.{}.ovpn".format(protocol))
+
+
+def get_ovpn_template_mismatches_file(protocol="udp"):
+    """Return the path to the list of domains whose configurations differ from
+    the template of protocol. Does not check if the file exists.
+    """
+    return get_zip_path("template.{}.json".format(protocol))
+
+
+def read_ovpn_template_mismatches(protocol="udp"):
+    """Return the set of domains whose configurations differ from the template of
+    protocol
+
+    :raises: ResourceNotFoundError if the template wasn't verified
+    """
+    mismatches_file = get_ovpn_template_mismatches_file(protocol)
+    try:
+        with open(mismatches_file, "r") as mismatches_fd:
+            return set(json.load(mismatches_fd))
+    except FileNotFoundError:
+        raise ResourceNotFoundError(mismatches_file)
+
+
+def read_ovpn_template(protocol="udp"):
+    """Return the template of the configurations of protocol
+
+    :raises: ResourceNotFoundError if there is no template
+    """
+    template_file = get_ovpn_template_file(protocol)
+    try:
+        with open(template_file, "r") as template_fd:
+            return template_fd.read()
+    except FileNotFoundError:
+        raise ResourceNotFoundError(template_file)
+
+
+def get_ovpn_cache_dir(create=True):
+    """Return the directory where configuration files read from the archives are
+    cached.
+
+    :raises: ResourceNotFoundError if path doesn't exist and create is false.
+    """
+    ovpn_cache_dir = "{}/ovpn".format(get_cache_dir(create=create))
+    if not os.path.exists(ovpn_cache_dir):
+        if create:
+            os.makedirs(ovpn_cache_dir, mode=0o755)
+        else:
+            raise ResourceNotFoundError(ovpn_cache_dir)
+
+    return ovpn_cache_dir
+
+
+def clear_ovpn_cache():
+    """Remove all cached configuration files"""
+    try:
+        rmtree(get_ovpn_cache_dir(create=False))
+    except ResourceNotFoundError:
+        pass
+
+    archives.clear_cache()
+
+
+def get_packed_ovpn_config(member_name, cache_size=16):
+    """Return the path to a configuration file read directly from the archives in
+    the zip directory. The last cache_size files are kept in the ovpn cache
+    directory, the least recently used ones are removed.
+
+    :param member_name: the name of the file in the archive
+    :param cache_size: maximum count of cached files
+    :raises: ResourceNotFoundError if no archive contains member_name
+    """
+    cache_dir = get_ovpn_cache_dir(create=True)
+    cache_file = "{}/{}".format(cache_dir, os.path.basename(member_name))
+    if os.path.exists(cache_file):
+        mark_used(cache_file)
+        return cache_file
+
+    zip_dir = get_zip_dir(create=False)
+    zip_file = archives.find_member(list_dir(zip_dir, "zip"), member_name)
+    if zip_file is None:
+        raise ResourceNotFoundError("{}/{}".format(zip_dir, member_name))
+
+    write_atomic(cache_file, archives.read_member(zip_file, member_name), mode="wb")
+    remove_least_recently_used(cache_dir, cache_size)
+    return cache_file
+
+
+def mark_used(path):
+    """Set the access time of path to now. Other than the modification time the
+    access time tracks usage without invalidating what depends on the content."""
+    os.utime(path, (time.time(), os.path.getmtime(path)))
+
+
+def remove_least_recently_used(directory, keep, filetype="ovpn"):
+    """Remove all but the keep most recently used files of filetype in directory.
+    Keeps at least one file."""
+    files = sorted(list_dir(directory, filetype), key=os.path.getatime)
+    for file_ in files[: -max(keep, 1)]:
+        os.remove(file_)
+
+
+def get_forged_ovpn_dir(create=True):
+    """Return the directory of the ovpn configs forged for the openvpn command
+
+    :raises: ResourceNotFoundError if path doesn't exist and create is false.
+    """
+    forged_dir = "{}/forged".format(get_cache_dir(create=create))
+    if not os.path.exists(forged_dir):
+        if create:
+            os.makedirs(forged_dir, mode=0o750)
+        else:
+            raise ResourceNotFoundError(forged_dir)
+
+    return forged_dir
+
+
+def get_forged_ovpn_file(key):
+    """Return the path to the forged ovpn config identified by key. Does not check
+    if the file exists.
+
+    :param key: a json serializable list of everything the forged config depends
+                on
+    """
+    digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+    return "{}/{}.ovpn".format(get_forged_ovpn_dir(create=True), digest)
+
+
 def get_scripts_dir():
     """Return the directory where the scripts are stored."""
 
@@ -332,20 +513,81 @@ def get_config_file(config_name="config.yml"):
     raise ResourceNotFoundError(config_file)
 
 
+def load_yaml(stream):
+    """Parse yaml from a string or file with the fastest safe loader available"""
+    return yaml.load(stream, Loader=YamlLoader)
+
+
+def dump_yaml(data, stream=None):
+    """Serialize data to yaml with the fastest safe dumper available
+
+    :returns: the yaml as string if stream is None
+    """
+    return yaml.dump(data, stream, Dumper=YamlDumper, default_flow_style=False)
+
+
+def _get_file_state(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+
+def read_yaml_file(path):
+    """Return the parsed content of a yaml file. The result is kept in memory until
+    the file changes, so repeated reads cost a stat and a copy.
+
+    :raises: MalformedResourceError in case of parsing errors
+             OSError if the file can't be read
+    """
+    state = _get_file_state(path)
+    with _PARSED_LOCK:
+        cached = _PARSED.get(path)
+    if cached is None or cached[0] != state:
+        try:
+            with open(path, "r") as yaml_fd:
+                data = load_yaml(yaml_fd)
+        except yaml.MarkedYAMLError as error:
+            raise MalformedResourceError(path, error.problem, str(error.problem_mark))
+
+        cached = (state, data)
+        with _PARSED_LOCK:
+            _PARSED[path] = cached
+
+    return copy.deepcopy(cached[1])
+
+
+def clear_parsed_cache():
+    """Forget all parsed files"""
+    with _PARSED_LOCK:
+        _PARSED.clear()
+
+
 # TODO: rename to read_config
 def get_config():
     """Returns a dictionary parsed from a yaml configuration file
 
     :raises: MalformedResourceError in case of parsing errors
     """
-    config_file = get_config_file()
+    return read_yaml_file(get_config_file())
+
+
+def get_config_section(section, defaults=None):
+    """Returns the section of the configuration file merged into defaults. Missing
+    sections or keys resolve to the defaults.
+
+    :param section: the name of a top-level section in config.yml
+    :param defaults: dictionary of default values
+    :returns: a new dictionary
+    """
+    config_section = dict(defaults) if defaults else {}
     try:
-        with open(config_file, "r") as config_fd:
-            return yaml.safe_load(config_fd)
-    except yaml.parser.ParserError as error:
-        raise MalformedResourceError(
-            config_file, error.problem, str(error.problem_mark)
-        )
+        section_dict = get_config()[section]
+    except (ResourceNotFoundError, KeyError, TypeError):
+        return config_section
+
+    if section_dict:
+        config_section.update(section_dict)
+
+    return config_section
 
 
 def write_config(config_dict):
@@ -363,7 +605,7 @@ def write_config(config_dict):
         )
 
     with open(config_file, "w") as config_fd:
-        yaml.dump(config_dict, config_fd, default_flow_style=False)
+        dump_yaml(config_dict, config_fd)
 
 
 @user.needs_root
@@ -422,28 +664,50 @@ def get_stats_file(stats_name=None, create=True):
     return stats_file
 
 
+def get_stats_sidecar(stats_file):
+    """Return the path of the json sidecar of stats_file"""
+    stats_dir, stats_name = os.path.split(stats_file)
+    return os.path.join(stats_dir, ".{}.json".format(stats_name))
+
+
+def _read_stats_sidecar(stats_file):
+    """Return the content of the sidecar if it mirrors the current stats_file
+    else None"""
+    try:
+        with open(get_stats_sidecar(stats_file), "r") as sidecar_fd:
+            sidecar = json.load(sidecar_fd)
+        if sidecar["state"] == _get_file_state(stats_file):
+            return sidecar["stats"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    return None
+
+
 # TODO: Rename to read_stats
 @user.needs_root
 def get_stats(stats_name="stats"):
-    """Return a dictionary parsed from a yaml stats file.
+    """Return a dictionary parsed from a yaml stats file. Stats written by
+    write_stats are read from their json sidecar as long as the yaml file is
+    unchanged.
 
     :raises: MalformedResourceError if errors occurred during parsing.
     """
     stats_file = get_stats_file(stats_name=stats_name)
-    try:
-        with open(stats_file, "r") as stats_fd:
-            stats_dict = yaml.safe_load(stats_fd)
-            if not stats_dict:
-                stats_dict = {}
+    stats_dict = _read_stats_sidecar(stats_file)
+    if stats_dict is None:
+        stats_dict = read_yaml_file(stats_file)
 
-            return stats_dict
-    except yaml.parser.ParserError as error:
-        raise MalformedResourceError(stats_file, error.problem, str(error.problem_mark))
+    if not stats_dict:
+        stats_dict = {}
+
+    return stats_dict
 
 
 @user.needs_root
 def write_stats(stats_dict, stats_name="stats"):
-    """Write a dictionary to a stats_file name stats_name.
+    """Write a dictionary to a stats_file name stats_name. A json sidecar next to
+    it spares readers parsing the yaml.
 
     :raises: TypeError if stats_dict is not of type dict
     """
@@ -456,27 +720,77 @@ def write_stats(stats_dict, stats_name="stats"):
             )
         )
 
-    with open(stats_file, "w") as stats_fd:
-        yaml.dump(stats_dict, stats_fd, default_flow_style=False)
+    write_atomic(stats_file, dump_yaml(stats_dict))
+    sidecar = {"state": _get_file_state(stats_file), "stats": stats_dict}
+    try:
+        sidecar_s = json.dumps(sidecar, separators=(",", ":"))
+    except (TypeError, ValueError):
+        return
+
+    # only if json doesn't change the types, else the yaml file is read instead
+    if json.loads(sidecar_s)["stats"] == stats_dict:
+        write_atomic(get_stats_sidecar(stats_file), sidecar_s)
 
 
-def read_pid(pid_name="openvpn.pid"):
-    """Return the content of a pid file as integer. Pid files reside in stats_dir.
+def get_cache_dir(create=True):
+    """Return path to the cache directory. Other than the stats directory the cache
+    directory survives disconnects and reboots.
+
+    :raises: ResourceNotFoundError if path doesn't exist and create is false.
     """
-    pid_file = get_stats_file(stats_name=pid_name)
-    with open(pid_file, "r") as pid_fd:
-        return int(pid_fd.readline())
+    cache_dir = __CACHE_DIR
+    if not os.path.exists(cache_dir):
+        if create:
+            os.makedirs(cache_dir, mode=0o755)
+        else:
+            raise ResourceNotFoundError(cache_dir)
+
+    return cache_dir
+
 
+def get_cache_file(cache_name, create_dirs=True):
+    """Return the path to the cache_name file. Does not check if the file exists.
 
-def get_ovpn_tmp_path():
-    """Return the path to the temporary file to be used for temporarily
-    created ovpn files.
+    :param cache_name: name of the file in the cache directory
+    :param create_dirs: if True create the cache directory
+    :raises: ResourceNotFoundError if the cache directory doesn't exist and
+             create_dirs is false.
     """
-    temp_dir = tempfile.gettempdir()
-    return "{}/{}".format(temp_dir, "ovpn.conf")
+    cache_dir = get_cache_dir(create=create_dirs)
+    return "{}/{}".format(cache_dir, cache_name)
 
 
-def remove_ovpn_tmp_file():
-    """Delete the temporary file used for ovpn."""
-    temp_dir = tempfile.gettempdir()
-    os.remove("{}/{}".format(temp_dir, "ovpn.conf"))
+def write_atomic(path, data, mode="w", permissions=0o644):
+    """Write data to a temporary file in the directory of path and rename it to
+    path. Readers see either the old or the new file but never a partial one.
+
+    :param path: the destination path
+    :param data: string or bytes depending on mode or an iterable of them which
+                 is written piece by piece
+    :param mode: 'w' or 'wb'
+    :param permissions: the permissions of the written file
+    """
+    directory, file_name = os.path.split(path)
+    tmp_fd, tmp_path = tempfile.mkstemp(
+        prefix=".{}.".format(file_name), suffix=".tmp", dir=directory or "."
+    )
+    try:
+        with os.fdopen(tmp_fd, mode) as tmp_file:
+            if isinstance(data, (str, bytes)):
+                tmp_file.write(data)
+            else:
+                tmp_file.writelines(data)
+        os.chmod(tmp_path, permissions)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_pid(pid_name="openvpn.pid"):
+    """Return the content of a pid file as integer. Pid files reside in stats_dir.
+    """
+    pid_file = get_stats_file(stats_name=pid_name)
+    with open(pid_file, "r") as pid_fd:
+        return int(pid_fd.readline())
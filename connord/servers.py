@@ -16,15 +16,30 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
+import json
+import time
 import requests
-from cachetools import cached, TTLCache
 from connord import ConnordError
-from connord.categories import map_categories_reverse
+from connord import categories
 from connord import countries
+from connord import features
+from connord import resources
 from connord.formatter import Formatter
+from connord.printer import Printer
+from connord.table import ServerTable
 
 __API_URL = "https://api.nordvpn.com/server"
+__CATALOGUE_FILE = "servers.json"
+__CATALOGUE_META_FILE = "servers.meta.json"
+__SERVERS_CACHE = {}
+__PAYLOAD_CACHE = {}
+# api responses which couldn't be written to the cache directory
+__CATALOGUE_CACHE = {}
+__TABLE_CACHE = {}
+__INDEX_CACHE = {}
 NETFLIX = ["us", "ca", "jp", "de", "gb", "fr", "it"]
+CATALOGUE_DEFAULTS = {"max_age": 300, "use_stale": True}
 
 
 class DomainNotFoundError(ConnordError):
@@ -49,57 +64,126 @@ class MalformedDomainError(ConnordError):
         self.problem = problem
 
 
+def _get_fqdn(domain):
+    """Return the fully qualified domain name of domain like de123.nordvpn.com"""
+    if ".nordvpn.com" in domain:
+        return domain
+
+    return domain + ".nordvpn.com"
+
+
+def build_domain_index(servers_):
+    """Return a dictionary mapping the fqdn and the short id like 'de123' of every
+    server to the server"""
+    index = {}
+    for server in servers_:
+        fqdn = server["domain"]
+        index[fqdn] = server
+        index[fqdn.split(".", 1)[0]] = server
+
+    return index
+
+
+def get_domain_index():
+    """Return the domain index of the servers. The index is built once per server
+    list returned by get_servers."""
+    return _get_derived(__INDEX_CACHE, build_domain_index)
+
+
 def get_server_by_domain(domain):
     """Return server specified with domain as string. Queries the nordvpn api.
 
     :raises: ValueError if the domain can't be found
     """
-    servers = get_servers()
-    if ".nordvpn.com" in domain:
-        fqdn = domain
-    else:
-        fqdn = domain + ".nordvpn.com"
-
-    for server in servers:
-        if server["domain"] == fqdn:
-            return server
-
-    raise ValueError("Domain not found: {!r}.".format(domain))
+    try:
+        return get_domain_index()[_get_fqdn(domain)]
+    except KeyError:
+        raise ValueError("Domain not found: {!r}.".format(domain))
 
 
 def get_servers_by_domains(domains):
     """Abstraction of get_server_by_domain for a list of domains.
 
-    :returns: list of filtered servers
+    :returns: list of filtered servers in the order of domains
     :raises: DomainNotFoundError if the domain doesn't exist.
     """
-    fqdns = []
+    index = get_domain_index()
+    filtered_servers = []
     for domain in domains:
-        if ".nordvpn.com" in domain:
-            fqdn = domain
-        else:
-            fqdn = domain + ".nordvpn.com"
+        try:
+            filtered_servers.append(index[_get_fqdn(domain)])
+        except KeyError:
+            raise DomainNotFoundError(domain)
 
-        fqdns.append(fqdn)
+    return filtered_servers
 
-    servers = get_servers()
-    filtered_servers = []
-    for server in servers:
-        for fqdn in fqdns:
-            if server["domain"] == fqdn:
-                filtered_servers.append(server)
-                fqdns.remove(fqdn)
-                break
 
-    if not fqdns:
-        raise DomainNotFoundError(fqdns[0])
+def get_catalogue_config():
+    """Return the 'servers' section of the configuration merged with the defaults"""
+    return resources.get_config_section("servers", CATALOGUE_DEFAULTS)
 
-    return filtered_servers
 
+def _read_payload(path):
+    """Return the content of path. The content is kept in memory until the file
+    changes, so the same bytes object is returned for an unchanged file."""
+    stat = os.stat(path)
+    state = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    cached_payload = __PAYLOAD_CACHE.get(path)
+    if cached_payload is None or cached_payload[0] != state:
+        with open(path, "rb") as payload_fd:
+            cached_payload = (state, payload_fd.read())
+        __PAYLOAD_CACHE.clear()
+        __PAYLOAD_CACHE[path] = cached_payload
 
-@cached(cache=TTLCache(maxsize=1, ttl=60))
-def get_servers():
-    """Returns the queried servers from nordvpn's api as list of dictionaries."""
+    return cached_payload[1]
+
+
+def read_catalogue():
+    """Read the cached api response and its metadata from the cache directory.
+
+    :returns: tuple (payload, meta) with payload as bytes or (None, {}) if there is
+              no usable cache.
+    """
+    try:
+        payload_file = resources.get_cache_file(__CATALOGUE_FILE, create_dirs=False)
+        meta_file = resources.get_cache_file(__CATALOGUE_META_FILE, create_dirs=False)
+        payload = _read_payload(payload_file)
+        with open(meta_file, "r") as meta_fd:
+            meta = json.load(meta_fd)
+    except (resources.ResourceNotFoundError, OSError, ValueError):
+        return None, {}
+
+    return payload, meta
+
+
+def write_catalogue(payload, meta):
+    """Write the api response and its metadata to the cache directory. The payload
+    is skipped if None. Does nothing if the cache directory is not writable.
+
+    :returns: True if the cache was written
+    """
+    try:
+        if payload is not None:
+            payload_file = resources.get_cache_file(__CATALOGUE_FILE)
+            resources.write_atomic(payload_file, payload, mode="wb")
+
+        meta_file = resources.get_cache_file(__CATALOGUE_META_FILE)
+        resources.write_atomic(meta_file, json.dumps(meta))
+    except OSError:
+        return False
+
+    return True
+
+
+def fetch_catalogue(meta=None):
+    """Query nordvpn's api. If meta is given the request is conditional and the api
+    may answer with 'Not Modified'.
+
+    :param meta: dictionary with 'etag' and 'last_modified' of a cached response
+    :returns: tuple (payload, meta). payload is None if the api answered with
+              'Not Modified'.
+    :raises: RequestException if the request failed
+    """
     header = {
         "User-Agent": " ".join(
             (
@@ -109,8 +193,141 @@ def get_servers():
         )
     }
 
+    if meta:
+        if meta.get("etag"):
+            header["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            header["If-Modified-Since"] = meta["last_modified"]
+
     with requests.get(__API_URL, headers=header, timeout=1) as response:
-        return response.json()
+        response.raise_for_status()
+        new_meta = {
+            "etag": response.headers.get("ETag", meta.get("etag") if meta else None),
+            "last_modified": response.headers.get(
+                "Last-Modified", meta.get("last_modified") if meta else None
+            ),
+            "fetched": time.time(),
+        }
+        if response.status_code == 304:
+            return None, new_meta
+
+        return response.content, new_meta
+
+
+def get_catalogue():
+    """Return the raw server list either from the cache directory if it's younger
+    than 'max_age' seconds or else revalidated with nordvpn's api. If the api can't
+    be reached and 'use_stale' is set fall back to the cached server list. If the
+    cache directory isn't writable the response is kept in memory instead.
+
+    :returns: the server list as json encoded bytes
+    :raises: RequestException if the api can't be reached and there's no usable
+             cache.
+    """
+    config = get_catalogue_config()
+    if "catalogue" in __CATALOGUE_CACHE:
+        payload, meta = __CATALOGUE_CACHE["catalogue"]
+    else:
+        payload, meta = read_catalogue()
+    if payload is not None:
+        age = time.time() - meta.get("fetched", 0)
+        if 0 <= age < config["max_age"]:
+            return payload
+
+    try:
+        new_payload, new_meta = fetch_catalogue(meta if payload is not None else None)
+    except requests.exceptions.RequestException as error:
+        if payload is not None and config["use_stale"]:
+            printer = Printer()
+            printer.info("Using cached server list: {!s}".format(error))
+            return payload
+
+        raise
+
+    written = write_catalogue(new_payload, new_meta)
+    if new_payload is None:
+        new_payload = payload
+
+    if written:
+        __CATALOGUE_CACHE.clear()
+    else:
+        __CATALOGUE_CACHE["catalogue"] = (new_payload, new_meta)
+
+    return new_payload
+
+
+def encode_masks(servers_):
+    """Add the 'features_mask' and 'categories_mask' to every server in servers_
+
+    :returns: servers_
+    """
+    for server in servers_:
+        server["features_mask"] = features.encode_features(server["features"])
+        server["categories_mask"] = categories.encode_categories(server["categories"])
+
+    return servers_
+
+
+def get_servers():
+    """Returns the queried servers from nordvpn's api as list of dictionaries. Each
+    server carries the precomputed 'features_mask' and 'categories_mask'. The list
+    is kept in memory until the server list in the cache directory or the answer
+    of the api changes."""
+    payload = get_catalogue()
+    try:
+        cached_payload, servers_ = __SERVERS_CACHE["servers"]
+        # an unchanged cache file is read as the same object
+        if cached_payload is payload or cached_payload == payload:
+            return servers_
+    except KeyError:
+        pass
+
+    servers_ = encode_masks(json.loads(payload.decode()))
+    __SERVERS_CACHE["servers"] = (payload, servers_)
+    return servers_
+
+
+def to_table(servers_):
+    """Return the list of servers as ServerTable"""
+    return ServerTable.from_servers(
+        servers_, features.get_server_mask, categories.get_server_mask
+    )
+
+
+def _get_derived(cache, build):
+    """Return build(servers) for the servers returned by get_servers. The result is
+    kept in cache until get_servers returns a new server list.
+
+    :param cache: a dictionary
+    :param build: a function taking the list of servers
+    """
+    servers_ = get_servers()
+    try:
+        cached_servers, derived = cache["derived"]
+        if cached_servers is servers_:
+            return derived
+    except KeyError:
+        pass
+
+    derived = build(servers_)
+    cache["derived"] = (servers_, derived)
+    return derived
+
+
+def get_server_table():
+    """Return the servers as ServerTable. The table is built once per server list
+    returned by get_servers."""
+    return _get_derived(__TABLE_CACHE, to_table)
+
+
+def clear_cache():
+    """Forget the servers and the indices held in memory. The next call to
+    get_servers reads the server list again from the cache directory or the api."""
+    __SERVERS_CACHE.clear()
+    __PAYLOAD_CACHE.clear()
+    __CATALOGUE_CACHE.clear()
+    __TABLE_CACHE.clear()
+    __INDEX_CACHE.clear()
 
 
 def filter_netflix_servers(servers, countries_):
@@ -141,18 +358,18 @@ class ServersPrettyFormatter(Formatter):
         ip = server["ip_address"]
         load = server["load"]
 
-        categories = [category["name"] for category in server["categories"]]
-        categories = ",".join(map_categories_reverse(categories))
+        categories_ = categories.decode_categories(categories.get_server_mask(server))
+        categories_ = ",".join(categories_)
 
-        features = [
+        features_ = [
             feature for feature in server["features"] if server["features"][feature]
         ]
-        features = ",".join(features)
+        features_ = ",".join(features_)
 
         string = "{:4d}: {:25}  {:6}  {:15}  load: {:>3d}  {}\n".format(
-            count, country, ident, ip, load, categories
+            count, country, ident, ip, load, categories_
         )
-        string += "      {}\n".format(features)
+        string += "      {}\n".format(features_)
         string += self.format_ruler(sep)
 
         return string
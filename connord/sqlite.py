@@ -18,7 +18,6 @@
 
 import sqlite3
 from sqlite3 import Error
-from cachetools import cached, TTLCache
 from connord import ConnordError
 from connord import resources
 
@@ -92,6 +91,39 @@ def create_location(connection, location):
         raise SqliteError(error, "Could not create location '{}'".format(location))
 
 
+def create_locations(connection, locations):
+    """Create many locations in the location table in a single transaction.
+
+    :param connection: a database connection
+    :param locations: list of tuples like in create_location
+    """
+    sql = """ INSERT OR IGNORE INTO locations(
+                latitude,
+                longitude,
+                display_name,
+                city,
+                country,
+                country_code,
+                map
+              )
+              VALUES(?,?,?,?,?,?,?) """
+
+    try:
+        with connection:
+            connection.executemany(sql, locations)
+    except Error as error:
+        raise SqliteError(error, "Could not create locations")
+
+
+def get_location_keys(connection):
+    """Return the set of (latitude, longitude) tuples of all locations"""
+    try:
+        rows = connection.execute("SELECT latitude, longitude FROM locations")
+        return {(row[0], row[1]) for row in rows}
+    except Error as error:
+        raise SqliteError(error, "Could not query locations")
+
+
 def location_exists(connection, latitude, longitude):
     """Return true if a location (latitude, longitude) exists. Prints errors to
     stdout."""
@@ -113,6 +145,21 @@ def get_city(connection, latitude, longitude):
     )
 
 
+def get_locations_version(connection):
+    """Return a value which changes when locations are added or removed. Locations
+    are never modified in place.
+
+    :returns: tuple with the count and the highest rowid of the locations or None
+              if the locations can't be queried
+    """
+    try:
+        return tuple(
+            connection.execute("SELECT count(*), max(rowid) FROM locations").fetchone()
+        )
+    except Error:
+        return None
+
+
 # deprecated: use get_columns directly
 def get_locations(connection):
     """Returns all locations found in the database as list. Prints errors to
@@ -121,7 +168,6 @@ def get_locations(connection):
 
 
 # pylint: disable=too-many-arguments
-@cached(cache=TTLCache(ttl=60, maxsize=20))
 def get_columns(
     connection,
     columns="*",
@@ -132,7 +178,8 @@ def get_columns(
 ):
     """
     Query columns from a given table by unique locations defined by latitude and
-    longitude if not None else selects all rows
+    longitude if not None else selects all rows. Latitude and longitude are bound
+    as parameters so the prepared statement is reused by the connection.
 
     param connection: A valid connection to the database
     param columns: A comma separated list of columns. Takes the special value '*'
@@ -140,30 +187,31 @@ def get_columns(
     param latitude: the latitude of the location
     param longitude: the longitude of the location
     param fetch: the query type 'all' or 'one'. 'many' is currently resolved to 'all'
-    returns: the result of the query. May be None if location does not exist
+    returns: the result of the query. May be None if location does not exist. Rows
+             of 'all' queries are sqlite3.Row objects.
     """
 
     if latitude is None and longitude is None:
         sql = """SELECT {} FROM {}""".format(columns, table)
+        parameters = ()
     else:
-        sql = """SELECT {} FROM {}
-                WHERE latitude = {} AND longitude = {}""".format(
-            columns, table, latitude, longitude
+        sql = """SELECT {} FROM {} WHERE latitude = ? AND longitude = ?""".format(
+            columns, table
         )
+        # the columns are text
+        parameters = (str(latitude), str(longitude))
 
     try:
+        cursor = connection.cursor()
         if fetch == "one":
-            cursor = connection.cursor()
-            result = cursor.execute(sql).fetchone()
+            result = cursor.execute(sql, parameters).fetchone()
             if result:
                 return result[0]
 
             return result
 
-        connection.row_factory = sqlite3.Row
-        cursor = connection.cursor()
-        result = cursor.execute(sql).fetchall()
-        return result
+        cursor.row_factory = sqlite3.Row
+        return cursor.execute(sql, parameters).fetchall()
 
     except Error as error:
         raise SqliteError(
@@ -206,7 +254,99 @@ def create_location_table(connection):
                                         city text NOT NULL,
                                         country NOT NULL,
                                         country_code NOT NULL,
+                                        map text,
                                         UNIQUE(latitude, longitude)
                                     ); """
 
     create_table(connection, sql_create_location_table)
+
+
+def create_latency_tables(connection):
+    """Creates the tables for the latency history and the moving averages of the
+    latencies if they don't exist.
+    """
+    sql_create_latency_table = """ CREATE TABLE IF NOT EXISTS latencies(
+                                        domain text NOT NULL,
+                                        timestamp real NOT NULL,
+                                        median real NOT NULL,
+                                        p95 real NOT NULL,
+                                        jitter real NOT NULL,
+                                        loss real NOT NULL
+                                    ); """
+    sql_create_latency_index = """ CREATE INDEX IF NOT EXISTS latencies_timestamp
+                                   ON latencies(timestamp); """
+    sql_create_average_table = """ CREATE TABLE IF NOT EXISTS latency_averages(
+                                        domain text PRIMARY KEY,
+                                        updated real NOT NULL,
+                                        median real NOT NULL,
+                                        p95 real NOT NULL,
+                                        jitter real NOT NULL,
+                                        loss real NOT NULL
+                                    ); """
+
+    create_table(connection, sql_create_latency_table)
+    create_table(connection, sql_create_latency_index)
+    create_table(connection, sql_create_average_table)
+
+
+def create_latencies(connection, latencies):
+    """Insert many latency measurements in a single transaction
+
+    :param connection: a database connection
+    :param latencies: list of tuples with (domain, timestamp, median, p95, jitter,
+                      loss)
+    """
+    sql = """ INSERT INTO latencies(domain, timestamp, median, p95, jitter, loss)
+              VALUES(?,?,?,?,?,?) """
+
+    try:
+        with connection:
+            connection.executemany(sql, latencies)
+    except Error as error:
+        raise SqliteError(error, "Could not create latencies")
+
+
+def delete_latencies(connection, before):
+    """Delete latency measurements older than the timestamp before"""
+    try:
+        with connection:
+            connection.execute("DELETE FROM latencies WHERE timestamp < ?", (before,))
+    except Error as error:
+        raise SqliteError(error, "Could not delete latencies")
+
+
+def replace_latency_averages(connection, averages):
+    """Insert or replace many moving averages in a single transaction
+
+    :param connection: a database connection
+    :param averages: list of tuples with (domain, updated, median, p95, jitter,
+                     loss)
+    """
+    sql = """ INSERT OR REPLACE INTO latency_averages(
+                domain, updated, median, p95, jitter, loss
+              )
+              VALUES(?,?,?,?,?,?) """
+
+    try:
+        with connection:
+            connection.executemany(sql, averages)
+    except Error as error:
+        raise SqliteError(error, "Could not replace latency averages")
+
+
+def get_latency_averages(connection, since=0):
+    """Return the moving averages updated after the timestamp since
+
+    :returns: dictionary of domain to dictionary with the keys 'updated', 'median',
+              'p95', 'jitter' and 'loss'
+    """
+    sql = """ SELECT domain, updated, median, p95, jitter, loss
+              FROM latency_averages WHERE updated >= ? """
+
+    try:
+        rows = connection.execute(sql, (since,)).fetchall()
+    except Error as error:
+        raise SqliteError(error, "Could not query latency averages")
+
+    keys = ("updated", "median", "p95", "jitter", "loss")
+    return {row[0]: {key: row[i] for i, key in enumerate(keys, 1)} for row in rows}
@@ -0,0 +1,186 @@
+# vim: set fileencoding=utf-8 :
+
+# connord - connect to nordvpn servers
+# Copyright (C) 2019  Mael Stor <maelstor@posteo.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Columnar in-memory representation of the server list"""
+
+import socket
+import struct
+from array import array
+
+
+def _pack_ip_address(ip_address):
+    """Return an ipv4 address as integer or 0 if the address is invalid"""
+    try:
+        return struct.unpack("!L", socket.inet_aton(ip_address))[0]
+    except (OSError, TypeError):
+        return 0
+
+
+class ServerTable:
+    """Holds the values of the server list needed by filters in array backed
+    columns. A table is a view on a selection of rows. Filters don't copy or touch
+    the servers but return a new view sharing the columns with this view. Iterating
+    over the table yields the original server dictionaries of the selected rows.
+    """
+
+    __slots__ = ("records", "_columns", "_values", "_rows")
+
+    def __init__(self, records, columns, values, rows):
+        """Init. Use from_servers to build a table from a server list.
+
+        :param records: the list of server dictionaries
+        :param columns: dictionary of column name to array
+        :param values: dictionary of column name to list of values for columns
+                       which store indices into this list
+        :param rows: array of selected row indices
+        """
+        self.records = records
+        self._columns = columns
+        self._values = values
+        self._rows = rows
+
+    @classmethod
+    def from_servers(cls, servers, features_mask, categories_mask):
+        """Build a table from a server list as parsed from the nordvpn api.
+
+        :param servers: list of servers as dictionaries
+        :param features_mask: function returning the feature mask of a server
+        :param categories_mask: function returning the category mask of a server
+        :returns: a ServerTable with all rows selected
+        """
+        columns = {
+            "load": array("B"),
+            "flag": array("B"),
+            "features": array("Q"),
+            "categories": array("Q"),
+            "ip_address": array("I"),
+            "latitude": array("d"),
+            "longitude": array("d"),
+            "angulars": array("I"),
+        }
+        flags = []
+        flag_indices = {}
+        # the location database is keyed by the coordinates as written in the
+        # json, e.g. '50' and not '50.0'
+        angulars = []
+        angular_indices = {}
+
+        for server in servers:
+            flag = server["flag"].lower()
+            if flag not in flag_indices:
+                flag_indices[flag] = len(flags)
+                flags.append(flag)
+
+            columns["load"].append(server["load"])
+            columns["flag"].append(flag_indices[flag])
+            columns["features"].append(features_mask(server))
+            columns["categories"].append(categories_mask(server))
+            columns["ip_address"].append(_pack_ip_address(server["ip_address"]))
+            columns["latitude"].append(server["location"]["lat"])
+            columns["longitude"].append(server["location"]["long"])
+
+            angular = (str(server["location"]["lat"]), str(server["location"]["long"]))
+            if angular not in angular_indices:
+                angular_indices[angular] = len(angulars)
+                angulars.append(angular)
+            columns["angulars"].append(angular_indices[angular])
+
+        rows = array("I", range(len(servers)))
+        return cls(servers, columns, {"flag": flags, "angulars": angulars}, rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __iter__(self):
+        records = self.records
+        for row in self._rows:
+            yield records[row]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.select(self._rows[index])
+
+        return self.records[self._rows[index]]
+
+    def select(self, rows):
+        """Return a view on rows sharing the columns with this table"""
+        return ServerTable(self.records, self._columns, self._values, rows)
+
+    def copy(self):
+        """Return a view on the same rows. Views are never modified in place so
+        this is cheap."""
+        return self.select(self._rows)
+
+    def to_list(self):
+        """Return the selected servers as list of dictionaries"""
+        return list(self)
+
+    def column(self, name):
+        """Return the values of the column name for the selected rows as list"""
+        column = self._columns[name]
+        values = self._values.get(name)
+        if values is None:
+            return [column[row] for row in self._rows]
+
+        return [values[column[row]] for row in self._rows]
+
+    def filter(self, name, predicate):
+        """Select rows where predicate(value) of the column name is true
+
+        :returns: a new view
+        """
+        column = self._columns[name]
+        rows = array("I", [row for row in self._rows if predicate(column[row])])
+        return self.select(rows)
+
+    def filter_columns(self, names, predicate):
+        """Select rows where predicate(value1, value2, ...) of the columns names is
+        true
+
+        :returns: a new view
+        """
+        columns = [self._columns[name] for name in names]
+        rows = array(
+            "I",
+            [
+                row
+                for row in self._rows
+                if predicate(*[column[row] for column in columns])
+            ],
+        )
+        return self.select(rows)
+
+    def filter_values(self, name, values):
+        """Select rows where the value of column name is one of values
+
+        :returns: a new view
+        """
+        column = self._columns[name]
+        indices = {
+            index for index, value in enumerate(self._values[name]) if value in values
+        }
+        rows = array("I", [row for row in self._rows if column[row] in indices])
+        return self.select(rows)
+
+    def filter_mask(self, name, mask):
+        """Select rows where all bits of mask are set in the column name
+
+        :returns: a new view
+        """
+        column = self._columns[name]
+        rows = array("I", [row for row in self._rows if column[row] & mask == mask])
+        return self.select(rows)
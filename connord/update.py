@@ -21,7 +21,11 @@
 # TODO: improve exception handling
 
 import os
-from shutil import move, rmtree
+import json
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from zipfile import ZipFile
 from datetime import datetime, timedelta
 import requests
@@ -29,88 +33,354 @@ from connord import ConnordError
 from connord.printer import Printer
 from connord import resources
 from connord import areas
+from connord import ovpn
 
 __URL = "https://downloads.nordcdn.com/configs/archives/servers"
 __ARCHIVES = {"standard": "ovpn.zip", "obfuscated": "ovpn_xor.zip"}
+__MANIFEST_FILE = "manifest.json"
 TIMEOUT = timedelta(hours=1)
+# seconds to connect and seconds between two chunks
+DOWNLOAD_TIMEOUT = (5, 30)
+CHUNK_SIZE = 1024 * 1024
 
 
 class UpdateError(ConnordError):
     """Raised during update"""
 
 
-def update_orig(archive):
-    """
-    Move the original file to make room for the newly downloaded file
-    """
+def read_manifest():
+    """Read the manifest of the last update from the zip directory.
 
+    :returns: dictionary with 'archives' mapping archive names to the 'etag' and
+              'last_modified' headers of their last download and 'members'
+              mapping extracted file names to their crc. Both are empty if there
+              is no manifest.
+    """
+    manifest = {"archives": {}, "members": {}}
     try:
-        zip_file = resources.get_zip_file(zip_name=archive, create_dirs=True)
-    except resources.ResourceNotFoundError:
-        return False
+        with open(resources.get_zip_path(__MANIFEST_FILE), "r") as manifest_fd:
+            manifest.update(json.load(manifest_fd))
+    except (OSError, ValueError):
+        pass
+
+    return manifest
 
-    move(zip_file, zip_file + ".orig")
-    return True
 
+def write_manifest(manifest):
+    """Write the manifest atomically to the zip directory"""
+    resources.write_atomic(
+        resources.get_zip_path(__MANIFEST_FILE), json.dumps(manifest)
+    )
 
-def get():
-    """Get the zip file
+
+def _read_part_meta(part_meta_path):
+    try:
+        with open(part_meta_path, "r") as part_meta_fd:
+            return json.load(part_meta_fd)
+    except (OSError, ValueError):
+        return {}
+
+
+def _get_meta(response):
+    return {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+def download(category, archive, meta=None, progress=None):
+    """Download an archive. If meta is given the request is conditional and the
+    archive is only downloaded if it changed. An interrupted download is resumed
+    with a range request if the archive didn't change in the meantime. The archive
+    is replaced atomically when the download is complete.
+
+    :param category: the category of the archive for display
+    :param archive: the file name of the archive
+    :param meta: dictionary with 'etag' and 'last_modified' of the last download
+    :param progress: called without arguments after each chunk
+    :returns: tuple (changed, meta)
+    :raises: RequestException if the download failed
     """
+    zip_path = resources.get_zip_path(archive)
+    part_path = zip_path + ".part"
+    part_meta_path = part_path + ".json"
+
+    headers = {}
+    offset = 0
+    part_meta = _read_part_meta(part_meta_path)
+    validator = part_meta.get("etag") or part_meta.get("last_modified")
+    if validator and os.path.exists(part_path):
+        offset = os.path.getsize(part_path)
+        headers["Range"] = "bytes={}-".format(offset)
+        headers["If-Range"] = validator
+    elif meta and os.path.exists(zip_path):
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    url = "{}/{}".format(__URL, archive)
+    with requests.get(
+        url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+    ) as response:
+        if response.status_code == 304:
+            # reset the timeout of update_needed
+            os.utime(zip_path)
+            return False, meta
+
+        if response.status_code == 416:
+            # the partial download is useless. Start over.
+            os.remove(part_path)
+            os.remove(part_meta_path)
+            return download(category, archive, meta, progress)
+
+        response.raise_for_status()
+        if response.status_code == 206:
+            new_meta = part_meta
+            mode = "ab"
+        else:
+            new_meta = _get_meta(response)
+            mode = "wb"
+            resources.write_atomic(part_meta_path, json.dumps(new_meta))
 
-    for category, archive in __ARCHIVES.items():
-        printer = Printer()
-        zip_path = resources.get_zip_path(archive)
-        update_orig(archive)
-        spinner = printer.spinner("Downloading {} configurations".format(category))
-        url = "{}/{}".format(__URL, archive)
-        with requests.get(url, stream=True, timeout=1) as response, open(
-            zip_path, "wb"
-        ) as zip_fd:
-            chunk_size = 512
-            for chunk in response.iter_content(chunk_size=chunk_size):
-                spinner.next()
+        with open(part_path, mode) as zip_fd:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
                 zip_fd.write(chunk)
+                if progress is not None:
+                    progress()
 
-        spinner.finish()
+    os.replace(part_path, zip_path)
+    os.remove(part_meta_path)
+    return True, new_meta
 
-    return True
 
+def get(manifest, force=False):
+    """Download the archives which changed since the last update concurrently
 
-def file_equals(file_, other_):
-    """Compares the orig.zip file to the downloaded file
-    : returns: False if file sizes differ
+    :param manifest: the manifest as returned by read_manifest. The download
+                     headers of the archives are updated in place.
+    :param force: if True download all archives unconditionally
+    :returns: list of the changed archives
+    :raises: RequestException if a download failed
     """
-    if os.path.exists(file_) and os.path.exists(other_):
-        return os.path.getsize(file_) == os.path.getsize(other_)
+    printer = Printer()
+    spinner = printer.spinner("Downloading configurations")
+    lock = threading.Lock()
+
+    def progress():
+        with lock:
+            spinner.next()
+
+    with ThreadPoolExecutor(max_workers=len(__ARCHIVES)) as executor:
+        futures = {
+            archive: executor.submit(
+                download,
+                category,
+                archive,
+                None if force else manifest["archives"].get(archive),
+                progress,
+            )
+            for category, archive in __ARCHIVES.items()
+        }
 
-    return False
+    spinner.finish()
+    changed = []
+    for archive, future in futures.items():
+        archive_changed, meta = future.result()
+        if archive_changed:
+            manifest["archives"][archive] = meta
+            changed.append(archive)
 
+    return changed
 
-def unzip():
-    """Unzip the configuration files
-    """
 
-    printer = Printer()
-    zip_dir = resources.get_zip_dir(create=True)
+def _is_config_member(info):
+    """Return True if the zip member is an openvpn configuration file which can be
+    extracted safely into the zip directory"""
+    name = info.filename
+    return (
+        not info.is_dir()
+        and name.endswith(".ovpn")
+        and not os.path.isabs(name)
+        and ".." not in name.split("/")
+    )
+
 
-    with printer.Do("Deleting old configuration files"):
-        for ovpn_dir in ("ovpn_udp", "ovpn_tcp"):
-            remove_dir = "{}/{}".format(zip_dir, ovpn_dir)
-            if os.path.exists(remove_dir):
-                rmtree(remove_dir, ignore_errors=True)
+def get_members():
+    """Return the configuration files of all archives read from their central
+    directories without extracting anything.
 
-    for key, archive in __ARCHIVES.items():
+    :returns: dictionary of file name to tuple (archive, crc)
+    """
+    members = {}
+    for archive in __ARCHIVES.values():
         zip_file = resources.get_zip_file(archive)
         with ZipFile(zip_file, "r") as zip_stream:
-            name_list = zip_stream.namelist()
+            for info in zip_stream.infolist():
+                if _is_config_member(info):
+                    members[info.filename] = (archive, info.CRC)
+
+    return members
+
+
+def _extract(zip_file, names, directory, progress):
+    """Extract the members names of zip_file into directory"""
+    with ZipFile(zip_file, "r") as zip_stream:
+        for name in names:
+            path = "{}/{}".format(directory, name)
+            with zip_stream.open(name) as member, open(path, "wb") as file_:
+                shutil.copyfileobj(member, file_, CHUNK_SIZE)
+            progress()
+
+
+def _swap(staging_dir, zip_dir, entry):
+    """Move entry from staging_dir into zip_dir. An existing directory is moved
+    into staging_dir first."""
+    target = "{}/{}".format(zip_dir, entry)
+    if os.path.isdir(target):
+        os.rename(target, "{}/.old.{}".format(staging_dir, entry))
+    os.replace("{}/{}".format(staging_dir, entry), target)
+
+
+def unzip(manifest, force=False, workers=None):
+    """Bring the extracted configuration files in line with the archives. The new
+    tree is built in a staging directory and swapped in at once, so openvpn never
+    sees a half extracted directory. Unchanged files are hard linked into the
+    staging directory and only files whose crc differs from the manifest are
+    extracted, concurrently by a pool of workers.
+
+    :param manifest: the manifest as returned by read_manifest. The members are
+                     updated in place.
+    :param force: if True extract all files no matter what the manifest says
+    :param workers: count of concurrent extractions. Defaults to the cpu count.
+    :returns: tuple (count of extracted files, count of removed files)
+    """
+    printer = Printer()
+    zip_dir = resources.get_zip_dir(create=True)
+    members = get_members()
+    known = {} if force else manifest["members"]
+    removed = [name for name in manifest["members"] if name not in members]
+    workers = workers or os.cpu_count() or 1
 
-            with printer.incremental_bar(
-                "Unzipping {} configurations".format(key), max=len(name_list)
-            ) as incremental_bar:
-                for file_name in name_list:
-                    zip_stream.extract(file_name, zip_dir)
+    staging_dir = tempfile.mkdtemp(prefix=".staging.", dir=zip_dir)
+    try:
+        changed = {}
+        for name, (archive, crc) in members.items():
+            os.makedirs(
+                os.path.dirname("{}/{}".format(staging_dir, name)), exist_ok=True
+            )
+            if known.get(name) == crc:
+                try:
+                    os.link(
+                        "{}/{}".format(zip_dir, name), "{}/{}".format(staging_dir, name)
+                    )
+                    continue
+                except OSError:
+                    pass
+            changed.setdefault(archive, []).append(name)
+
+        count = sum(len(names) for names in changed.values())
+        with printer.incremental_bar(
+            "Unzipping configurations", max=max(count, 1)
+        ) as incremental_bar:
+            lock = threading.Lock()
+
+            def progress():
+                with lock:
                     incremental_bar.next()
 
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(
+                        _extract,
+                        resources.get_zip_file(archive),
+                        names[worker::workers],
+                        staging_dir,
+                        progress,
+                    )
+                    for archive, names in changed.items()
+                    for worker in range(min(workers, len(names)))
+                ]
+            for future in futures:
+                future.result()
+
+        entries = {name.split("/")[0] for name in members}
+        for entry in entries:
+            _swap(staging_dir, zip_dir, entry)
+
+        # directories not in the archives anymore
+        for entry in {name.split("/")[0] for name in removed} - entries:
+            path = "{}/{}".format(zip_dir, entry)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    manifest["members"] = {name: crc for name, (_, crc) in members.items()}
+    return count, len(removed)
+
+
+def remove_extracted(manifest):
+    """Remove the configuration files extracted by earlier updates. Openvpn reads
+    its configuration on start, so a running connection isn't affected.
+
+    :param manifest: the manifest as returned by read_manifest. The members are
+                     cleared in place.
+    :returns: count of removed directories
+    """
+    zip_dir = resources.get_zip_dir(create=True)
+    entries = {name.split("/")[0] for name in manifest["members"]}
+    # configurations extracted before the manifest existed
+    entries.update("ovpn_{}".format(protocol) for protocol in ovpn.PROTOCOLS)
+    removed = 0
+    for entry in entries:
+        path = "{}/{}".format(zip_dir, entry)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+            removed += 1
+
+    manifest["members"] = {}
+    return removed
+
+
+def update_templates():
+    """Make the templates of the configurations from the standard archive. Every
+    configuration is verified against the template and the domains of differing
+    configurations are saved next to the template. A protocol whose
+    configurations don't share a template loses its template file and falls back
+    to the configuration files.
+    """
+    zip_file = resources.get_zip_path(__ARCHIVES["standard"])
+    for protocol in ovpn.PROTOCOLS:
+        template_file = resources.get_ovpn_template_file(protocol)
+        mismatches_file = resources.get_ovpn_template_mismatches_file(protocol)
+        template = ovpn.build_template(zip_file, protocol)
+        if template is not None:
+            mismatches = ovpn.find_mismatches(zip_file, protocol, template)
+            # the template is valid only together with its mismatches
+            resources.write_atomic(mismatches_file, json.dumps(sorted(mismatches)))
+            resources.write_atomic(template_file, template)
+        else:
+            for file_ in (template_file, mismatches_file):
+                if os.path.exists(file_):
+                    os.remove(file_)
+
+
+def templates_missing():
+    """Return True if the template or the mismatches of a protocol are missing.
+    A protocol without a shared template has neither, so it counts as missing.
+    """
+    return not all(
+        os.path.exists(file_)
+        for protocol in ovpn.PROTOCOLS
+        for file_ in (
+            resources.get_ovpn_template_file(protocol),
+            resources.get_ovpn_template_mismatches_file(protocol),
+        )
+    )
+
 
 def _update_openvpn_conf(force):
     printer = Printer()
@@ -120,16 +390,10 @@ def _update_openvpn_conf(force):
     except resources.ResourceNotFoundError:
         initial_run = True
 
-    if force or initial_run:
-        get()
-        unzip()
-    else:
-        update_archives = False
+    if not force and not initial_run:
+        # if one archive needs an update all archives are updated
         for archive in __ARCHIVES.values():
-            zip_file = resources.get_zip_path(archive)
-            # if one archive needs an update all archives are updated
-            if update_needed(zip_file):
-                update_archives = True
+            if update_needed(resources.get_zip_path(archive)):
                 break
         else:
             raise UpdateError(
@@ -137,16 +401,35 @@ def _update_openvpn_conf(force):
                 "the timeout."
             )
 
-        if update_archives:
-            get()
-            for archive in __ARCHIVES.values():
-                zip_file = resources.get_zip_path(archive)
-                orig_file = resources.get_zip_path(archive + ".orig")
-                if not file_equals(orig_file, zip_file):
-                    unzip()
-                    break
-            else:
-                printer.info("Configurations are up-to-date.")
+    full = force or initial_run
+    manifest = read_manifest()
+    changed = get(manifest, force=full)
+    if changed or full:
+        resources.clear_ovpn_cache()
+
+    mode = resources.get_configurations_config()["mode"]
+    if mode == "template" and (
+        full or __ARCHIVES["standard"] in changed or templates_missing()
+    ):
+        # the templates are made from the standard archive only
+        update_templates()
+
+    if mode in ("lazy", "template"):
+        # the archives stay packed and configurations are read on demand
+        if remove_extracted(manifest):
+            printer.info("Removed the extracted configuration files.")
+        write_manifest(manifest)
+        if not changed:
+            printer.info("Configurations are up-to-date.")
+    elif changed or full:
+        written, removed = unzip(manifest, force=full)
+        write_manifest(manifest)
+        printer.info(
+            "Updated {} and removed {} configuration files.".format(written, removed)
+        )
+    else:
+        write_manifest(manifest)
+        printer.info("Configurations are up-to-date.")
 
 
 def update(force=False):
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# pylint: disable=redefined-outer-name
+
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+import pytest
+from connord import archives
+
+
+@pytest.fixture
+def zip_file(tmp_path):
+    path = str(tmp_path / "ovpn.zip")
+    with ZipFile(path, "w") as zip_stream:
+        zip_stream.writestr("ovpn_udp/", "")
+        zip_stream.writestr(
+            "ovpn_udp/de1.nordvpn.com.udp.ovpn", "client\n" * 100, ZIP_DEFLATED
+        )
+        zip_stream.writestr("ovpn_tcp/de1.nordvpn.com.tcp.ovpn", "tcp\n", ZIP_STORED)
+    archives.clear_cache()
+    return path
+
+
+def test_get_index(zip_file):
+    actual_result = archives.get_index(zip_file)
+
+    assert set(actual_result) == {
+        "ovpn_udp/de1.nordvpn.com.udp.ovpn",
+        "ovpn_tcp/de1.nordvpn.com.tcp.ovpn",
+    }
+    assert actual_result["ovpn_tcp/de1.nordvpn.com.tcp.ovpn"].file_size == 4
+
+
+def test_get_index_is_cached_until_archive_changes(zip_file, mocker):
+    spy = mocker.spy(archives, "ZipFile")
+
+    archives.get_index(zip_file)
+    archives.get_index(zip_file)
+    assert spy.call_count == 1
+
+    with ZipFile(zip_file, "a") as zip_stream:
+        zip_stream.writestr("ovpn_udp/de2.nordvpn.com.udp.ovpn", "new")
+
+    assert "ovpn_udp/de2.nordvpn.com.udp.ovpn" in archives.get_index(zip_file)
+    assert spy.call_count == 2
+
+
+def test_read_member(zip_file):
+    assert (
+        archives.read_member(zip_file, "ovpn_udp/de1.nordvpn.com.udp.ovpn")
+        == b"client\n" * 100
+    )
+    assert archives.read_member(zip_file, "ovpn_tcp/de1.nordvpn.com.tcp.ovpn") == (
+        b"tcp\n"
+    )
+
+
+def test_read_member_when_member_not_exists(zip_file):
+    with pytest.raises(KeyError):
+        archives.read_member(zip_file, "ovpn_udp/us1.nordvpn.com.udp.ovpn")
+
+
+def test_read_member_when_crc_is_bad(zip_file, mocker):
+    index = dict(archives.get_index(zip_file))
+    name = "ovpn_tcp/de1.nordvpn.com.tcp.ovpn"
+    index[name] = index[name]._replace(crc=0)
+    mocker.patch("connord.archives.get_index", return_value=index)
+
+    with pytest.raises(archives.ArchiveError):
+        archives.read_member(zip_file, name)
+
+
+def test_find_member(zip_file, tmp_path):
+    broken_file = str(tmp_path / "broken.zip")
+    with open(broken_file, "w") as broken_fd:
+        broken_fd.write("no zip")
+    missing_file = str(tmp_path / "missing.zip")
+    name = "ovpn_tcp/de1.nordvpn.com.tcp.ovpn"
+
+    assert archives.find_member([missing_file, broken_file, zip_file], name) == (
+        zip_file
+    )
+    assert archives.find_member([zip_file], "ovpn_tcp/us1.nordvpn.com.tcp.ovpn") is None
@@ -1,5 +1,7 @@
 # pylint: disable=redefined-outer-name, unused-argument, unused-import, import-error
 
+import copy
+import sqlite3
 import pytest
 from connord import areas
 from main_test_module import (
@@ -14,7 +16,7 @@ from main_test_module import (
 @pytest.fixture(autouse=True)
 def clear_cache():
     yield
-    areas.get_locations.cache_clear()
+    areas.clear_cache()
 
 
 @pytest.fixture(scope="module")
@@ -27,14 +29,6 @@ def location_json():
     return get_json("location_rome_fixture.json")
 
 
-@pytest.fixture()
-def sleepless(monkeypatch):
-    def sleep(seconds):
-        pass
-
-    monkeypatch.setattr(areas.time, "sleep", sleep)
-
-
 @pytest.fixture(scope="module")
 def servers():
     return get_servers_stub()
@@ -140,7 +134,7 @@ def locations_db_fix2():
     return [minneapolis, minnea]
 
 
-def test_query_location(sleepless, location, requests_mock):
+def test_query_location(location, requests_mock):
     expected_useragent = (
         "Mozilla/5.0 (Windows NT 6.1; Win64; x64; rv:60.0) "
         "Gecko/20100101 Firefox/60.0"
@@ -173,102 +167,136 @@ def test_init_database(mocker, connection):
     mocked_sqlite.create_location_table.assert_called_once_with(connection)
 
 
-def test_update_database_all_locations_exist(mocker, connection, servers):
-    mocked_sqlite = mocker.patch("connord.areas.sqlite")
-    mocked_sqlite.create_connection.return_value = connection
-    mocked_sqlite.location_exists.return_value = True
-    mocked_init = mocker.patch("connord.areas.init_database")
-    mocked_query = mocker.patch("connord.areas.query_location")
+@pytest.fixture
+def database(mocker):
+    connection = sqlite3.connect(":memory:")
+    areas.init_database(connection)
+    mocker.patch("connord.areas.sqlite.create_connection", return_value=connection)
+    return connection
+
 
+@pytest.fixture
+def backend(mocker):
+    backend = mocker.Mock(rate_limited=False)
+    mocker.patch("connord.areas.geocoding.get_backend", return_value=backend)
+    return backend
+
+
+def _get_location_rows(connection):
+    return connection.execute(
+        "SELECT latitude, longitude, city, country_code FROM locations"
+    ).fetchall()
+
+
+def test_update_database_all_locations_exist(mocker, database, servers, backend):
+    angulars = {areas.get_server_angulars(server) for server in servers}
+    database.executemany(
+        "INSERT INTO locations VALUES(?,?,'name','city','country','cc',NULL)",
+        angulars,
+    )
+    mocked_query = backend.reverse
     mocked_get_servers = mocker.patch(
         "connord.areas.servers.get_servers", return_value=servers
     )
 
     areas.update_database()
 
-    mocked_sqlite.create_connection.assert_called()
-    mocked_init.assert_called_once_with(connection)
     mocked_get_servers.assert_called_once()
-    mocked_sqlite.location_exists.assert_called()
     mocked_query.assert_not_called()
+    assert len(_get_location_rows(database)) == len(angulars)
 
 
 def test_update_database_location_not_exists(
-    mocker, location_json, connection, servers
+    mocker, location_json, database, servers, backend
 ):
-    mocked_sqlite = mocker.patch("connord.areas.sqlite")
-    mocked_sqlite.create_connection.return_value = connection
-    mocked_sqlite.location_exists.side_effect = [
-        False,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-    ]
-    mocked_init = mocker.patch("connord.areas.init_database")
-    mocked_query = mocker.patch(
-        "connord.areas.query_location", return_value=location_json
+    angulars = sorted({areas.get_server_angulars(server) for server in servers})
+    database.executemany(
+        "INSERT INTO locations VALUES(?,?,'name','city','country','cc',NULL)",
+        angulars[1:],
     )
-
+    mocked_query = backend.reverse
+    mocked_query.return_value = location_json
     mocked_get_servers = mocker.patch(
         "connord.areas.servers.get_servers", return_value=servers
     )
 
     areas.update_database()
 
-    mocked_sqlite.create_connection.assert_called()
-    mocked_init.assert_called_once_with(connection)
     mocked_get_servers.assert_called_once()
-    mocked_sqlite.location_exists.assert_called()
-    mocked_query.assert_called()
-    mocked_sqlite.create_location.assert_called_once()
+    mocked_query.assert_called_once_with(*angulars[0])
+    rows = _get_location_rows(database)
+    assert len(rows) == len(angulars)
+    assert (angulars[0][0], angulars[0][1], "Rome", mocker.ANY) in rows
 
 
 def test_update_database_location_not_exists_when_city_is_unknown(
     # setup
     mocker,
     location_json,
-    connection,
+    database,
     servers,
+    backend,
 ):
-    mocked_sqlite = mocker.patch("connord.areas.sqlite")
-    mocked_sqlite.create_connection.return_value = connection
-    mocked_sqlite.location_exists.side_effect = [
-        False,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-    ]
-    mocked_init = mocker.patch("connord.areas.init_database")
+    angulars = sorted({areas.get_server_angulars(server) for server in servers})
+    database.executemany(
+        "INSERT INTO locations VALUES(?,?,'name','city','country','cc',NULL)",
+        angulars[1:],
+    )
     # delete keys
     location_json["address"].pop("city")
     location_json["address"].pop("state")
 
-    mocked_query = mocker.patch(
-        "connord.areas.query_location", return_value=location_json
-    )
+    mocked_query = backend.reverse
+    mocked_query.return_value = location_json
+    mocker.patch("connord.areas.servers.get_servers", return_value=servers)
 
-    mocked_get_servers = mocker.patch(
-        "connord.areas.servers.get_servers", return_value=servers
-    )
+    # run
+    areas.update_database()
+
+    # assert
+    mocked_query.assert_called_once()
+    rows = _get_location_rows(database)
+    assert (angulars[0][0], angulars[0][1], "Unknown", mocker.ANY) in rows
+
+
+def test_update_database_queries_each_location_once(
+    mocker, location_json, database, servers, backend
+):
+    angulars = {areas.get_server_angulars(server) for server in servers}
+    mocked_query = backend.reverse
+    mocked_query.return_value = location_json
+    mocker.patch("connord.areas.servers.get_servers", return_value=servers * 2)
 
     # run
     areas.update_database()
 
     # assert
-    mocked_sqlite.create_connection.assert_called()
-    mocked_init.assert_called_once_with(connection)
-    mocked_get_servers.assert_called_once()
-    mocked_sqlite.location_exists.assert_called()
-    mocked_query.assert_called()
-    mocked_sqlite.create_location.assert_called_once()
+    assert mocked_query.call_count == len(angulars)
+    assert len(_get_location_rows(database)) == len(angulars)
+
+
+def test_update_database_keeps_locations_when_query_fails(
+    mocker, location_json, database, servers, backend
+):
+    angulars = sorted({areas.get_server_angulars(server) for server in servers})
+
+    def reverse(latitude, longitude):
+        if (latitude, longitude) == angulars[0]:
+            raise areas.geocoding.GeocodingError("query failed")
+        return location_json
+
+    backend.reverse.side_effect = reverse
+    mocked_error = mocker.patch("connord.areas.Printer.error")
+    mocker.patch("connord.areas.servers.get_servers", return_value=servers)
+
+    # run
+    areas.update_database()
+
+    # assert
+    rows = _get_location_rows(database)
+    assert len(rows) == len(angulars) - 1
+    assert (angulars[0][0], angulars[0][1], "Rome", mocker.ANY) not in rows
+    mocked_error.assert_called_once()
 
 
 def test_get_server_angulars(server):
@@ -348,6 +376,41 @@ def test_verify_areas_when_area_not_found(mocker, areas_not_exist, locations_db_
     mocked_get_loc.assert_called_once()
 
 
+def test_area_index_find(server_locations):
+    server_locations.append(
+        {"latitude": "50.1", "longitude": "8.6", "city": "Frankfurt"}
+    )
+    server_locations.append({"latitude": "0", "longitude": "0", "city": "Şalalah"})
+    area_index = areas.AreaIndex(server_locations)
+
+    assert area_index.find("fr") == ["Frankfurt"]
+    assert area_index.find("A") == ["Amsterdam"]
+    assert area_index.find("sal") == ["Şalalah"]
+    assert area_index.find("") == [
+        "Frankfurt",
+        "Amsterdam",
+        "Manassas",
+        "Dallas",
+        "Şalalah",
+    ]
+    assert area_index.find("x") == []
+    assert area_index.find("zz") == []
+
+
+def test_area_index_get_angulars(server_locations):
+    server_locations.append(
+        {"latitude": "50.1", "longitude": "8.6", "city": "Frankfurt"}
+    )
+    area_index = areas.AreaIndex(server_locations)
+
+    assert area_index.get_angulars(["fra", "dal"]) == {
+        ("50.116667", "8.683333"),
+        ("50.1", "8.6"),
+        ("32.7833333", "-96.8"),
+    }
+    assert area_index.get_angulars(["xyz"]) == set()
+
+
 def test_get_translation_table():
     # setup
     expected_translation_table = {
@@ -368,46 +431,110 @@ def test_get_translation_table():
     assert actual_translation_table == expected_translation_table
 
 
-def test_filter_servers(mocker, servers, connection):
+@pytest.fixture
+def server_locations():
+    cities = {
+        ("50.116667", "8.683333"): "Frankfurt",
+        ("52.35", "4.916667"): "Amsterdam",
+        ("38.7508333", "-77.4755556"): "Manassas",
+        ("32.7833333", "-96.8"): "Dallas",
+    }
+    return [
+        {"latitude": latitude, "longitude": longitude, "city": city}
+        for (latitude, longitude), city in cities.items()
+    ]
+
+
+def test_filter_servers(mocker, servers, server_locations):
     # setup
     areas_ = ["fr"]
-    cities = [
-        "Frankfurt",
-        "Frankfurt",
-        "Frankfurt",
-        "Amsterdam",
-        "Amsterdam",
-        "Amsteradm",
-        "Manassas",
-        "Dallas",
-    ]
     expected_servers = get_expected_servers_by_domain(["de111", "de112", "de113"])
-    mocked_sqlite = mocker.patch("connord.areas.sqlite")
-    mocked_sqlite.create_connection.return_value = connection
-    mocked_sqlite.location_exists.side_effect = [
-        False,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-        True,
-    ]
-    mocked_sqlite.get_city.side_effect = cities
+    mocked_locations = mocker.patch("connord.areas.get_locations")
+    mocked_locations.side_effect = [server_locations[1:], server_locations]
     mocked_update = mocker.patch("connord.areas.update_database")
+    mocked_update.side_effect = areas.clear_cache
 
     # run
     actual_servers = areas.filter_servers(servers, areas_)
 
     # assert
-    mocked_sqlite.create_connection.assert_called_once()
-    mocked_sqlite.location_exists.assert_called()
     mocked_update.assert_called_once()
-
     assert actual_servers == expected_servers
 
 
+def test_filter_servers_with_server_table(mocker, servers, server_locations):
+    # setup
+    from connord.servers import to_table
+
+    areas_ = ["fr"]
+    expected_servers = get_expected_servers_by_domain(["de111", "de112", "de113"])
+    mocked_locations = mocker.patch("connord.areas.get_locations")
+    mocked_locations.return_value = server_locations
+    mocked_update = mocker.patch("connord.areas.update_database")
+    spy_build = mocker.spy(areas, "_build_location_index")
+
+    # run
+    actual_servers = areas.filter_servers(to_table(servers), areas_)
+    actual_servers_again = areas.filter_servers(to_table(servers), ["dal"])
+
+    # assert
+    # the indexes are built just once for the same locations
+    spy_build.assert_called_once()
+    mocked_update.assert_not_called()
+    assert list(actual_servers) == expected_servers
+    assert [server["domain"] for server in actual_servers_again] == [
+        "us2853.nordvpn.com"
+    ]
+
+
+def test_filter_servers_when_coordinates_are_integers(
+    mocker, servers, server_locations
+):
+    # setup
+    from connord.servers import to_table
+
+    server = copy.deepcopy(servers[0])
+    server["location"] = {"lat": 50, "long": 8.5}
+    server_locations.append({"latitude": "50", "longitude": "8.5", "city": "Frankfurt"})
+    mocked_locations = mocker.patch("connord.areas.get_locations")
+    mocked_locations.return_value = server_locations
+    mocked_update = mocker.patch("connord.areas.update_database")
+
+    # run
+    actual_servers = areas.filter_servers([server], ["fr"])
+    actual_table = areas.filter_servers(to_table([server]), ["fr"])
+
+    # assert
+    mocked_update.assert_not_called()
+    assert actual_servers == [server]
+    assert list(actual_table) == [server]
+
+
+def test_filter_servers_when_location_stays_unknown(mocker, servers, server_locations):
+    # setup
+    mocked_locations = mocker.patch("connord.areas.get_locations")
+    mocked_locations.return_value = server_locations[1:]
+    mocked_update = mocker.patch("connord.areas.update_database")
+    mocked_update.side_effect = areas.clear_cache
+
+    # run
+    actual_servers = areas.filter_servers(servers, ["fr"])
+
+    # assert
+    mocked_update.assert_called_once()
+    assert actual_servers == []
+
+
+def test_get_location_index(mocker, server_locations):
+    mocked_locations = mocker.patch("connord.areas.get_locations")
+    mocked_locations.return_value = server_locations
+
+    actual_index = areas.get_location_index()
+
+    assert actual_index[("52.35", "4.916667")]["city"] == "Amsterdam"
+    assert len(actual_index) == len(server_locations)
+
+
 def test_filter_servers_when_servers_is_none(areas_good_fix):
     # setup
     servers = None
@@ -441,33 +568,62 @@ def test_filter_servers_when_servers_is_empty(areas_good_fix):
     assert actual_servers == list()
 
 
-def test_get_min_id(mocker):
+def test_get_min_id(mocker, locations_db_fix):
     # setup
-    mocked_verify = mocker.patch("connord.areas.verify_areas")
+    mocked_get_loc = mocker.patch(
+        "connord.areas.get_locations", return_value=locations_db_fix
+    )
     expected_id = "m"
 
     # run
     actual_id = areas.get_min_id("Minneapolis")
 
     # assert
-    mocked_verify.assert_called_once_with([expected_id])
+    mocked_get_loc.assert_called_once()
     assert actual_id == expected_id
 
 
-def test_get_min_id_when_city_is_fully_ambiguous(mocker):
+def test_get_min_id_when_city_is_fully_ambiguous(mocker, locations_db_fix2):
     # setup
-    mocked_verify = mocker.patch("connord.areas.verify_areas")
-    mocked_verify.side_effect = areas.AreaError
+    locations_db_fix2[1]["city"] = "Minneapolisx"
+    mocker.patch("connord.areas.get_locations", return_value=locations_db_fix2)
     expected_id = "minneapolis"
 
     # run
     actual_id = areas.get_min_id("Minneapolis")
 
     # assert
-    mocked_verify.assert_called()
     assert actual_id == expected_id
 
 
+def test_area_index_min_ids():
+    cities = ["Frankfurt", "Amsterdam", "Manassas", "Malmö", "Madrid", "Frankfort"]
+    locations = [
+        {"latitude": str(i), "longitude": "0", "city": city}
+        for i, city in enumerate(cities)
+    ]
+    locations.append({"latitude": "10", "longitude": "0", "city": "Sao Paulo"})
+    locations.append({"latitude": "11", "longitude": "0", "city": "São Paulo"})
+    area_index = areas.AreaIndex(locations)
+
+    # run
+    actual_ids = {city: area_index.get_min_id(city) for city in cities}
+
+    # assert
+    assert actual_ids == {
+        "Frankfurt": "frankfu",
+        "Amsterdam": "a",
+        "Manassas": "man",
+        "Malmö": "mal",
+        "Madrid": "mad",
+        "Frankfort": "frankfo",
+    }
+    assert area_index.get_min_id("São Paulo") == "sao paulo"
+    assert area_index.get_min_id("Unknown") == "unknown"
+    for city, min_id in actual_ids.items():
+        assert area_index.find(min_id) == [city]
+
+
 def test_get_locations_when_locations_is_empty(mocker, connection, locations_db_fix):
     # setup
     mocked_sqlite = mocker.patch("connord.areas.sqlite")
@@ -504,6 +660,28 @@ def test_get_locations_when_locations_is_not_empty(
     assert actual_locations == locations_db_fix
 
 
+def test_get_locations_when_locations_are_unchanged(
+    mocker, connection, locations_db_fix
+):
+    # setup
+    mocked_sqlite = mocker.patch("connord.areas.sqlite")
+    mocked_sqlite.create_connection.return_value = connection
+    mocked_sqlite.get_locations_version.side_effect = [(4, 4), (4, 4), (5, 5)]
+    mocked_sqlite.get_locations.return_value = locations_db_fix
+
+    # run
+    actual_locations = areas.get_locations()
+    actual_index = areas.get_area_index()
+    actual_locations_after_change = areas.get_locations()
+
+    # assert
+    assert actual_locations is locations_db_fix
+    assert actual_index.find("chennai") == ["Chennai"]
+    # read again only after locations were added
+    assert mocked_sqlite.get_locations.call_count == 2
+    assert actual_locations_after_change is locations_db_fix
+
+
 def test_area_pretty_formatter_format_headline(mocker):
     # setup
     expected_headline = """================================================================================
@@ -216,3 +216,31 @@ def test_print_categories():
         assert True
     except Exception:
         assert False
+
+
+def test_filter_servers_with_server_table():
+    from connord import servers
+
+    servers_ = get_servers_stub()
+    table = servers.to_table(servers_)
+
+    for categories_ in (None, ["p2p"], ["standard", "p2p"], ["double"]):
+        expected_servers = categories.filter_servers(servers_, categories_)
+        actual_servers = categories.filter_servers(table, categories_)
+        assert list(actual_servers) == expected_servers
+
+
+def test_category_bits_are_unique_and_cover_all_categories():
+    assert set(categories.CATEGORY_BITS) == set(categories.CATEGORIES)
+    assert len(set(categories.CATEGORY_BITS.values())) == len(categories.CATEGORY_BITS)
+
+
+def test_encode_and_decode_categories():
+    server = get_expected_servers_by_domain(["de111"])[0]
+
+    mask = categories.encode_categories(server["categories"])
+
+    assert categories.decode_categories(mask) == ["standard", "p2p"]
+    assert categories.has_category(server, "P2P")
+    assert not categories.has_category(server, "Double VPN")
+    assert not categories.has_category(server, "Unknown Category")
@@ -2,6 +2,9 @@
 
 # pylint: disable=import-error, redefined-outer-name, too-many-locals
 
+import math
+import os
+import sqlite3
 import time
 import pytest
 from connord import connect
@@ -14,25 +17,6 @@ from tests.main_test_module import (
 )
 
 
-@pytest.fixture
-def ping_output_good():
-    return b"""PING archlinux.org (192.168.8.1) 56(84) bytes of data.
-
---- archlinux.org ping statistics ---
-4 packets transmitted, 4 received, 0% packet loss, time 9ms
-rtt min/avg/max/mdev = 0.895/0.980/1.040/0.067 ms
-"""
-
-
-@pytest.fixture
-def ping_output_bad():
-    return b"""PING archlinux.org (192.168.8.1) 56(84) bytes of data.
-
---- archlinux.org ping statistics ---
-4 packets transmitted, 0 received, 100% packet loss, time 9ms
-"""
-
-
 @pytest.fixture
 def servers_fix():
     return get_servers_stub()
@@ -48,6 +32,7 @@ def pinged_servers():
     servers_ = get_json("servers_fix_12_sorted_by_load_cut_to_10.json")
     for i, server in enumerate(servers_):
         server["ping"] = i
+        server["latency"] = {"min": i, "median": i, "p95": i, "jitter": 0, "loss": 0}
     return servers_
 
 
@@ -63,59 +48,106 @@ def openvpn_command_no_options():
     return openvpn_command
 
 
-def test_ping(mocker, ping_output_good):
-    test_server = {}
-    test_server["ip_address"] = "100.100.100.100"
-    test_server["domain"] = "us1000"
+def test_ping_servers_parallel(mocker):
+    servers_ = get_servers_stub()
+    samples = {
+        server["ip_address"]: [float(i), float(i + 2), math.inf]
+        for i, server in enumerate(servers_)
+    }
+    samples[servers_[0]["ip_address"]] = [math.inf] * 3
+    mocked_probe = mocker.patch(
+        "connord.connect.probe.probe_samples", return_value=samples
+    )
+    probe_config = dict(connect.PROBE_DEFAULTS, method="tcp")
 
-    mocked_popen = mocker.patch("connord.connect.subprocess.Popen")
-    process_mock = mocker.MagicMock()
-    attrs = {"communicate.return_value": (ping_output_good, b"error")}
-    process_mock.configure_mock(**attrs)
-    mocked_popen.return_value.__enter__.return_value = process_mock
+    # run
+    actual_servers = connect.ping_servers_parallel(servers_, probe_config)
 
-    server = connect.ping(test_server)
+    # assert
+    mocked_probe.assert_called_once_with(
+        [server["ip_address"] for server in servers_],
+        samples=probe_config["samples"],
+        interval=probe_config["interval"],
+        method="tcp",
+        timeout=probe_config["timeout"],
+        deadline=probe_config["deadline"],
+    )
+    assert actual_servers[0]["ping"] == math.inf
+    assert actual_servers[0]["latency"]["loss"] == 1.0
+    for actual_server in actual_servers[1:]:
+        rtt = samples[actual_server["ip_address"]][0]
+        assert actual_server["ping"] == rtt + 1
+        assert actual_server["latency"]["min"] == rtt
+        assert actual_server["latency"]["jitter"] == 2
+        assert actual_server["latency"]["loss"] == pytest.approx(1 / 3)
+    assert "ping" not in servers_[0]
+
+
+def test_ping_servers_parallel_reads_config(mocker):
+    servers_ = get_servers_stub()
+    mocked_config = mocker.patch("connord.connect.resources.get_config")
+    mocked_config.return_value = {"probe": {"method": "icmp", "samples": 5}}
+    mocked_probe = mocker.patch("connord.connect.probe.probe_samples")
+    mocked_probe.return_value = {server["ip_address"]: [1.0] for server in servers_}
 
-    mocked_popen.assert_called()
-    assert server["ping"] == 0.980
+    # run
+    connect.ping_servers_parallel(servers_)
 
+    # assert
+    mocked_probe.assert_called_once_with(
+        [server["ip_address"] for server in servers_],
+        samples=5,
+        interval=connect.PROBE_DEFAULTS["interval"],
+        method="icmp",
+        timeout=connect.PROBE_DEFAULTS["timeout"],
+        deadline=connect.PROBE_DEFAULTS["deadline"],
+    )
 
-def test_ping_bad(mocker, ping_output_bad):
-    test_server = {}
-    test_server["ip_address"] = "100.100.100.100"
-    test_server["domain"] = "us1000"
 
-    mocked_popen = mocker.patch("connord.connect.subprocess.Popen")
-    process_mock = mocker.MagicMock()
-    attrs = {"communicate.return_value": (ping_output_bad, b"error")}
-    process_mock.configure_mock(**attrs)
-    mocked_popen.return_value.__enter__.return_value = process_mock
+def _latency(median_, jitter=0.0, loss=0.0):
+    return {
+        "min": median_,
+        "median": median_,
+        "p95": median_,
+        "jitter": jitter,
+        "loss": loss,
+    }
 
-    server = connect.ping(test_server)
 
-    mocked_popen.assert_called()
-    import math
+def test_rank_servers():
+    servers_ = [
+        {"domain": "lossy", "load": 1, "latency": _latency(10.0, loss=0.5)},
+        {"domain": "dead", "load": 1, "latency": _latency(math.inf, math.inf, 1.0)},
+        {"domain": "jittery", "load": 1, "latency": _latency(20.0, jitter=50.0)},
+        {"domain": "loaded", "load": 90, "latency": _latency(10.0)},
+        {"domain": "best", "load": 10, "latency": _latency(30.0, jitter=5.0)},
+    ]
 
-    assert server["ping"] == math.inf
+    # run
+    actual_servers = connect.rank_servers(servers_, connect.RANKING_DEFAULTS)
 
+    # assert
+    assert [server["domain"] for server in actual_servers] == [
+        "best",
+        "jittery",
+        "loaded",
+        "lossy",
+        "dead",
+    ]
 
-def test_ping_servers_parallelness(mocker):
-    test_server = {}
-    test_server["ip_address"] = "100.100.100.100"
-    test_server["domain"] = "us1000"
 
-    def ping_fix(ip):
-        time.sleep(0.2)
-        return test_server
+def test_rank_servers_by_median_only():
+    servers_ = [
+        {"domain": "slow", "load": 1, "latency": _latency(20.0)},
+        {"domain": "fast", "load": 99, "latency": _latency(10.0, jitter=30.0)},
+    ]
+    weights = {"median": 1.0, "p95": 0.0, "jitter": 0.0, "loss": 0.0, "load": 0.0}
 
-    mocker.patch("connord.connect.ping", ping_fix)
-    servers_ = get_servers_stub()
-    actual_servers = connect.ping_servers_parallel(servers_)
-    expected_servers = []
-    for i in range(len(servers_)):
-        expected_servers.append(test_server)
+    # run
+    actual_servers = connect.rank_servers(servers_, weights)
 
-    assert actual_servers == expected_servers
+    # assert
+    assert [server["domain"] for server in actual_servers] == ["fast", "slow"]
 
 
 def test_filter_servers(mocker, servers_fix):
@@ -144,6 +176,15 @@ def test_filter_servers(mocker, servers_fix):
 def test_filter_best_servers(
     mocker, servers_sorted_by_load, servers_12, pinged_servers
 ):
+    probe_config = dict(connect.PROBE_DEFAULTS, servers=10)
+    mocker.patch("connord.connect.get_probe_config", return_value=probe_config)
+    mocker.patch(
+        "connord.connect.get_ranking_config", return_value=connect.RANKING_DEFAULTS
+    )
+    mocker.patch(
+        "connord.connect.sqlite.create_connection",
+        return_value=sqlite3.connect(":memory:"),
+    )
     mocked_ping = mocker.patch("connord.connect.ping_servers_parallel")
     mocked_ping.return_value = pinged_servers
 
@@ -151,10 +192,98 @@ def test_filter_best_servers(
     actual_servers = connect.filter_best_servers(servers_12)
 
     # assert
-    mocked_ping.assert_called_once_with(servers_sorted_by_load)
+    mocked_ping.assert_called_once_with(servers_sorted_by_load, probe_config)
     assert actual_servers == pinged_servers
 
 
+def test_filter_best_servers_probes_candidates_from_history(
+    mocker, servers_sorted_by_load, servers_12, pinged_servers
+):
+    probe_config = dict(connect.PROBE_DEFAULTS, servers=10)
+    mocker.patch("connord.connect.get_probe_config", return_value=probe_config)
+    mocker.patch(
+        "connord.connect.get_ranking_config", return_value=connect.RANKING_DEFAULTS
+    )
+    history_config = dict(connect.history.HISTORY_DEFAULTS, candidates=3)
+    mocker.patch(
+        "connord.connect.history.get_history_config", return_value=history_config
+    )
+    connection = sqlite3.connect(":memory:")
+    mocker.patch("connord.connect.sqlite.create_connection", return_value=connection)
+    mocked_ping = mocker.patch("connord.connect.ping_servers_parallel")
+    mocked_ping.return_value = pinged_servers
+
+    # run the first time probes all servers
+    connect.filter_best_servers(servers_12)
+    mocked_ping.assert_called_once_with(servers_sorted_by_load, probe_config)
+
+    # run the second time probes the best servers of the first run
+    mocked_ping.reset_mock()
+    connection = sqlite3.connect(":memory:")
+    connect.history.record(connection, pinged_servers, history_config)
+    mocker.patch("connord.connect.sqlite.create_connection", return_value=connection)
+    connect.filter_best_servers(servers_12)
+    mocked_ping.assert_called_once_with(servers_sorted_by_load[:3], probe_config)
+
+
+def test_filter_best_servers_without_history(
+    mocker, servers_sorted_by_load, servers_12, pinged_servers
+):
+    probe_config = dict(connect.PROBE_DEFAULTS, servers=10)
+    mocker.patch("connord.connect.get_probe_config", return_value=probe_config)
+    mocker.patch(
+        "connord.connect.get_ranking_config", return_value=connect.RANKING_DEFAULTS
+    )
+    connection = sqlite3.connect(":memory:")
+    mocker.patch("connord.connect.sqlite.create_connection", return_value=connection)
+    mocker.patch(
+        "connord.connect.history.get_averages",
+        side_effect=connect.sqlite.SqliteError("error"),
+    )
+    mocker.patch(
+        "connord.connect.history.record",
+        side_effect=connect.sqlite.SqliteError("error"),
+    )
+    mocked_ping = mocker.patch("connord.connect.ping_servers_parallel")
+    mocked_ping.return_value = pinged_servers
+
+    # run
+    actual_servers = connect.filter_best_servers(servers_12)
+
+    # assert
+    mocked_ping.assert_called_once_with(servers_sorted_by_load, probe_config)
+    assert actual_servers == pinged_servers
+
+
+def test_prerank_servers():
+    servers_ = [
+        {"domain": "unknown1", "load": 1},
+        {"domain": "slow", "load": 2},
+        {"domain": "unknown2", "load": 3},
+        {"domain": "fast", "load": 4},
+    ]
+    averages = {"slow": _latency(100.0), "fast": _latency(10.0)}
+
+    # run
+    actual_servers = connect.prerank_servers(
+        servers_, averages, connect.RANKING_DEFAULTS, 3
+    )
+
+    # assert
+    assert [server["domain"] for server in actual_servers] == [
+        "fast",
+        "slow",
+        "unknown1",
+    ]
+    assert connect.prerank_servers(servers_, {}, connect.RANKING_DEFAULTS, 3) == (
+        servers_
+    )
+    assert (
+        connect.prerank_servers(servers_, averages, connect.RANKING_DEFAULTS, 0)
+        == servers_
+    )
+
+
 def test_connect_to_specific_server(mocker, servers_12):
     mockbase = MockBase("connect")
     mockbase.setup(connect)
@@ -222,7 +351,7 @@ def test_connect_when_domain_is_best(mocker, pinged_servers, servers_fix):
         "connord.connect.connect_to_specific_server", return_value=True
     )
     mocked_servers = mocker.patch(
-        "connord.connect.servers.get_servers", return_value=servers_fix
+        "connord.connect.servers.get_server_table", return_value=servers_fix
     )
     mocked_filter = mocker.patch(
         "connord.connect.filter_servers", return_value=servers_fix
@@ -280,7 +409,7 @@ def test_connect_when_domain_is_best_max_retries_reached(
         "connord.connect.connect_to_specific_server", return_value=True
     )
     mocked_servers = mocker.patch(
-        "connord.connect.servers.get_servers", return_value=servers_fix
+        "connord.connect.servers.get_server_table", return_value=servers_fix
     )
     mocked_filter = mocker.patch(
         "connord.connect.filter_servers", return_value=servers_fix
@@ -342,7 +471,7 @@ def test_connect_when_domain_is_best_no_server_left_with_valid_ping(
         "connord.connect.connect_to_specific_server", return_value=True
     )
     mocked_servers = mocker.patch(
-        "connord.connect.servers.get_servers", return_value=servers_fix
+        "connord.connect.servers.get_server_table", return_value=servers_fix
     )
     mocked_filter = mocker.patch(
         "connord.connect.filter_servers", return_value=servers_fix
@@ -408,7 +537,7 @@ def test_connect_when_domain_is_best_two_servers_run_openvpn_fails(
         "connord.connect.connect_to_specific_server", return_value=True
     )
     mocked_servers = mocker.patch(
-        "connord.connect.servers.get_servers", return_value=servers_fix
+        "connord.connect.servers.get_server_table", return_value=servers_fix
     )
     mocked_filter = mocker.patch(
         "connord.connect.filter_servers", return_value=servers_fix
@@ -717,3 +846,341 @@ def test_forge_scripts_when_name_is_unknown_path_is_built_in(
         assert False
     except ResourceNotFoundError as error:
         assert str(error) == "No built-in found for 'something'."
+
+
+@pytest.fixture
+def forged_dir(tmp_path, mocker):
+    forged_dir = tmp_path / "forged"
+    forged_dir.mkdir()
+    mocker.patch(
+        "connord.connect.resources.get_forged_ovpn_dir", return_value=str(forged_dir)
+    )
+    return forged_dir
+
+
+def _mock_configurations_config(mocker, mode):
+    mocker.patch(
+        "connord.connect.resources.get_configurations_config",
+        return_value={"mode": mode, "cache": 2},
+    )
+
+
+def test_forge_ovpn_config_when_template_exists(
+    openvpn_command_no_options, mocker, tmp_path, forged_dir
+):
+    # setup
+    template_file = tmp_path / "template.udp.ovpn"
+    template_file.write_text(
+        "remote ${ip_address} 1194\nverify-x509-name CN=${domain}\n\n"
+    )
+    _mock_configurations_config(mocker, "template")
+    mocker.patch(
+        "connord.connect.resources.get_ovpn_template_file",
+        return_value=str(template_file),
+    )
+    mocker.patch(
+        "connord.connect.resources.read_ovpn_template_mismatches",
+        return_value={"de112.nordvpn.com"},
+    )
+    mocked_get_ovpn_config = mocker.patch("connord.connect.resources.get_ovpn_config")
+    openvpn_command_no_options.cmd.append("--verify-x509-name")
+
+    # run
+    openvpn_command_no_options.forge_ovpn_config()
+
+    # assert
+    mocked_get_ovpn_config.assert_not_called()
+    config_file = openvpn_command_no_options.cmd[-1]
+    assert openvpn_command_no_options.cmd[-2] == "--config"
+    assert os.path.dirname(config_file) == str(forged_dir)
+    with open(config_file) as config_fd:
+        assert config_fd.read() == "remote 185.145.66.248 1194\n\n"
+    assert os.stat(config_file).st_mode & 0o777 == 0o640
+
+
+def test_forge_ovpn_config_when_template_not_exists(
+    openvpn_command_no_options, mocker, tmp_path, forged_dir
+):
+    # setup
+    config_file = tmp_path / "de111.nordvpn.com.udp.ovpn"
+    config_file.write_text("remote 185.145.66.248 1194\n  \n--dev tun\n")
+    _mock_configurations_config(mocker, "template")
+    mocker.patch(
+        "connord.connect.resources.get_ovpn_template_file",
+        return_value=str(tmp_path / "template.udp.ovpn"),
+    )
+    mocker.patch(
+        "connord.connect.resources.get_ovpn_config", return_value=str(config_file)
+    )
+    openvpn_command_no_options.cmd.append("--dev")
+
+    # run
+    openvpn_command_no_options.forge_ovpn_config()
+
+    # assert
+    with open(openvpn_command_no_options.cmd[-1]) as config_fd:
+        assert config_fd.read() == "remote 185.145.66.248 1194\n  \n"
+
+
+@pytest.mark.parametrize(
+    "domain, mismatches",
+    [
+        # the template is made of the standard archive only
+        ("nl80", set()),
+        ("de111", {"de111.nordvpn.com"}),
+        ("de111", connect.resources.ResourceNotFoundError("template.udp.json")),
+    ],
+)
+def test_get_ovpn_template_file_when_config_differs(
+    domain, mismatches, mocker, tmp_path
+):
+    # setup
+    server = get_expected_servers_by_domain([domain])[0]
+    template_file = tmp_path / "template.udp.ovpn"
+    template_file.write_text("remote ${ip_address} 1194\n")
+    _mock_configurations_config(mocker, "template")
+    mocker.patch(
+        "connord.connect.resources.get_ovpn_template_file",
+        return_value=str(template_file),
+    )
+    mocker.patch(
+        "connord.connect.resources.read_ovpn_template_mismatches",
+        side_effect=[mismatches],
+    )
+    openvpn_command = connect.OpenvpnCommand(server, "", False, "udp")
+
+    # run
+    actual_template_file = openvpn_command._get_ovpn_template_file()
+
+    # assert
+    assert actual_template_file is None
+
+
+def test_forge_ovpn_config_is_cached(mocker, tmp_path, forged_dir):
+    # setup
+    server = get_expected_servers_by_domain(["de111"])[0]
+    config_file = tmp_path / "de111.nordvpn.com.udp.ovpn"
+    config_file.write_text("remote 185.145.66.248 1194\ndev tun\n")
+    _mock_configurations_config(mocker, "extract")
+    mocked_write = mocker.spy(connect.resources, "write_atomic")
+
+    def forge(*flags):
+        openvpn_command = connect.OpenvpnCommand(server, "", False, "udp")
+        openvpn_command.cmd.extend(flags)
+        openvpn_command.forge_ovpn_config(config_file=str(config_file))
+        return openvpn_command.cmd[-1]
+
+    # run
+    first = forge("--daemon")
+    second = forge("--daemon")
+    third = forge("--daemon", "--dev")
+    config_file.write_text("remote 185.145.66.248 443\ndev tun\n")
+    fourth = forge("--daemon")
+
+    # assert
+    assert first == second
+    assert mocked_write.call_count == 3
+    assert len({first, third, fourth}) == 3
+    with open(third) as config_fd:
+        assert config_fd.read() == "remote 185.145.66.248 1194\n"
+    assert sorted(os.listdir(str(forged_dir))) == sorted(
+        os.path.basename(path) for path in (third, fourth)
+    )
+
+
+@pytest.fixture
+def openvpn_run(mocker, openvpn_command_no_options):
+    process = mocker.MagicMock()
+    process.poll.return_value = None
+    mocked_popen = mocker.patch("connord.connect.subprocess.Popen")
+    mocked_popen.return_value.__enter__.return_value = process
+    mocker.patch(
+        "connord.connect.resources.get_config",
+        return_value={"openvpn": {"scripts": [{"stage": "up", "creates": "up.env"}]}},
+    )
+    mocker.patch.object(connect.OpenvpnCommand, "cleanup")
+    mocker.patch("connord.connect.resources.get_stats_dir")
+    mocker.patch("connord.connect.resources.get_stats_file")
+    mocker.patch("connord.connect.resources.get_stats", return_value={})
+    mocker.patch("connord.connect.resources.write_stats")
+    openvpn_command_no_options.management_socket = "/run/openvpn.sock"
+    return openvpn_command_no_options, process
+
+
+def test_run_applies_iptables_when_connected(mocker, openvpn_run):
+    openvpn_command, process = openvpn_run
+    calls = mocker.MagicMock()
+    mocked_client = mocker.patch("connord.connect.management.ManagementClient")
+    calls.attach_mock(mocked_client.return_value.wait_connected, "wait_connected")
+    calls.attach_mock(
+        mocker.patch("connord.connect.iptables.apply_config_dir", return_value=True),
+        "apply_config_dir",
+    )
+
+    # run
+    actual_result = openvpn_command.run()
+
+    # assert
+    mocked_client.assert_called_once_with("/run/openvpn.sock")
+    assert [call[0] for call in calls.mock_calls] == [
+        "wait_connected",
+        "apply_config_dir",
+    ]
+    process.wait.assert_called_once_with()
+    assert actual_result
+
+
+def test_run_panics_when_openvpn_fails(mocker, openvpn_run):
+    openvpn_command, process = openvpn_run
+    mocked_client = mocker.patch("connord.connect.management.ManagementClient")
+    mocked_client.return_value.wait_connected.side_effect = (
+        connect.management.ManagementError("Authentication failed.")
+    )
+    mocked_apply = mocker.patch("connord.connect.iptables.apply_config_dir")
+
+    # run
+    with pytest.raises(connect.OpenvpnCommandPanic) as error:
+        openvpn_command.run()
+
+    # assert
+    assert error.value.problem == "Authentication failed."
+    process.kill.assert_called_once_with()
+    mocked_apply.assert_not_called()
+    mocked_client.return_value.close.assert_called_once_with()
+
+
+class FakeClient:
+    """Stands in for the management client of a racing openvpn. The domain in the
+    socket path selects how long it takes and whether it connects."""
+
+    behaviour = {}
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self, is_alive, timeout):
+        pass
+
+    def wait_connected(self, timeout):
+        domain = self.path.split("race-")[1].split(".sock")[0]
+        delay, succeeds = self.behaviour[domain]
+        time.sleep(delay)
+        if not succeeds:
+            raise connect.management.ManagementError("Openvpn is exiting.")
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def race(mocker, pinged_servers):
+    servers_ = pinged_servers[:3]
+    processes = []
+
+    def popen(*args, **kwargs):
+        process = mocker.MagicMock()
+        process.poll.return_value = None
+        processes.append(process)
+        return process
+
+    mocker.patch("connord.connect.subprocess.Popen", side_effect=popen)
+    mocker.patch.object(connect.OpenvpnCommand, "forge_ovpn_config")
+    mocker.patch("connord.connect.resources.get_config", return_value={"openvpn": {}})
+    mocker.patch(
+        "connord.connect.resources.get_stats_file",
+        side_effect=lambda name: "/run/{}".format(name),
+    )
+    mocker.patch("connord.connect.management.ManagementClient", FakeClient)
+    return servers_, processes
+
+
+def test_race_servers_returns_first_server_up(race):
+    servers_, processes = race
+    FakeClient.behaviour = {
+        servers_[0]["domain"]: (0.3, True),
+        servers_[1]["domain"]: (0.0, False),
+        servers_[2]["domain"]: (0.05, True),
+    }
+
+    # run
+    actual_result = connect.race_servers(servers_, "", "udp", 5)
+
+    # assert
+    assert actual_result is servers_[2]
+    assert len(processes) == 3
+    for process in processes:
+        process.terminate.assert_called_once_with()
+        process.wait.assert_called_once_with(timeout=5)
+
+
+def test_race_servers_when_no_server_connects(race):
+    servers_, processes = race
+    FakeClient.behaviour = {server["domain"]: (0.0, False) for server in servers_}
+
+    assert connect.race_servers(servers_, "", "udp", 5) is None
+    assert len(processes) == 3
+
+
+def test_race_servers_when_timeout_is_reached(race):
+    servers_, _ = race
+    FakeClient.behaviour = {server["domain"]: (0.3, True) for server in servers_}
+
+    assert connect.race_servers(servers_, "", "udp", 0.05) is None
+
+
+def test_forge_race(openvpn_command_no_options, mocker):
+    mocker.patch(
+        "connord.connect.resources.get_config",
+        return_value={
+            "openvpn": {
+                "daemon": True,
+                "auth-nocache": True,
+                "script-security": 2,
+                "scripts": [
+                    {"name": "up", "path": "/up", "stage": "up", "creates": "up.env"}
+                ],
+            }
+        },
+    )
+    mocker.patch.object(connect.OpenvpnCommand, "forge_ovpn_config")
+
+    openvpn_command_no_options.forge_race("/run/race.sock")
+
+    assert openvpn_command_no_options.cmd == [
+        "openvpn",
+        "--auth-nocache",
+        "--route-noexec",
+        "--ifconfig-noexec",
+        "--script-security",
+        "1",
+        "--management",
+        "/run/race.sock",
+        "unix",
+    ]
+
+
+def test_connect_tries_race_winner_first(mocker, pinged_servers):
+    best_servers = pinged_servers[:3]
+    for i, server in enumerate(best_servers):
+        server["ping"] = i + 1
+    mocker.patch("connord.connect.servers.get_server_table")
+    mocker.patch("connord.connect.filter_servers")
+    mocker.patch("connord.connect.filter_best_servers", return_value=best_servers)
+    mocker.patch(
+        "connord.connect.get_race_config",
+        return_value={"candidates": 2, "timeout": 5},
+    )
+    mocked_race = mocker.patch(
+        "connord.connect.race_servers", return_value=best_servers[1]
+    )
+    mocked_run = mocker.patch("connord.connect.run_openvpn", return_value=True)
+    mocker.patch("connord.connect.Printer")
+
+    # run
+    connect.connect(
+        ["best"], None, None, None, None, False, 10, "max", False, "", "udp"
+    )
+
+    # assert
+    mocked_race.assert_called_once_with(best_servers[:2], "", "udp", 5)
+    mocked_run.assert_called_once_with(best_servers[1], "", False, "udp")
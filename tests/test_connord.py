@@ -1,5 +1,9 @@
 #!/usr/bin/env python
 
+import os
+import subprocess
+import sys
+import pytest
 from connord import connord
 from tests.main_test_module import get_stub, MockBase
 
@@ -204,3 +208,94 @@ def test_main_provoking_not_implemented_error(mocker):
         assert False
     except NotImplementedError as error:
         assert str(error) == "Could not process command-line arguments."
+
+
+def test_main_when_connord_error_is_raised(mocker):
+    argv = ["connord", "update"]
+    mocker.patch.object(connord.sys, "argv", argv)
+    mocked_update = mocker.patch("connord.connord.update")
+    mocked_update.update.side_effect = connord.ConnordError("failed")
+    mocked_error = mocker.patch("connord.connord.Printer.error")
+
+    try:
+        connord.main()
+        assert False
+    except SystemExit as error:
+        assert error.code == 1
+
+    mocked_error.assert_called_once_with("failed")
+
+
+def test_main_when_daemon_asks(capsys, mocker):
+    argv = ["connord", "connect", "-s", "nl80"]
+    mocker.patch.object(connord.sys, "argv", argv)
+    mocked_stdin = mocker.patch.object(connord.sys, "stdin")
+    mocked_stdin.isatty.return_value = True
+    mocked_daemon = mocker.patch("connord.connord.daemon")
+    mocked_daemon.forward.side_effect = [
+        {"status": 1, "stdout": "", "stderr": "failed\n", "question": "Sure?"},
+        {"status": 0, "stdout": "connected\n", "stderr": ""},
+    ]
+    mocked_yes_no = mocker.patch("connord.connord.Printer.yes_no", return_value=True)
+
+    try:
+        connord.main()
+        assert False
+    except SystemExit as error:
+        assert error.code == 0
+
+    mocked_yes_no.assert_called_once_with("Sure?")
+    mocked_daemon.forward.assert_called_with(argv[1:], confirm=True)
+    captured = capsys.readouterr()
+    assert captured.out == "connected\n"
+    assert captured.err == ""
+
+
+def _get_import_times(argv=None):
+    """Return a dictionary of module name to self import time in microseconds of
+    a connord invocation with argv or of the bare interpreter if None"""
+    package_dir = os.path.dirname(os.path.dirname(connord.__file__))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [package_dir] + sys.path[1:] + [env.get("PYTHONPATH", "")]
+    )
+    code = "pass"
+    if argv is not None:
+        code = "import sys; sys.argv = {!r}; from connord.__main__ import main; main()"
+        code = code.format(["connord"] + argv)
+
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=False,
+    )
+
+    times = {}
+    for line in process.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            self_us, _, name = line[len("import time:") :].split("|")
+            if self_us.strip().isdigit():
+                times[name.strip()] = int(self_us)
+    return times
+
+
+# budget in seconds for the imports of a command on top of the interpreter startup
+STARTUP_BUDGET = 0.25
+SLOW_IMPORTS = ("iptc", "jinja2", "requests", "netaddr", "netifaces", "pkg_resources")
+
+
+@pytest.mark.parametrize("argv", [["version"], ["list", "countries"], ["-h"]])
+def test_startup_imports(argv):
+    baseline = _get_import_times()
+
+    # run
+    times = _get_import_times(argv)
+
+    # assert
+    assert "connord.__main__" in times
+    assert not [name for name in SLOW_IMPORTS if name in times]
+    spent = sum(time_ for name, time_ in times.items() if name not in baseline)
+    assert spent / 10 ** 6 < STARTUP_BUDGET
@@ -211,3 +211,17 @@ def test_print_countries():
         assert True
     except Exception:
         assert False
+
+
+def test_filter_servers_with_server_table():
+    from connord import servers
+
+    servers_ = get_servers_stub()
+    table = servers.to_table(servers_)
+
+    actual_servers = countries.filter_servers(table, ["NL", "us"])
+
+    expected_servers = get_expected_servers_by_domain(
+        ["nl80", "nl81", "nl82", "us-ca5", "us2853"]
+    )
+    assert list(actual_servers) == expected_servers
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+# pylint: disable=redefined-outer-name
+
+import os
+import socket
+import sys
+import threading
+import pytest
+from connord import ConnordError
+from connord import connord
+from connord import daemon
+from connord.printer import Printer
+
+
+class FakeExecute:
+    """Records the commands and prints the command name"""
+
+    def __init__(self):
+        self.args = []
+
+    def __call__(self, args):
+        self.args.append(args)
+        print("running {}".format(args.command))
+        if args.command == "kill":
+            print("failed", file=sys.stderr)
+            return 1
+        if args.command == "connect" and args.server == ["nl80"]:
+            # like connect to an obfuscated server and execute
+            try:
+                if not Printer().yes_no("nl80 is an obfuscated server."):
+                    return 0
+            except ConnordError as error:
+                Printer().error(str(error))
+                return 1
+        return 0
+
+
+@pytest.fixture
+def server(tmp_path, mocker):
+    path = str(tmp_path / "connord.sock")
+    execute = FakeExecute()
+    daemon_server = daemon.DaemonServer(path, connord.parse_args, execute)
+    mocker.patch("connord.daemon.format_status", return_value="Openvpn: running\n")
+    thread = threading.Thread(
+        target=daemon_server.serve_forever, kwargs={"poll_interval": 0.05}
+    )
+    thread.start()
+    yield daemon_server
+    daemon_server.shutdown()
+    daemon_server.server_close()
+    thread.join()
+
+
+def install_streams(server, mocker):
+    # pytest replaces the streams between setup and call
+    mocker.patch.object(sys, "stdout", server.stdout)
+    mocker.patch.object(sys, "stderr", server.stderr)
+
+
+def test_is_forwarded():
+    assert daemon.is_forwarded(connord.parse_args(["list", "countries"]))
+    assert daemon.is_forwarded(connord.parse_args(["-v", "connect", "-c", "de"]))
+    assert daemon.is_forwarded(connord.parse_args(["iptables", "reload"]))
+    assert daemon.is_forwarded(connord.parse_args(["status"]))
+    assert not daemon.is_forwarded(connord.parse_args(["iptables", "flush"]))
+    assert not daemon.is_forwarded(connord.parse_args(["update"]))
+    assert not daemon.is_forwarded(connord.parse_args(["daemon"]))
+
+
+def test_forward(server, mocker):
+    install_streams(server, mocker)
+
+    # run
+    response = daemon.forward(["list", "countries"], server.server_address, 5.0)
+
+    # assert
+    assert response == {"status": 0, "stdout": "running list\n", "stderr": ""}
+    assert server.execute.args[0].list_sub == "countries"
+
+    response = daemon.forward(["kill"], server.server_address, 5.0)
+    assert response == {"status": 1, "stdout": "running kill\n", "stderr": "failed\n"}
+
+
+def test_forward_when_command_is_status(server, mocker):
+    install_streams(server, mocker)
+
+    response = daemon.forward(["status"], server.server_address, 5.0)
+
+    assert response == {"status": 0, "stdout": "Openvpn: running\n", "stderr": ""}
+    assert server.execute.args == []
+
+
+def test_forward_when_command_is_connect(server, mocker):
+    install_streams(server, mocker)
+
+    response = daemon.forward(["connect", "-c", "de"], server.server_address, 5.0)
+
+    # openvpn is sent to the background to not block the daemon
+    assert response["status"] == 0
+    assert server.execute.args[0].daemon
+    assert server.since is not None
+
+
+def test_forward_when_arguments_are_invalid(server, mocker):
+    install_streams(server, mocker)
+
+    response = daemon.forward(["list", "invalid"], server.server_address, 5.0)
+
+    assert response["status"] == 2
+    assert "invalid choice" in response["stderr"]
+    assert server.execute.args == []
+
+
+def test_forward_when_daemon_is_not_running(tmp_path):
+    path = str(tmp_path / "connord.sock")
+
+    assert daemon.forward(["status"], path, 5.0) is None
+
+
+def test_forward_when_socket_is_default(server, mocker):
+    install_streams(server, mocker)
+    mocker.patch.dict(daemon.DAEMON_DEFAULTS, {"socket": server.server_address})
+    mocked_config = mocker.patch("connord.daemon.get_daemon_config")
+
+    # run
+    response = daemon.forward(["status"], timeout=5.0)
+
+    # assert
+    assert response["stdout"] == "Openvpn: running\n"
+    mocked_config.assert_not_called()
+
+
+def test_forward_when_socket_is_configured(server, tmp_path, mocker):
+    install_streams(server, mocker)
+    default_path = str(tmp_path / "default.sock")
+    mocker.patch.dict(daemon.DAEMON_DEFAULTS, {"socket": default_path})
+    mocked_config = mocker.patch("connord.daemon.get_daemon_config")
+    mocked_config.return_value = {"socket": server.server_address, "timeout": 5.0}
+
+    # run
+    response = daemon.forward(["status"])
+
+    # assert
+    assert response["stdout"] == "Openvpn: running\n"
+    mocked_config.assert_called_once_with()
+
+    # run
+    mocked_config.return_value = {"socket": default_path, "timeout": 5.0}
+    response = daemon.forward(["status"])
+
+    # assert
+    assert response is None
+
+
+def test_run_when_user_is_not_root(server, mocker):
+    install_streams(server, mocker)
+    response = server.run(["iptables", "reload"], uid=1000)
+
+    assert response["status"] == 1
+    assert "Permission Denied" in response["stderr"]
+    assert server.execute.args == []
+
+    response = server.run(["list", "countries"], uid=1000)
+    assert response == {"status": 0, "stdout": "running list\n", "stderr": ""}
+
+
+def test_forward_when_peer_is_not_root(server, mocker):
+    install_streams(server, mocker)
+    mocker.patch("connord.daemon.get_peer_uid", return_value=1000)
+
+    # the socket is open to every user
+    assert os.stat(server.server_address).st_mode & 0o777 == 0o666
+
+    response = daemon.forward(["list", "countries"], server.server_address, 5.0)
+    assert response == {"status": 0, "stdout": "running list\n", "stderr": ""}
+
+    response = daemon.forward(["connect", "-c", "de"], server.server_address, 5.0)
+    assert response["status"] == 1
+    assert "Permission Denied" in response["stderr"]
+    assert [args.command for args in server.execute.args] == ["list"]
+
+
+def test_forward_when_command_asks(server, mocker):
+    install_streams(server, mocker)
+    argv = ["connect", "-s", "nl80"]
+
+    # run
+    response = daemon.forward(argv, server.server_address, 5.0)
+
+    # assert
+    assert response["status"] == 1
+    assert response["question"] == "nl80 is an obfuscated server."
+    assert "Confirmation needed" in response["stderr"]
+
+    response = daemon.forward(argv, server.server_address, 5.0, confirm=True)
+    assert response == {"status": 0, "stdout": "running connect\n", "stderr": ""}
+    assert Printer().interactive
+
+
+def test_forward_when_command_raises(server, mocker):
+    install_streams(server, mocker)
+    server.execute = mocker.Mock(side_effect=ValueError("bogus is not a domain"))
+
+    response = daemon.forward(["connect", "-s", "de111"], server.server_address, 5.0)
+
+    assert response == {
+        "status": 1,
+        "stdout": "",
+        "stderr": "connord: bogus is not a domain\n",
+    }
+
+
+def test_run_when_command_is_not_forwarded(server):
+    response = server.run(["daemon"])
+
+    assert response["status"] == 1
+    assert server.execute.args == []
+
+
+def test_bad_request(server):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(server.server_address)
+        sock.sendall(b'{"argv": "status"}\n')
+        with sock.makefile("rb") as sock_fd:
+            response = sock_fd.readline()
+
+    assert b"Bad request" in response
+
+
+def test_remove_stale_socket(server, tmp_path):
+    with pytest.raises(daemon.DaemonError):
+        daemon._remove_stale_socket(server.server_address)
+
+    stale_path = str(tmp_path / "stale.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(stale_path)
+
+    daemon._remove_stale_socket(stale_path)
+    daemon._remove_stale_socket(stale_path)
+
+
+def test_format_status_when_stats_need_root(mocker):
+    mocker.patch("connord.daemon.read_pid", return_value=None)
+    mocker.patch("connord.daemon.resources.get_stats", side_effect=PermissionError)
+
+    actual_result = daemon.format_status()
+
+    assert actual_result == (
+        "Openvpn: not running\nServer:  None\nDaemon:  not running\n"
+    )
+
+
+def test_format_status(mocker):
+    mocker.patch("connord.daemon.read_pid", return_value=1234)
+    mocker.patch("connord.daemon.is_alive", return_value=True)
+    mocker.patch(
+        "connord.daemon.resources.get_stats",
+        return_value={
+            "last_server": {"domain": "de111.nordvpn.com", "protocol": "udp"}
+        },
+    )
+
+    actual_result = daemon.format_status()
+
+    assert actual_result == (
+        "Openvpn: running (pid 1234)\n"
+        "Server:  de111.nordvpn.com (udp)\n"
+        "Daemon:  not running\n"
+    )
@@ -250,3 +250,35 @@ def test_print_features():
         assert True
     except Exception:
         assert False
+
+
+def test_filter_servers_with_server_table():
+    from connord import servers
+
+    servers_ = get_servers_stub()
+    table = servers.to_table(servers_)
+
+    for features_ in (None, ["openvpn_xor_udp"], ["openvpn_udp", "socks"]):
+        expected_servers = features.filter_servers(servers_, features_)
+        actual_servers = features.filter_servers(table, features_)
+        assert list(actual_servers) == expected_servers
+
+
+def test_feature_bits_are_unique_and_cover_all_features():
+    assert set(features.FEATURE_BITS) == set(features.FEATURES)
+    assert len(set(features.FEATURE_BITS.values())) == len(features.FEATURE_BITS)
+
+
+def test_get_mask_and_decode_features():
+    mask = features.get_mask(["openvpn_udp", "socks"])
+
+    assert mask == features.FEATURE_BITS["openvpn_udp"] | features.FEATURE_BITS["socks"]
+    assert features.decode_features(mask) == ["openvpn_udp", "socks"]
+
+
+def test_get_server_mask_prefers_precomputed_mask():
+    server = {"features": {"openvpn_udp": True}, "features_mask": 0}
+
+    assert features.get_server_mask(server) == 0
+    del server["features_mask"]
+    assert features.get_server_mask(server) == features.FEATURE_BITS["openvpn_udp"]
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+# pylint: disable=redefined-outer-name
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+import pytest
+from connord import geocoding
+from main_test_module import get_json
+
+
+class StubNominatim(HTTPServer):
+    """Answers reverse queries with the location fixture. Fails the first
+    'failures' requests of every coordinate with 'status'."""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.location = get_json("location_rome_fixture.json")
+        self.failures = 0
+        self.status = 503
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=invalid-name
+        query = parse_qs(urlparse(self.path).query)
+        coordinate = (query["lat"][0], query["lon"][0])
+        with self.server.lock:
+            self.server.requests.append((time.monotonic(), coordinate))
+            count = sum(1 for _, c in self.server.requests if c == coordinate)
+
+        if count <= self.server.failures:
+            self.send_response(self.server.status)
+            self.end_headers()
+            return
+
+        body = json.dumps(self.server.location).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+@pytest.fixture
+def nominatim():
+    server = StubNominatim()
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def coordinates():
+    return [("50.1", "8.6"), ("52.3", "4.9"), ("38.7", "-77.4"), ("32.7", "-96.8")]
+
+
+def test_token_bucket_starts_at_rate():
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+
+    bucket = geocoding.TokenBucket(2.0, 1, clock=lambda: now[0], sleep=sleep)
+
+    # run
+    for _ in range(3):
+        bucket.acquire()
+
+    # assert
+    assert sleeps == [0.5, 1.0]
+
+
+def test_token_bucket_refills_up_to_capacity():
+    now = [0.0]
+    sleeps = []
+    bucket = geocoding.TokenBucket(1.0, 2, clock=lambda: now[0], sleep=sleeps.append)
+
+    # run
+    bucket.acquire()
+    bucket.acquire()
+    now[0] = 10.0
+    bucket.acquire()
+    bucket.acquire()
+    bucket.acquire()
+
+    # assert
+    assert sleeps == [1.0]
+
+
+def test_nominatim_backend(nominatim):
+    backend = geocoding.NominatimBackend(nominatim.url)
+
+    actual_result = backend.reverse("50.1", "8.6")
+
+    assert actual_result == nominatim.location
+    assert nominatim.requests[0][1] == ("50.1", "8.6")
+
+
+def test_nominatim_backend_when_server_is_busy(nominatim):
+    nominatim.failures = 1
+    nominatim.status = 429
+    backend = geocoding.NominatimBackend(nominatim.url)
+
+    with pytest.raises(geocoding.GeocodingError) as error:
+        backend.reverse("50.1", "8.6")
+
+    assert error.value.retry
+
+
+def test_nominatim_backend_when_request_is_bad(nominatim):
+    nominatim.failures = 1
+    nominatim.status = 400
+    backend = geocoding.NominatimBackend(nominatim.url)
+
+    with pytest.raises(geocoding.GeocodingError) as error:
+        backend.reverse("50.1", "8.6")
+
+    assert not error.value.retry
+
+
+def test_reverse_many_deduplicates_and_limits_rate(nominatim, coordinates):
+    backend = geocoding.NominatimBackend(nominatim.url)
+    done = []
+
+    # run
+    results, errors = geocoding.reverse_many(
+        coordinates * 2, backend, rate=20.0, callback=lambda: done.append(1)
+    )
+
+    # assert
+    assert errors == {}
+    assert set(results) == set(coordinates)
+    assert len(nominatim.requests) == len(coordinates)
+    assert len(done) == len(coordinates)
+    starts = sorted(start for start, _ in nominatim.requests)
+    assert starts[-1] - starts[0] >= (len(coordinates) - 1) / 20.0 * 0.9
+
+
+def test_reverse_many_retries(nominatim, coordinates):
+    nominatim.failures = 2
+    backend = geocoding.NominatimBackend(nominatim.url)
+
+    # run
+    results, errors = geocoding.reverse_many(
+        coordinates, backend, rate=100.0, retries=2, backoff=0.01
+    )
+
+    # assert
+    assert errors == {}
+    assert set(results) == set(coordinates)
+    assert len(nominatim.requests) == 3 * len(coordinates)
+
+
+def test_reverse_many_gives_up(nominatim, coordinates):
+    nominatim.failures = 5
+    backend = geocoding.NominatimBackend(nominatim.url)
+
+    # run
+    results, errors = geocoding.reverse_many(
+        coordinates[:1], backend, rate=100.0, retries=1, backoff=0.01
+    )
+
+    # assert
+    assert results == {}
+    assert errors[coordinates[0]].retry
+    assert len(nominatim.requests) == 2
+
+
+def test_snapshot_backend(tmp_path):
+    location = get_json("location_rome_fixture.json")
+    snapshot_file = tmp_path / "snapshot.json"
+    snapshot_file.write_text(json.dumps({"50.1,8.6": location}))
+    backend = geocoding.SnapshotBackend(str(snapshot_file))
+
+    # run
+    results, errors = geocoding.reverse_many([("50.1", "8.6"), ("0", "0")], backend)
+
+    # assert
+    assert results == {("50.1", "8.6"): location}
+    assert not errors[("0", "0")].retry
+
+
+def test_get_backend(tmp_path):
+    snapshot_file = tmp_path / "snapshot.json"
+    snapshot_file.write_text("{}")
+    config = dict(geocoding.GEOCODING_DEFAULTS)
+
+    assert isinstance(geocoding.get_backend(config), geocoding.NominatimBackend)
+
+    config.update(backend="snapshot", snapshot=str(snapshot_file))
+    assert isinstance(geocoding.get_backend(config), geocoding.SnapshotBackend)
+
+    config.update(snapshot=str(tmp_path / "missing.json"))
+    with pytest.raises(geocoding.GeocodingError):
+        geocoding.get_backend(config)
+
+    config.update(backend="unknown")
+    with pytest.raises(geocoding.GeocodingError):
+        geocoding.get_backend(config)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# pylint: disable=redefined-outer-name
+
+import math
+import sqlite3
+import pytest
+from connord import history
+from connord import sqlite
+
+
+@pytest.fixture
+def connection():
+    return sqlite3.connect(":memory:")
+
+
+@pytest.fixture
+def history_config():
+    return dict(history.HISTORY_DEFAULTS, alpha=0.5, keep=100)
+
+
+def _latency(median, jitter=0.0, loss=0.0):
+    return {
+        "min": median,
+        "median": median,
+        "p95": median,
+        "jitter": jitter,
+        "loss": loss,
+    }
+
+
+def test_moving_average_without_average():
+    latency = _latency(10.0)
+
+    actual_result = history.moving_average(None, latency, 0.5)
+
+    assert actual_result == {"median": 10.0, "p95": 10.0, "jitter": 0.0, "loss": 0.0}
+
+
+def test_moving_average():
+    average = {"median": 10.0, "p95": 20.0, "jitter": 2.0, "loss": 0.0}
+
+    actual_result = history.moving_average(average, _latency(30.0, 4.0, 1 / 3), 0.25)
+
+    assert actual_result == {
+        "median": 15.0,
+        "p95": 22.5,
+        "jitter": 2.5,
+        "loss": pytest.approx(1 / 12),
+    }
+
+
+def test_moving_average_when_server_did_not_answer():
+    average = {"median": 10.0, "p95": 20.0, "jitter": 2.0, "loss": 0.0}
+    latency = _latency(math.inf, math.inf, 1.0)
+
+    actual_result = history.moving_average(average, latency, 0.5)
+
+    assert actual_result == {"median": 10.0, "p95": 20.0, "jitter": 2.0, "loss": 0.5}
+
+
+def test_moving_average_when_server_answers_again():
+    average = {"median": math.inf, "p95": math.inf, "jitter": math.inf, "loss": 1.0}
+
+    actual_result = history.moving_average(average, _latency(10.0), 0.5)
+
+    assert actual_result == {"median": 10.0, "p95": 10.0, "jitter": 0.0, "loss": 0.5}
+
+
+def test_record_and_get_averages(mocker, connection, history_config):
+    mocker.patch("connord.history.time.time", return_value=1000.0)
+    servers_ = [
+        {"domain": "de1.nordvpn.com", "latency": _latency(10.0)},
+        {"domain": "de2.nordvpn.com", "latency": _latency(math.inf, math.inf, 1.0)},
+    ]
+
+    # run
+    history.record(connection, servers_, history_config, timestamp=900.0)
+    servers_[0]["latency"] = _latency(20.0)
+    history.record(connection, servers_, history_config, timestamp=950.0)
+    actual_result = history.get_averages(connection, max_age=100)
+
+    # assert
+    assert actual_result == {
+        "de1.nordvpn.com": {
+            "updated": 950.0,
+            "median": 15.0,
+            "p95": 15.0,
+            "jitter": 0.0,
+            "loss": 0.0,
+        },
+        "de2.nordvpn.com": {
+            "updated": 950.0,
+            "median": math.inf,
+            "p95": math.inf,
+            "jitter": math.inf,
+            "loss": 1.0,
+        },
+    }
+    rows = connection.execute("SELECT COUNT(*) FROM latencies").fetchone()
+    assert rows[0] == 4
+
+
+def test_get_averages_ignores_old_averages(mocker, connection, history_config):
+    mocker.patch("connord.history.time.time", return_value=1000.0)
+    servers_ = [{"domain": "de1.nordvpn.com", "latency": _latency(10.0)}]
+    history.record(connection, servers_, history_config, timestamp=800.0)
+
+    assert history.get_averages(connection, max_age=100) == {}
+
+
+def test_record_deletes_old_latencies(connection, history_config):
+    servers_ = [{"domain": "de1.nordvpn.com", "latency": _latency(10.0)}]
+
+    # run
+    history.record(connection, servers_, history_config, timestamp=800.0)
+    history.record(connection, servers_, history_config, timestamp=1000.0)
+
+    # assert
+    rows = connection.execute("SELECT timestamp FROM latencies").fetchall()
+    assert rows == [(1000.0,)]
+
+
+def test_record_when_database_fails(mocker, connection, history_config):
+    mocker.patch(
+        "connord.history.sqlite.create_latencies",
+        side_effect=sqlite.SqliteError("error"),
+    )
+    servers_ = [{"domain": "de1.nordvpn.com", "latency": _latency(10.0)}]
+
+    with pytest.raises(sqlite.SqliteError):
+        history.record(connection, servers_, history_config)
@@ -6,6 +6,8 @@
 # 'connord.iptables.user.needs_root', lambda *x, **y: lambda f: f)
 
 # from connord import user
+import os
+import pytest
 from main_test_module import get_expected_servers_by_domain
 
 
@@ -288,11 +290,9 @@ def test_apply_config_good(mocker):
     }
     config_file = "tests/fixtures/iptables.filter.yml"
     mocked_init_table = mocker.patch("connord.iptables.init_table_from_file_name")
-    mocked_table = mocker.Mock()
-    mocked_init_table.return_value(mocked_table)
+    mocked_table = mocked_init_table.return_value
+    mocked_table.is_chain.return_value = False
     mocked_iptc = mocker.patch("connord.iptables.iptc")
-    mocked_iptc.easy.flush_table.return_value = True
-    mocked_iptc.easy.has_chain.return_value = False
     mocked_is_table_v6 = mocker.patch("connord.iptables.is_table_v6")
     mocked_is_table_v6.return_value = False
     mocked_read_config = mocker.patch("connord.iptables.read_config")
@@ -304,15 +304,14 @@ def test_apply_config_good(mocker):
     iptables.apply_config(config_file, None, None)
 
     mocked_init_table.assert_called_once_with(config_file)
-    mocked_iptc.easy.flush_table.assert_called_once()
-    mocked_is_table_v6.assert_called_once()
-    # mocked_iptc.Chain.assert_called()
-    mocked_iptc.easy.has_chain.assert_called()
-    mocked_iptc.easy.add_chain.assert_called()
+    mocked_table.create_chain.assert_called()
     mocked_iptc.Policy.assert_called()
-    mocked_iptc.easy.set_policy.assert_called()
+    mocked_iptc.Chain.return_value.set_policy.assert_called()
     mocked_iptc.easy.test_rule.assert_called()
-    mocked_iptc.easy.add_rule.assert_called()
+    assert mocked_iptc.Chain.return_value.insert_rule.call_count == 7
+    mocked_iptc.easy.add_rule.assert_not_called()
+    mocked_table.commit.assert_called_once()
+    assert mocked_table.autocommit is True
 
 
 def test_apply_config_bad(mocker):
@@ -340,11 +339,9 @@ def test_apply_config_bad(mocker):
     }
     config_file = "tests/fixtures/iptables.filter.yml"
     mocked_init_table = mocker.patch("connord.iptables.init_table_from_file_name")
-    mocked_table = mocker.Mock()
-    mocked_init_table.return_value(mocked_table)
+    mocked_table = mocked_init_table.return_value
+    mocked_table.is_chain.return_value = False
     mocked_iptc = mocker.patch("connord.iptables.iptc")
-    mocked_iptc.easy.flush_table.return_value = True
-    mocked_iptc.easy.has_chain.return_value = False
     mocked_is_table_v6 = mocker.patch("connord.iptables.is_table_v6")
     mocked_is_table_v6.return_value = False
     mocked_iptc.easy.test_rule.return_value = False
@@ -361,15 +358,213 @@ def test_apply_config_bad(mocker):
         assert True
 
     mocked_init_table.assert_called_once_with(config_file)
-    mocked_iptc.easy.flush_table.assert_called_once()
-    mocked_is_table_v6.assert_called_once()
-    # mocked_iptc.Chain.assert_called()
-    mocked_iptc.easy.has_chain.assert_called()
-    mocked_iptc.easy.add_chain.assert_called()
-    mocked_iptc.Policy.assert_called()
-    mocked_iptc.easy.set_policy.assert_called()
     mocked_iptc.easy.test_rule.assert_called()
-    mocked_iptc.easy.add_rule.assert_not_called()
+    mocked_iptc.Chain.return_value.insert_rule.assert_not_called()
+    # the rules are validated before the table is touched
+    assert mocked_table.method_calls == []
+
+
+class FakePolicy:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeChain:
+    def __init__(self, table, name, rules=(), builtin=False, policy="ACCEPT"):
+        self.table = table
+        self.name = name
+        self._rules = list(rules)
+        self.builtin = builtin
+        self.policy = FakePolicy(policy)
+
+    @property
+    def rules(self):
+        return list(self._rules)
+
+    def is_builtin(self):
+        return self.builtin
+
+    def get_policy(self):
+        return self.policy
+
+    def set_policy(self, policy):
+        self.table.ops.append(("set_policy", self.name, policy.name))
+        self.policy = policy
+
+    def append_rule(self, rule):
+        self.table.ops.append(("append_rule", self.name, rule))
+        self._rules.append(rule)
+
+    def insert_rule(self, rule, position):
+        self.table.ops.append(("insert_rule", self.name, rule, position))
+        self._rules.insert(position, rule)
+
+    def replace_rule(self, rule, position):
+        self.table.ops.append(("replace_rule", self.name, rule, position))
+        self._rules[position] = rule
+
+    def delete_rule(self, rule):
+        self.table.ops.append(("delete_rule", self.name, rule))
+        self._rules.remove(rule)
+
+    def flush(self):
+        self.table.ops.append(("flush", self.name))
+        self._rules = []
+
+    def delete(self):
+        self.table.ops.append(("delete", self.name))
+        del self.table.chain_d[self.name]
+
+
+class FakeTable:
+    """Table with chains mapping names to (rules, policy). Rules are strings and
+    chains with upper case names are builtin."""
+
+    def __init__(self, chains):
+        self.name = "filter"
+        self.autocommit = True
+        self.committed = 0
+        self.ops = []
+        self.chain_d = {}
+        for chain_s, (rules, policy) in chains.items():
+            self.chain_d[chain_s] = FakeChain(
+                self, chain_s, rules, chain_s.isupper(), policy
+            )
+
+    @property
+    def chains(self):
+        return list(self.chain_d.values())
+
+    def is_chain(self, chain_s):
+        return chain_s in self.chain_d
+
+    def create_chain(self, chain_s):
+        self.ops.append(("create_chain", chain_s))
+        self.chain_d[chain_s] = FakeChain(self, chain_s)
+
+    def refresh(self):
+        pass
+
+    def commit(self):
+        self.committed += 1
+
+    def state(self):
+        return {chain.name: (chain.rules, chain.policy.name) for chain in self.chains}
+
+
+def set_up_fake_iptc(mocker):
+    mocked_iptc = mocker.patch("connord.iptables.iptc")
+    mocked_iptc.Chain.side_effect = lambda table, chain_s: table.chain_d[chain_s]
+    mocked_iptc.Policy.side_effect = FakePolicy
+    mocked_iptc.easy.test_rule.return_value = True
+    mocked_iptc.easy.encode_iptc_rule.side_effect = lambda rule_d, ipv6: rule_d["r"]
+    mocker.patch("connord.iptables.is_table_v6", return_value=False)
+    return mocked_iptc
+
+
+def to_config(chains):
+    return {
+        chain_s: {"policy": policy, "rules": [{"r": rule} for rule in rules]}
+        for chain_s, (rules, policy) in chains.items()
+    }
+
+
+def test_commit_config_when_one_rule_changed(mocker):
+    set_up_fake_iptc(mocker)
+    table = FakeTable(
+        {
+            "INPUT": (["lo", "vpn", "lan"], "DROP"),
+            "OUTPUT": (["established", "remote 1.1.1.1", "lan"], "DROP"),
+            "connord-vpn": (["accept"], "ACCEPT"),
+        }
+    )
+    wanted = {
+        "INPUT": (["lo", "vpn", "lan"], "DROP"),
+        "OUTPUT": (["established", "remote 2.2.2.2", "lan"], "DROP"),
+        "connord-vpn": (["accept"], "None"),
+    }
+
+    from connord import iptables
+
+    changes = iptables.commit_config(table, to_config(wanted))
+
+    assert changes == 1
+    assert table.ops == [("replace_rule", "OUTPUT", "remote 2.2.2.2", 1)]
+    assert table.committed == 1
+    assert table.autocommit is True
+
+
+def test_commit_config_when_nothing_changed(mocker):
+    set_up_fake_iptc(mocker)
+    table = FakeTable({"INPUT": (["lo"], "DROP"), "connord-vpn": (["accept"], "ACCEPT")})
+    wanted = {"INPUT": (["lo"], "DROP"), "connord-vpn": (["accept"], "None")}
+
+    from connord import iptables
+
+    changes = iptables.commit_config(table, to_config(wanted))
+
+    assert changes == 0
+    assert table.ops == []
+    assert table.committed == 0
+
+
+def test_commit_config_inserts_and_deletes_by_position(mocker):
+    set_up_fake_iptc(mocker)
+    table = FakeTable(
+        {"INPUT": (["a", "b", "c"], "DROP"), "OUTPUT": (["a", "b", "c", "d"], "DROP")}
+    )
+    wanted = {
+        "INPUT": (["a", "x", "y", "b", "c"], "DROP"),
+        "OUTPUT": (["a", "d"], "DROP"),
+    }
+
+    from connord import iptables
+
+    changes = iptables.commit_config(table, to_config(wanted))
+
+    assert table.state() == wanted
+    assert changes == 4
+    assert ("insert_rule", "INPUT", "x", 1) in table.ops
+
+
+def test_commit_config_when_deleted_rule_has_duplicate(mocker):
+    set_up_fake_iptc(mocker)
+    table = FakeTable({"INPUT": (["x", "y", "x"], "DROP")})
+    wanted = {"INPUT": (["x", "y"], "DROP")}
+
+    from connord import iptables
+
+    iptables.commit_config(table, to_config(wanted))
+
+    # deleting 'x' would remove the first one, so the chain is rebuilt
+    assert table.state() == wanted
+    assert ("flush", "INPUT") in table.ops
+
+
+def test_commit_config_chains_and_policies(mocker):
+    set_up_fake_iptc(mocker)
+    table = FakeTable(
+        {
+            "INPUT": (["old", "jump connord-old"], "DROP"),
+            "FORWARD": (["forward"], "DROP"),
+            "connord-old": (["accept"], "ACCEPT"),
+        }
+    )
+    config_d = to_config({"INPUT": (["new", "jump connord-new"], "DROP")})
+    config_d["connord-new"] = {"rules": [{"r": "accept"}]}
+
+    from connord import iptables
+
+    iptables.commit_config(table, config_d)
+
+    assert table.state() == {
+        "INPUT": (["new", "jump connord-new"], "DROP"),
+        "FORWARD": ([], "ACCEPT"),
+        "connord-new": (["accept"], "ACCEPT"),
+    }
+    assert table.ops.index(("replace_rule", "INPUT", "jump connord-new", 1)) < (
+        table.ops.index(("delete", "connord-old"))
+    )
 
 
 def test_is_table_v6(mocker):
@@ -382,24 +577,157 @@ def test_is_table_v6(mocker):
     assert not retval
 
 
-def test_apply_config_dir_when_apply_config_bad(mocker):
-    config_files = ["testing", "config"]
-    config_dir = "testdir"
+def test_apply_config_dir_when_config_is_bad(mocker):
+    config_files = ["01-filter.rules", "02-nat.rules"]
 
     mocked_find = mocker.patch("connord.iptables.resources.list_config_dir")
     mocked_find.return_value = config_files
-    mocked_apply = mocker.patch("connord.iptables.apply_config")
-    mocked_apply.return_value = False
+    mocker.patch("connord.iptables.init_table_from_file_name")
+    mocker.patch("connord.iptables.get_render_context")
+    mocked_read_config = mocker.patch("connord.iptables.read_config")
+    mocked_commit = mocker.patch("connord.iptables.commit_config")
 
     set_up(mocker)
     from connord import iptables
 
-    retval = iptables.apply_config_dir(None, None)
+    mocked_read_config.side_effect = [{}, iptables.IptablesError("bad")]
+
+    try:
+        iptables.apply_config_dir(None, None)
+        assert False
+    except iptables.IptablesError:
+        assert True
 
     mocked_find.assert_called_once_with(filetype="rules")
-    mocked_apply.assert_called()
-    assert not retval
+    # all files are rendered before any table is touched
+    mocked_commit.assert_not_called()
+
+
+def test_apply_config_dir_when_rule_is_malformed(mocker):
+    mocked_iptc = set_up_fake_iptc(mocker)
+    mocked_iptc.easy.test_rule.side_effect = lambda rule_d, ipv6: rule_d["r"] != "bad"
+    filter_table = FakeTable({"INPUT": (["lo"], "ACCEPT")})
+    nat_table = FakeTable({"POSTROUTING": ([], "ACCEPT")})
+    mocker.patch(
+        "connord.iptables.compile_config_dir",
+        return_value=[
+            (filter_table, "01-filter.rules", to_config({"INPUT": (["vpn"], "DROP")})),
+            (nat_table, "02-nat.rules", to_config({"POSTROUTING": (["bad"], "None")})),
+        ],
+    )
+    set_up(mocker)
+
+    from connord import iptables
+
+    with pytest.raises(iptables.IptablesError):
+        iptables.apply_config_dir(None, None)
+
+    # the rules of all files are validated before the first table changes
+    assert filter_table.ops == []
+    assert filter_table.committed == 0
+    assert nat_table.committed == 0
+
+
+def test_apply_config_dir_when_config_is_good(mocker):
+    config_files = ["01-filter.rules", "02-nat.rules"]
+
+    mocked_find = mocker.patch("connord.iptables.resources.list_config_dir")
+    mocked_find.return_value = config_files
+    mocked_init_table = mocker.patch("connord.iptables.init_table_from_file_name")
+    mocked_context = mocker.patch("connord.iptables.get_render_context")
+    mocked_read_config = mocker.patch("connord.iptables.read_config")
+    mocked_read_config.return_value = {}
+    mocked_commit = mocker.patch("connord.iptables.commit_config")
+
+    set_up(mocker)
+    from connord import iptables
+
+    retval = iptables.apply_config_dir(None, None, filetype="fallback")
+
+    mocked_find.assert_called_once_with(filetype="fallback")
+    # the render context is built once and shared by all files
+    mocked_context.assert_called_once_with(None, None)
+    mocked_read_config.assert_called_with(
+        "02-nat.rules", None, None, mocked_context.return_value
+    )
+    assert mocked_commit.call_count == 2
+    mocked_commit.assert_called_with(mocked_init_table.return_value, {}, {})
+    assert retval
+
+
+def test_reset_when_fallback_is_true(mocker):
+    mocked_table = mocker.Mock()
+    mocked_table.name = "filter"
+    mocked_compile = mocker.patch("connord.iptables.compile_config_dir")
+    mocked_compile.return_value = [(mocked_table, "01-filter.fallback", {})]
+    mocker.patch("connord.iptables.is_table_v6", return_value=False)
+    mocked_iptc = mocker.patch("connord.iptables.iptc")
+    mocked_iptc.easy.get_tables.return_value = ["filter", "nat"]
+    mocked_init_table = mocker.patch("connord.iptables.init_table")
+    mocked_commit = mocker.patch("connord.iptables.commit_config")
+
+    set_up(mocker)
+    from connord import iptables
+
+    iptables.reset(fallback=True)
+
+    mocked_compile.assert_called_once_with(filetype="fallback")
+    # the filter table switches to the fallback without being flushed first
+    assert mocker.call("filter") not in mocked_init_table.call_args_list
+    mocked_init_table.assert_any_call("nat")
+    mocked_init_table.assert_any_call("filter6")
+    mocked_commit.assert_any_call(mocked_table, {}, {})
+
+
+@pytest.fixture
+def templates(tmp_path, mocker):
+    config_file = tmp_path / "config.yml"
+    config_file.write_text("lan_iface: eth0\n")
+    rules_file = tmp_path / "01-filter.rules"
+    rules_file.write_text(
+        "OUTPUT:\n  policy: DROP\n  rules:\n"
+        "    - dst: '{{ vpn_remote }}'\n      out-interface: '{{ lan_iface }}'\n"
+    )
+    mocker.patch(
+        "connord.iptables.resources.get_config_file", return_value=str(config_file)
+    )
+    mocker.patch("connord.iptables.get_default_gateway", return_value=(None, None))
+    mocker.patch("connord.iptables.merge_environment", side_effect=lambda d: d)
+    set_up(mocker)
+
+    from connord import iptables
+
+    iptables.clear_cache()
+    yield rules_file
+    iptables.clear_cache()
+
+
+def test_read_config(templates, mocker):
+    from connord import iptables
+
+    mocked_render = mocker.spy(iptables, "render_template")
+    server = {"ip_address": "1.2.3.4"}
+    expected_result = {
+        "OUTPUT": {
+            "policy": "DROP",
+            "rules": [{"dst": "1.2.3.4", "out-interface": "eth0"}],
+        }
+    }
+
+    # run
+    actual_result = iptables.read_config(str(templates), server, "udp")
+    actual_result["OUTPUT"]["rules"].clear()
+    cached_result = iptables.read_config(str(templates), server, "udp")
+
+    # assert
+    assert cached_result == expected_result
+    assert mocked_render.call_count == 1
 
+    iptables.read_config(str(templates), {"ip_address": "5.6.7.8"}, "udp")
+    assert mocked_render.call_count == 2
 
-def test_read_config():
-    pass
+    templates.write_text("INPUT:\n  policy: DROP\n  rules: []\n")
+    os.utime(str(templates), ns=(0, 0))
+    actual_result = iptables.read_config(str(templates), server, "udp")
+    assert actual_result == {"INPUT": {"policy": "DROP", "rules": []}}
+    assert mocked_render.call_count == 3
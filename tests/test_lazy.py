@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+import sys
+from connord.lazy import lazy_import
+
+
+def test_lazy_import_imports_on_first_access(mocker):
+    mocker.patch.dict(sys.modules)
+    sys.modules.pop("colorsys", None)
+
+    # run
+    colorsys = lazy_import("colorsys")
+
+    # assert
+    assert "colorsys" not in sys.modules
+    assert colorsys.rgb_to_hsv(0.0, 0.0, 0.0) == (0.0, 0.0, 0.0)
+    assert "colorsys" in sys.modules
+
+
+def test_lazy_import_when_attribute_is_patched(mocker):
+    lazy_json = lazy_import("json")
+
+    mocked_dumps = mocker.patch.object(lazy_json, "dumps", return_value="mocked")
+
+    assert lazy_json.dumps({}) == "mocked"
+    mocked_dumps.assert_called_once_with({})
+    assert sys.modules["json"].dumps is not mocked_dumps
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from connord import listings
+from connord import servers
 from tests.main_test_module import get_stub, get_servers_stub
 
 
@@ -18,13 +19,13 @@ def test_listings_when_every_option_is_given_and_countries_is_none(capsys, mocke
     servers_ = get_servers_stub()
 
     mocked_servers = mocker.patch("connord.listings.servers")
-    mocked_servers.get_servers.return_value = servers_
+    mocked_servers.get_server_table.return_value = servers.to_table(servers_)
     mocked_servers.to_string.return_value = "testing"
 
     listings.list_servers(None, None, None, None, False, 10, "max", 10)
     captured = capsys.readouterr()
 
-    mocked_servers.get_servers.assert_called_once()
+    mocked_servers.get_server_table.assert_called_once()
     mocked_servers.to_string.assert_called_once()
     assert captured.out == ""
     assert captured.err == ""
@@ -34,12 +35,12 @@ def test_listings_when_every_option_is_given_and_countries_is_empty(capsys, mock
     servers_ = get_servers_stub()
 
     mocked_servers = mocker.patch("connord.listings.servers")
-    mocked_servers.get_servers.return_value = servers_
+    mocked_servers.get_server_table.return_value = servers.to_table(servers_)
 
     listings.list_servers(list(), None, None, None, True, 10, "max", 10)
     captured = capsys.readouterr()
 
-    mocked_servers.get_servers.assert_called_once()
+    mocked_servers.get_server_table.assert_called_once()
     mocked_servers.to_string.assert_called_once()
     assert captured.out == ""
     assert captured.err == ""
@@ -49,14 +50,28 @@ def test_listings_when_every_option_is_given_with_categories_features(capsys, mo
     servers_ = get_servers_stub()
 
     mocked_servers = mocker.patch("connord.listings.servers")
-    mocked_servers.get_servers.return_value = servers_
+    mocked_servers.get_server_table.return_value = servers.to_table(servers_)
 
     categories_ = ["standard"]
     features_ = ["openvpn_udp"]
     listings.list_servers(list(), None, categories_, features_, True, 10, "max", 10)
     captured = capsys.readouterr()
 
-    mocked_servers.get_servers.assert_called_once()
+    mocked_servers.get_server_table.assert_called_once()
     mocked_servers.to_string.assert_called_once()
     assert captured.out == ""
     assert captured.err == ""
+
+
+def test_filter_servers_with_server_table():
+    servers_ = get_servers_stub()
+    table = servers.to_table(servers_)
+
+    expected_servers = listings.filter_servers(
+        servers_, False, ["de"], None, ["openvpn_udp"], ["p2p"], 90, "max", 2
+    )
+    actual_servers = listings.filter_servers(
+        table, False, ["de"], None, ["openvpn_udp"], ["p2p"], 90, "max", 2
+    )
+
+    assert list(actual_servers) == expected_servers
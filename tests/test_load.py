@@ -194,3 +194,15 @@ def test_filter_servers_when_match_is_invalid():
         assert False
     except ValueError as error:
         assert str(error) == 'Match must be one of "exact","max" or "min".'
+
+
+def test_filter_servers_with_server_table():
+    from connord import servers
+
+    servers_ = get_servers_stub()
+    table = servers.to_table(servers_)
+
+    for match in ("exact", "max", "min"):
+        expected_servers = filter_servers(servers_, 25, match)
+        actual_servers = filter_servers(table, 25, match)
+        assert list(actual_servers) == expected_servers
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+# pylint: disable=redefined-outer-name
+
+import socket
+import threading
+import pytest
+from connord import management
+
+
+class FakeOpenvpn:
+    """Serves the management interface on a unix socket. Answers the 'state'
+    command with 'state' and sends the lines of 'notifications' after that."""
+
+    def __init__(self, path):
+        self.path = path
+        self.state = "1561975600,WAIT,,,"
+        self.notifications = []
+        self.commands = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.thread = None
+
+    def start(self):
+        self.server.bind(self.path)
+        self.server.listen(1)
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        conn, _ = self.server.accept()
+        with conn:
+            conn.sendall(b">INFO:OpenVPN Management Interface Version 1\r\n")
+            reader = conn.makefile("r")
+            for line in reader:
+                command = line.strip()
+                self.commands.append(command)
+                if command == "state on":
+                    conn.sendall(b"SUCCESS: real-time state notification set to ON\r\n")
+                elif command == "state":
+                    conn.sendall("{}\r\nEND\r\n".format(self.state).encode())
+                    for notification in self.notifications:
+                        conn.sendall(notification.encode() + b"\r\n")
+                    if self.notifications == ["close"]:
+                        return
+
+    def stop(self):
+        self.server.close()
+
+
+@pytest.fixture
+def openvpn(tmp_path):
+    fake = FakeOpenvpn(str(tmp_path / "openvpn.sock"))
+    yield fake
+    fake.stop()
+
+
+def test_parse_state():
+    assert management.parse_state(">STATE:1561975612,CONNECTED,SUCCESS,10.8.0.2") == (
+        "CONNECTED"
+    )
+    assert management.parse_state("1561975612,WAIT,,,") == "WAIT"
+    assert management.parse_state("END") is None
+    assert management.parse_state(">INFO:OpenVPN Management Interface") is None
+
+
+def test_wait_connected_on_notification(openvpn):
+    openvpn.notifications = [
+        ">STATE:1561975601,AUTH,,,",
+        ">STATE:1561975602,CONNECTED,SUCCESS,10.8.0.2,1.2.3.4",
+    ]
+    openvpn.start()
+    client = management.ManagementClient(openvpn.path)
+
+    # run
+    client.connect(lambda: True, 1)
+    client.wait_connected(1)
+    client.close()
+
+    # assert
+    assert openvpn.commands[:2] == ["state on", "state"]
+
+
+def test_wait_connected_when_already_connected(openvpn):
+    openvpn.state = "1561975602,CONNECTED,SUCCESS,10.8.0.2,1.2.3.4"
+    openvpn.start()
+    client = management.ManagementClient(openvpn.path)
+
+    client.connect(lambda: True, 1)
+    client.wait_connected(1)
+    client.close()
+
+
+@pytest.mark.parametrize(
+    "notification,message",
+    [
+        (">FATAL:Cannot open TUN/TAP dev", "Cannot open TUN/TAP dev"),
+        (">PASSWORD:Verification Failed: 'Auth'", "Authentication failed."),
+        (">STATE:1561975602,EXITING,SIGTERM,,", "Openvpn is exiting."),
+        ("close", "Openvpn process stopped unexpected."),
+    ],
+)
+def test_wait_connected_when_openvpn_fails(openvpn, notification, message):
+    openvpn.notifications = [notification]
+    openvpn.start()
+    client = management.ManagementClient(openvpn.path)
+    client.connect(lambda: True, 1)
+
+    with pytest.raises(management.ManagementError) as error:
+        client.wait_connected(1)
+
+    client.close()
+    assert str(error.value) == message
+
+
+def test_wait_connected_when_timeout_is_reached(openvpn):
+    openvpn.start()
+    client = management.ManagementClient(openvpn.path)
+    client.connect(lambda: True, 1)
+
+    with pytest.raises(management.ManagementError) as error:
+        client.wait_connected(0.1)
+
+    client.close()
+    assert str(error.value) == "Timeout reached."
+
+
+def test_connect_when_openvpn_stopped(tmp_path):
+    client = management.ManagementClient(str(tmp_path / "openvpn.sock"))
+
+    with pytest.raises(management.ManagementError) as error:
+        client.connect(lambda: False, 1)
+
+    assert str(error.value) == "Openvpn process stopped unexpected."
+
+
+def test_connect_when_socket_is_created_late(openvpn):
+    timer = threading.Timer(0.05, openvpn.start)
+    timer.start()
+    client = management.ManagementClient(openvpn.path)
+
+    client.connect(lambda: True, 1)
+
+    assert client.read_line(1).startswith(">INFO:")
+    client.close()
+    timer.join()
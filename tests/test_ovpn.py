@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# pylint: disable=redefined-outer-name
+
+from zipfile import ZipFile
+import pytest
+from connord import archives
+from connord import ovpn
+
+CONFIG = """client
+dev tun
+proto udp
+remote {ip_address} 1194
+remote-random
+verify-x509-name CN={domain}
+<ca>
+-----BEGIN CERTIFICATE-----
+MIIFCjCCAvKgAwIBAgIBATANBgkqhkiG9w0BAQ0FADA5MQswCQYDVQQGEwJQQTEQ
+-----END CERTIFICATE-----
+</ca>
+"""
+
+
+def make_config(server):
+    return CONFIG.format(**server)
+
+
+def make_server(i):
+    return {"domain": "de{}.nordvpn.com".format(i), "ip_address": "10.0.0.{}".format(i)}
+
+
+@pytest.fixture
+def write_archive(tmp_path):
+    def _write_archive(configs):
+        zip_file = str(tmp_path / "ovpn.zip")
+        with ZipFile(zip_file, "w") as zip_stream:
+            for name, config in configs.items():
+                zip_stream.writestr(name, config)
+        archives.clear_cache()
+        return zip_file
+
+    return _write_archive
+
+
+def test_make_template_and_render():
+    server = make_server(1)
+    config = make_config(server).replace("client", "client $HOME")
+
+    # run
+    template = ovpn.make_template(config, server)
+
+    # assert
+    assert "10.0.0.1" not in template
+    assert "de1.nordvpn.com" not in template
+    other = make_server(11)
+    assert ovpn.render(template, other) == make_config(other).replace(
+        "client", "client $HOME"
+    )
+
+
+def test_make_template_when_ip_address_not_in_config():
+    with pytest.raises(ValueError):
+        ovpn.make_template("client\n", make_server(1))
+
+
+def test_build_template(write_archive):
+    zip_file = write_archive(
+        {
+            "ovpn_udp/{}.udp.ovpn".format(server["domain"]): make_config(server)
+            for server in map(make_server, range(1, 30))
+        }
+    )
+
+    # run
+    template = ovpn.build_template(zip_file, "udp")
+
+    # assert
+    server = make_server(100)
+    assert ovpn.render(template, server) == make_config(server)
+    assert ovpn.build_template(zip_file, "tcp") is None
+
+
+def test_build_template_when_configs_differ(write_archive):
+    configs = {
+        "ovpn_udp/{}.udp.ovpn".format(server["domain"]): make_config(server)
+        for server in map(make_server, range(1, 3))
+    }
+    configs["ovpn_udp/de2.nordvpn.com.udp.ovpn"] += "tls-auth\n"
+    zip_file = write_archive(configs)
+
+    assert ovpn.build_template(zip_file, "udp", samples=2) is None
+
+
+def test_find_mismatches(write_archive):
+    configs = {
+        "ovpn_udp/{}.udp.ovpn".format(server["domain"]): make_config(server)
+        for server in map(make_server, range(1, 30))
+    }
+    configs["ovpn_udp/de2.nordvpn.com.udp.ovpn"] += "tls-auth\n"
+    configs["ovpn_udp/de3.nordvpn.com.udp.ovpn"] = "client\n"
+    zip_file = write_archive(configs)
+    template = ovpn.build_template(zip_file, "udp", samples=1)
+
+    # run
+    actual_mismatches = ovpn.find_mismatches(zip_file, "udp", template)
+
+    # assert
+    assert actual_mismatches == {"de2.nordvpn.com", "de3.nordvpn.com"}
+    assert ovpn.find_mismatches(zip_file, "tcp", template) == set()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+# pylint: disable=redefined-outer-name
+
+import math
+import socket
+import struct
+import time
+import pytest
+from connord import probe
+
+
+@pytest.fixture
+def listening_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(16)
+    yield sock.getsockname()[1]
+    sock.close()
+
+
+@pytest.fixture
+def closed_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_checksum_of_echo_request_verifies():
+    packet = probe._icmp_echo_request(0x1234, 7)
+
+    assert probe._checksum(packet) == 0
+    assert struct.unpack("!BBHHH", packet[:8])[3:] == (0x1234, 7)
+
+
+def test_probe_tcp_when_port_is_open(listening_port):
+    actual_result = probe.probe(["127.0.0.1"], method="tcp", port=listening_port)
+
+    assert list(actual_result) == ["127.0.0.1"]
+    assert 0 <= actual_result["127.0.0.1"] < 1000
+
+
+def test_probe_tcp_counts_refused_connections_as_answer(closed_port):
+    actual_result = probe.probe(["127.0.0.1"], method="tcp", port=closed_port)
+
+    assert actual_result["127.0.0.1"] < math.inf
+
+
+def test_probe_tcp_when_host_does_not_answer(mocker):
+    async def never_connect(*args, **kwargs):
+        await probe.asyncio.sleep(10)
+
+    mocker.patch("connord.probe.asyncio.open_connection", never_connect)
+
+    # run
+    start = time.monotonic()
+    actual_result = probe.probe(["10.0.0.1", "10.0.0.2"], method="tcp", timeout=0.1)
+
+    # assert
+    assert time.monotonic() - start < 1
+    assert actual_result == {"10.0.0.1": math.inf, "10.0.0.2": math.inf}
+
+
+def test_probe_stops_at_deadline(mocker):
+    async def never_connect(*args, **kwargs):
+        await probe.asyncio.sleep(10)
+
+    mocker.patch("connord.probe.asyncio.open_connection", never_connect)
+    ip_addresses = ["10.0.0.{}".format(i) for i in range(1, 51)]
+
+    # run
+    start = time.monotonic()
+    actual_result = probe.probe(
+        ip_addresses, method="tcp", timeout=10, deadline=0.2, limit=10
+    )
+
+    # assert
+    assert time.monotonic() - start < 1
+    assert actual_result == {ip_address: math.inf for ip_address in ip_addresses}
+
+
+def test_probe_auto_falls_back_to_tcp(mocker, listening_port):
+    mocker.patch("connord.probe.open_icmp_socket", return_value=(None, False))
+
+    actual_result = probe.probe(["127.0.0.1"], method="auto", port=listening_port)
+
+    assert actual_result["127.0.0.1"] < math.inf
+
+
+def test_probe_icmp_when_not_permitted(mocker):
+    mocker.patch("connord.probe.open_icmp_socket", return_value=(None, False))
+
+    with pytest.raises(PermissionError):
+        probe.probe(["127.0.0.1"], method="icmp")
+
+
+def test_probe_icmp_localhost():
+    sock, _ = probe.open_icmp_socket()
+    if sock is None:
+        pytest.skip("Not permitted to open an icmp socket")
+    sock.close()
+
+    actual_result = probe.probe(["127.0.0.1"], method="icmp")
+
+    assert actual_result["127.0.0.1"] < math.inf
+
+
+def test_probe_with_unknown_method():
+    with pytest.raises(ValueError):
+        probe.probe(["127.0.0.1"], method="udp")
+
+
+def test_probe_without_addresses():
+    assert probe.probe([], method="tcp") == {}
+
+
+def test_probe_samples_takes_samples(mocker, listening_port):
+    actual_result = probe.probe_samples(
+        ["127.0.0.1"], samples=3, interval=0, method="tcp", port=listening_port
+    )
+
+    assert len(actual_result["127.0.0.1"]) == 3
+    assert math.inf not in actual_result["127.0.0.1"]
+
+
+def test_probe_samples_pads_samples_missing_at_deadline(mocker):
+    rtts = iter([5.0])
+
+    async def tcp_probe(*args):
+        try:
+            return next(rtts)
+        except StopIteration:
+            await probe.asyncio.sleep(10)
+
+    mocker.patch("connord.probe.tcp_probe", tcp_probe)
+
+    # run
+    actual_result = probe.probe_samples(
+        ["10.0.0.1"], samples=3, interval=0, method="tcp", deadline=0.1
+    )
+
+    # assert
+    assert actual_result == {"10.0.0.1": [5.0, math.inf, math.inf]}
+
+
+def test_get_stats():
+    actual_result = probe.get_stats([10.0, 14.0, math.inf, 12.0, 30.0])
+
+    assert actual_result == {
+        "min": 10.0,
+        "median": 13.0,
+        "p95": 30.0,
+        "jitter": pytest.approx((4 + 2 + 18) / 3),
+        "loss": 0.2,
+    }
+
+
+def test_get_stats_with_single_answer():
+    actual_result = probe.get_stats([10.0])
+
+    assert actual_result == {
+        "min": 10.0,
+        "median": 10.0,
+        "p95": 10.0,
+        "jitter": 0.0,
+        "loss": 0.0,
+    }
+
+
+def test_get_stats_without_answers():
+    actual_result = probe.get_stats([math.inf, math.inf])
+
+    assert actual_result["median"] == math.inf
+    assert actual_result["jitter"] == math.inf
+    assert actual_result["loss"] == 1.0
@@ -2,6 +2,8 @@
 from connord import resources
 from main_test_module import MockBase
 
+YAML_PROBLEMS = ("expected <block end>, but found '-'", "did not find expected key")
+
 
 def _mock_os_any(mocker, func, return_value):
     if func:
@@ -45,6 +47,13 @@ def _mock_get_ovpn_dir(mocker, return_value):
     return mocker.patch("connord.resources.get_ovpn_dir", return_value=return_value)
 
 
+def _mock_configurations_config(mocker, mode="extract"):
+    return mocker.patch(
+        "connord.resources.get_configurations_config",
+        return_value={"mode": mode, "cache": 2},
+    )
+
+
 def _mock_get_ovpn_protocol_dir(mocker, return_value):
     return mocker.patch(
         "connord.resources.get_ovpn_protocol_dir", return_value=return_value
@@ -460,6 +469,29 @@ def test_get_credentials_file_create_false_path_not_exists(mocker):
     mocked_verify.assert_not_called()
 
 
+def test_get_credentials_file_when_printer_is_not_interactive(mocker):
+    # setup
+    _mock_user_is_root(mocker, return_value=True)
+    _setup()
+    mocker.patch("connord.resources.get_credentials_dir", return_value="/test/dir")
+    mocked_create_creds_file = mocker.patch("connord.resources.create_credentials_file")
+    mocked_os = _mock_os(mocker)
+    mocked_os.path.exists.return_value = False
+    mocked_printer = mocker.patch("connord.resources.Printer")
+    mocked_printer.return_value.interactive = False
+
+    # run
+    try:
+        resources.get_credentials_file()
+        assert False
+    except resources.ResourceNotFoundError as error:
+        assert error.resource_file == "/test/dir/credentials"
+        assert "No credentials found" in str(error)
+
+    # assert
+    mocked_create_creds_file.assert_not_called()
+
+
 def test_create_credentials_file(mocker):
     # setup
     _setup()
@@ -559,6 +591,7 @@ def test_get_ovpn_config_when_domain_without_fqdn_and_path_exists(mocker):
     # setup
     _mock_user_is_root(mocker, True)
     _setup()
+    _mock_configurations_config(mocker)
     mocked_get_dir = _mock_get_ovpn_protocol_dir(mocker, "/test/dir/ovpn_udp")
     domain = "us2000"
     protocol = "udp"
@@ -578,6 +611,7 @@ def test_get_ovpn_config_when_domain_with_fqdn_and_path_exists(mocker):
     # setup
     _mock_user_is_root(mocker, True)
     _setup()
+    _mock_configurations_config(mocker)
     mocked_get_dir = _mock_get_ovpn_protocol_dir(mocker, "/test/dir/ovpn_udp")
     domain = "us2000.nordvpn.com"
     protocol = "udp"
@@ -597,6 +631,7 @@ def test_get_ovpn_config_when_path_not_exists(mocker):
     # setup
     _mock_user_is_root(mocker, True)
     _setup()
+    _mock_configurations_config(mocker)
     mocked_get_dir = _mock_get_ovpn_protocol_dir(mocker, "/test/dir/ovpn_udp")
     domain = "us2000.nordvpn.com"
     protocol = "udp"
@@ -854,7 +889,8 @@ def test_get_config_when_invalid_yaml(mocker):
         assert False
     except resources.MalformedResourceError as error:
         assert error.resource_file == yaml_fixture
-        assert error.problem == "expected <block end>, but found '-'"
+        # the message depends on the availability of libyaml
+        assert error.problem in YAML_PROBLEMS
         assert (
             error.problem_mark
             # pylint: disable=line-too-long
@@ -864,6 +900,35 @@ def test_get_config_when_invalid_yaml(mocker):
     mocked_config_file.assert_called_once()
 
 
+def test_get_config_section_merges_defaults(mocker):
+    # setup
+    mocked_config = mocker.patch("connord.resources.get_config")
+    mocked_config.return_value = {"connord": {"var": "value"}}
+
+    # run
+    actual_result = resources.get_config_section(
+        "connord", {"var": "default", "other": 1}
+    )
+
+    # assert
+    assert actual_result == {"var": "value", "other": 1}
+
+
+def test_get_config_section_when_section_is_missing(mocker):
+    # setup
+    mocked_config = mocker.patch("connord.resources.get_config")
+    mocked_config.return_value = {"connord": None}
+    defaults = {"var": "default"}
+
+    # run and assert
+    assert resources.get_config_section("connord", defaults) == defaults
+    assert resources.get_config_section("missing", defaults) == defaults
+    assert resources.get_config_section("missing") == {}
+
+    mocked_config.side_effect = resources.ResourceNotFoundError("config.yml")
+    assert resources.get_config_section("connord", defaults) == defaults
+
+
 def test_write_config_when_valid_config(mocker):
     # setup
     mockbase = MockBase("resources")
@@ -1112,7 +1177,8 @@ def test_get_stats_when_invalid_yaml(mocker):
         resources.get_stats()
     except resources.MalformedResourceError as error:
         assert error.resource_file == stats_file
-        assert error.problem == "expected <block end>, but found '-'"
+        # the message depends on the availability of libyaml
+        assert error.problem in YAML_PROBLEMS
         assert (
             error.problem_mark
             # pylint: disable=line-too-long
@@ -1131,9 +1197,8 @@ def test_get_stats_when_stats_dict_is_none(mocker):
 
     stats_file = "tests/fixtures/config_valid_yaml_fixture.yml"
     mocked_stats_file = _mock_get_stats_file(mocker, stats_file)
-    mocked_safe_load = mocker.patch(
-        "connord.resources.yaml.safe_load", return_value=None
-    )
+    mocked_safe_load = mocker.patch("connord.resources.load_yaml", return_value=None)
+    resources.clear_parsed_cache()
     expected_result = dict()
 
     # run
@@ -1191,3 +1256,238 @@ def test_write_stats_when_invalid_dict(mocker):
 
     # assert
     mocked_stats_file.assert_called_once()
+
+
+def test_read_yaml_file_is_cached(tmp_path, mocker):
+    # setup
+    yaml_file = tmp_path / "config.yml"
+    yaml_file.write_text("connord:\n  var: value\n")
+    resources.clear_parsed_cache()
+    mocked_load = mocker.spy(resources, "load_yaml")
+
+    # run
+    actual_result = resources.read_yaml_file(str(yaml_file))
+    actual_result["connord"]["var"] = "changed"
+    cached_result = resources.read_yaml_file(str(yaml_file))
+
+    # assert
+    assert cached_result == {"connord": {"var": "value"}}
+    assert mocked_load.call_count == 1
+
+    yaml_file.write_text("connord:\n  var: other\n")
+    import os
+
+    os.utime(str(yaml_file), ns=(0, 0))
+    assert resources.read_yaml_file(str(yaml_file)) == {"connord": {"var": "other"}}
+    assert mocked_load.call_count == 2
+
+
+def test_write_stats_writes_json_sidecar(tmp_path, mocker):
+    # setup
+    mockbase = MockBase("resources")
+    mockbase.mock_user_is_root(mocker, True)
+    stats_file = str(tmp_path / "stats")
+    _mock_get_stats_file(mocker, stats_file)
+    stats = {"last_server": {"domain": "de111.nordvpn.com", "protocol": "udp"}}
+
+    # run
+    resources.write_stats(stats)
+    resources.clear_parsed_cache()
+    mocked_load = mocker.spy(resources, "load_yaml")
+    actual_result = resources.get_stats()
+
+    # assert
+    assert actual_result == stats
+    mocked_load.assert_not_called()
+    assert (tmp_path / ".stats.json").exists()
+    with open(stats_file) as stats_fd:
+        assert resources.load_yaml(stats_fd) == stats
+
+
+def test_get_stats_when_sidecar_is_stale(tmp_path, mocker):
+    # setup
+    mockbase = MockBase("resources")
+    mockbase.mock_user_is_root(mocker, True)
+    stats_file = tmp_path / "stats"
+    _mock_get_stats_file(mocker, str(stats_file))
+    resources.write_stats({"var": "old"})
+
+    # run
+    stats_file.write_text("var: new\n")
+    actual_result = resources.get_stats()
+
+    # assert
+    assert actual_result == {"var": "new"}
+
+
+def test_write_stats_when_json_changes_types(tmp_path, mocker):
+    # setup
+    mockbase = MockBase("resources")
+    mockbase.mock_user_is_root(mocker, True)
+    stats_file = str(tmp_path / "stats")
+    _mock_get_stats_file(mocker, stats_file)
+    stats = {1: "one"}
+
+    # run
+    resources.write_stats(stats)
+
+    # assert
+    assert not (tmp_path / ".stats.json").exists()
+    assert resources.get_stats() == stats
+
+
+def test_get_cache_dir_when_default_and_path_not_exists(mocker):
+    # setup
+    mockbase = MockBase("resources")
+    mockbase.setup(resources)
+
+    cache_dir = "/cache/dir"
+    # pylint: disable=protected-access
+    resources.__CACHE_DIR = cache_dir
+
+    mocked_exists = mockbase.mock_os_any(mocker, "path.exists", False)
+    mocked_makedirs = mockbase.mock_os_any(mocker, "makedirs", cache_dir)
+
+    # run
+    actual_result = resources.get_cache_dir()
+
+    # assert
+    mocked_exists.assert_called_once_with(cache_dir)
+    mocked_makedirs.assert_called_once_with(cache_dir, mode=0o755)
+    assert actual_result == cache_dir
+
+
+def test_get_cache_dir_when_create_is_false_and_path_not_exists(mocker):
+    # setup
+    mockbase = MockBase("resources")
+    mockbase.setup(resources)
+
+    cache_dir = "/cache/dir"
+    # pylint: disable=protected-access
+    resources.__CACHE_DIR = cache_dir
+
+    mockbase.mock_os_any(mocker, "path.exists", False)
+    mocked_makedirs = mockbase.mock_os_any(mocker, "makedirs", cache_dir)
+
+    # run and assert
+    try:
+        resources.get_cache_dir(create=False)
+        assert False
+    except resources.ResourceNotFoundError as error:
+        assert error.resource_file == cache_dir
+
+    mocked_makedirs.assert_not_called()
+
+
+def test_get_cache_file(mocker):
+    # setup
+    mocked_cache_dir = mocker.patch(
+        "connord.resources.get_cache_dir", return_value="/cache/dir"
+    )
+
+    # run
+    actual_result = resources.get_cache_file("servers.json")
+
+    # assert
+    mocked_cache_dir.assert_called_once_with(create=True)
+    assert actual_result == "/cache/dir/servers.json"
+
+
+def test_write_atomic(tmp_path):
+    path = tmp_path / "file"
+    path.write_text("old")
+
+    # run
+    resources.write_atomic(str(path), b"new", mode="wb", permissions=0o600)
+
+    # assert
+    assert path.read_bytes() == b"new"
+    assert path.stat().st_mode & 0o777 == 0o600
+    assert [p.name for p in tmp_path.iterdir()] == ["file"]
+
+
+def test_write_atomic_when_write_fails(tmp_path):
+    path = tmp_path / "file"
+    path.write_text("old")
+
+    # run
+    try:
+        resources.write_atomic(str(path), b"new", mode="w")
+        assert False
+    except TypeError:
+        pass
+
+    # assert
+    assert path.read_text() == "old"
+    assert [p.name for p in tmp_path.iterdir()] == ["file"]
+
+
+def _write_archive(zip_dir, names):
+    from zipfile import ZipFile
+
+    with ZipFile(str(zip_dir / "ovpn.zip"), "w") as zip_stream:
+        for name in names:
+            zip_stream.writestr(name, name)
+
+
+def test_get_packed_ovpn_config_evicts_least_recently_used(tmp_path, mocker):
+    zip_dir = tmp_path / "nordvpn"
+    zip_dir.mkdir()
+    names = ["ovpn_udp/de{}.nordvpn.com.udp.ovpn".format(i) for i in range(3)]
+    _write_archive(zip_dir, names)
+    mocker.patch("connord.resources.get_zip_dir", return_value=str(zip_dir))
+    mocker.patch("connord.resources.get_cache_dir", return_value=str(tmp_path))
+    mocked_mark_used = mocker.spy(resources, "mark_used")
+
+    # run
+    first = resources.get_packed_ovpn_config(names[0], cache_size=2)
+    resources.get_packed_ovpn_config(names[1], cache_size=2)
+    resources.get_packed_ovpn_config(names[0], cache_size=2)
+    resources.get_packed_ovpn_config(names[2], cache_size=2)
+
+    # assert
+    assert first == str(tmp_path / "ovpn" / "de0.nordvpn.com.udp.ovpn")
+    assert open(first).read() == names[0]
+    mocked_mark_used.assert_called_once_with(first)
+    assert sorted(p.name for p in (tmp_path / "ovpn").iterdir()) == [
+        "de0.nordvpn.com.udp.ovpn",
+        "de2.nordvpn.com.udp.ovpn",
+    ]
+
+
+def test_get_packed_ovpn_config_when_member_not_exists(tmp_path, mocker):
+    _write_archive(tmp_path, [])
+    mocker.patch("connord.resources.get_zip_dir", return_value=str(tmp_path))
+    mocker.patch("connord.resources.get_cache_dir", return_value=str(tmp_path))
+
+    try:
+        resources.get_packed_ovpn_config("ovpn_udp/de1.nordvpn.com.udp.ovpn")
+        assert False
+    except resources.ResourceNotFoundError as error:
+        assert error.resource_file == "{}/ovpn_udp/de1.nordvpn.com.udp.ovpn".format(
+            tmp_path
+        )
+
+
+def test_get_ovpn_config_when_lazy(mocker):
+    _mock_user_is_root(mocker, True)
+    _setup()
+    _mock_configurations_config(mocker, mode="lazy")
+    mocked_get_dir = _mock_get_ovpn_protocol_dir(mocker, "/test/dir/ovpn_udp")
+    mocked_packed = mocker.patch(
+        "connord.resources.get_packed_ovpn_config", return_value="/cache/file"
+    )
+
+    actual_result = resources.get_ovpn_config("us2000", "tcp")
+
+    mocked_get_dir.assert_not_called()
+    mocked_packed.assert_called_once_with("ovpn_tcp/us2000.nordvpn.com.tcp.ovpn", 2)
+    assert actual_result == "/cache/file"
+
+
+def test_write_atomic_when_data_is_iterable(tmp_path):
+    path = tmp_path / "file"
+
+    resources.write_atomic(str(path), (line for line in ["a\n", "b\n"]))
+
+    assert path.read_text() == "a\nb\n"
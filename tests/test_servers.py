@@ -1,8 +1,29 @@
 #!/usr/bin/env python
 
+# pylint: disable=redefined-outer-name, unused-argument
+
+import json
+import time
+import pytest
+from requests.exceptions import ConnectionError as RequestsConnectionError
 from connord import servers
 from main_test_module import get_servers_stub, get_stub
 
+API_URL = "https://api.nordvpn.com/server"
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(mocker, tmp_path):
+    servers.clear_cache()
+    mocker.patch("connord.servers.resources.get_cache_dir", return_value=str(tmp_path))
+    yield tmp_path
+    servers.clear_cache()
+
+
+def _write_cache(cache_dir, payload, meta):
+    (cache_dir / "servers.json").write_bytes(payload)
+    (cache_dir / "servers.meta.json").write_text(json.dumps(meta))
+
 
 def test_get_servers(requests_mock):
     servers_ = get_servers_stub()
@@ -16,7 +37,7 @@ Gecko/20100101 Firefox/60.0"
     actual_servers = servers.get_servers()
     actual_useragent = requests_mock.last_request.headers["User-Agent"]
     actual_url = requests_mock.last_request.url
-    assert actual_servers == servers_
+    assert actual_servers == servers.encode_masks(servers_)
     assert actual_url == url_
     assert actual_useragent == expected_useragent
 
@@ -32,3 +53,203 @@ def test_to_string():
 
 def test_to_string_when_servers_is_empty():
     assert servers.to_string(list()) == str()
+
+
+def test_get_servers_writes_cache(requests_mock, cache_dir):
+    servers_ = get_servers_stub()
+    requests_mock.get(API_URL, json=servers_, headers={"ETag": '"abc"'})
+
+    servers.get_servers()
+
+    cached_servers = json.loads((cache_dir / "servers.json").read_text())
+    meta = json.loads((cache_dir / "servers.meta.json").read_text())
+    assert cached_servers == servers_
+    assert meta["etag"] == '"abc"'
+
+
+def test_get_servers_when_cache_is_fresh(requests_mock, cache_dir):
+    servers_ = get_servers_stub()
+    _write_cache(
+        cache_dir, json.dumps(servers_).encode(), {"etag": None, "fetched": time.time()}
+    )
+    requests_mock.get(API_URL, json=[])
+
+    actual_servers = servers.get_servers()
+
+    assert not requests_mock.called
+    assert actual_servers == servers.encode_masks(servers_)
+
+
+def test_get_servers_is_kept_until_cache_changes(mocker, requests_mock, cache_dir):
+    servers_ = get_servers_stub()
+    _write_cache(
+        cache_dir, json.dumps(servers_).encode(), {"etag": None, "fetched": time.time()}
+    )
+    spy_encode = mocker.spy(servers, "encode_masks")
+
+    # run
+    actual_servers = servers.get_servers()
+    actual_servers_again = servers.get_servers()
+    _write_cache(
+        cache_dir,
+        json.dumps(servers_[:1]).encode(),
+        {"etag": None, "fetched": time.time()},
+    )
+    actual_servers_changed = servers.get_servers()
+
+    # assert
+    assert not requests_mock.called
+    assert actual_servers_again is actual_servers
+    assert spy_encode.call_count == 2
+    assert actual_servers_changed == servers.encode_masks(servers_[:1])
+
+
+def test_get_catalogue_when_cache_dir_is_not_writable(mocker, requests_mock):
+    servers_ = get_servers_stub()
+    mocker.patch(
+        "connord.servers.resources.get_cache_file",
+        side_effect=PermissionError("/var/cache/connord"),
+    )
+    requests_mock.get(API_URL, json=servers_)
+
+    # run
+    actual_servers = servers.get_servers()
+    servers.get_server_table()
+    servers.get_server_by_domain("de111")
+
+    # assert
+    # the response is kept in memory for 'max_age' seconds
+    assert requests_mock.call_count == 1
+    assert actual_servers == servers.encode_masks(servers_)
+
+
+def test_get_servers_when_cache_is_stale_and_not_modified(requests_mock, cache_dir):
+    servers_ = get_servers_stub()
+    _write_cache(
+        cache_dir, json.dumps(servers_).encode(), {"etag": '"abc"', "fetched": 0}
+    )
+    requests_mock.get(API_URL, status_code=304)
+
+    actual_servers = servers.get_servers()
+
+    meta = json.loads((cache_dir / "servers.meta.json").read_text())
+    assert requests_mock.last_request.headers["If-None-Match"] == '"abc"'
+    assert actual_servers == servers.encode_masks(servers_)
+    assert meta["fetched"] > 0
+
+
+def test_get_servers_when_cache_is_stale_and_modified(requests_mock, cache_dir):
+    servers_ = get_servers_stub()
+    _write_cache(cache_dir, b"[]", {"etag": '"abc"', "fetched": 0})
+    requests_mock.get(API_URL, json=servers_, headers={"ETag": '"def"'})
+
+    actual_servers = servers.get_servers()
+
+    meta = json.loads((cache_dir / "servers.meta.json").read_text())
+    assert actual_servers == servers.encode_masks(servers_)
+    assert meta["etag"] == '"def"'
+
+
+def test_get_servers_when_api_unreachable_uses_stale_cache(requests_mock, cache_dir):
+    servers_ = get_servers_stub()
+    _write_cache(cache_dir, json.dumps(servers_).encode(), {"fetched": 0})
+    requests_mock.get(API_URL, exc=RequestsConnectionError)
+
+    actual_servers = servers.get_servers()
+
+    assert actual_servers == servers.encode_masks(servers_)
+
+
+def test_get_servers_when_api_unreachable_and_use_stale_is_off(
+    mocker, requests_mock, cache_dir
+):
+    _write_cache(cache_dir, b"[]", {"fetched": 0})
+    mocker.patch(
+        "connord.servers.get_catalogue_config",
+        return_value={"max_age": 300, "use_stale": False},
+    )
+    requests_mock.get(API_URL, exc=RequestsConnectionError)
+
+    with pytest.raises(RequestsConnectionError):
+        servers.get_servers()
+
+
+def test_get_servers_when_api_unreachable_and_no_cache(requests_mock):
+    requests_mock.get(API_URL, exc=RequestsConnectionError)
+
+    with pytest.raises(RequestsConnectionError):
+        servers.get_servers()
+
+
+def test_encode_masks():
+    servers_ = servers.encode_masks(get_servers_stub())
+
+    de111 = servers_[0]
+    assert de111["categories_mask"] == (
+        servers.categories.CATEGORY_BITS["standard"]
+        | servers.categories.CATEGORY_BITS["p2p"]
+    )
+    assert servers.features.decode_features(de111["features_mask"]) == [
+        feature for feature, enabled in de111["features"].items() if enabled
+    ]
+
+
+def test_to_string_with_masks():
+    servers_ = servers.encode_masks(get_servers_stub())
+    expected_string = get_stub("servers_stub_to_string.txt").rstrip()
+
+    actual_string = servers.to_string(servers_)
+    assert actual_string == expected_string
+
+
+def test_get_server_by_domain(mocker):
+    servers_ = get_servers_stub()
+    mocked_get_servers = mocker.patch(
+        "connord.servers.get_servers", return_value=servers_
+    )
+
+    assert servers.get_server_by_domain("de112") is servers_[1]
+    assert servers.get_server_by_domain("nl80.nordvpn.com") is servers_[3]
+    # the index is built once per server list
+    assert servers.get_domain_index() is servers.get_domain_index()
+    assert mocked_get_servers.call_count == 4
+
+
+def test_get_server_by_domain_when_domain_not_exists(mocker):
+    mocker.patch("connord.servers.get_servers", return_value=get_servers_stub())
+
+    with pytest.raises(ValueError):
+        servers.get_server_by_domain("de1")
+
+
+def test_get_servers_by_domains(mocker):
+    servers_ = get_servers_stub()
+    mocker.patch("connord.servers.get_servers", return_value=servers_)
+
+    actual_servers = servers.get_servers_by_domains(["us2853", "de111.nordvpn.com"])
+
+    assert actual_servers == [servers_[7], servers_[0]]
+
+
+def test_get_servers_by_domains_when_domain_not_exists(mocker):
+    mocker.patch("connord.servers.get_servers", return_value=get_servers_stub())
+
+    with pytest.raises(servers.DomainNotFoundError) as error:
+        servers.get_servers_by_domains(["de111", "xx1"])
+
+    assert error.value.domain == "xx1"
+
+
+def test_domain_index_is_rebuilt_with_server_list(mocker):
+    servers_ = get_servers_stub()
+    mocked_get_servers = mocker.patch(
+        "connord.servers.get_servers", return_value=servers_
+    )
+    index = servers.get_domain_index()
+
+    mocked_get_servers.return_value = servers_[:1]
+    assert servers.get_domain_index() is not index
+    assert "de112" not in servers.get_domain_index()
+
+    servers.clear_cache()
+    assert "de111" in servers.get_domain_index()
@@ -20,3 +20,52 @@ def test_location_exists_when_it_does_exist(database):
     conn = sqlite.create_connection(database)
     result = sqlite.location_exists(conn, 50.116667, 8.683333)
     assert result
+
+
+def test_latency_averages_are_replaced():
+    conn = sqlite.create_connection(":memory:")
+    sqlite.create_latency_tables(conn)
+
+    # run
+    sqlite.replace_latency_averages(conn, [("de1", 1.0, 10.0, 20.0, 1.0, 0.0)])
+    sqlite.replace_latency_averages(conn, [("de1", 2.0, 12.0, 22.0, 2.0, 0.5)])
+
+    # assert
+    assert sqlite.get_latency_averages(conn) == {
+        "de1": {"updated": 2.0, "median": 12.0, "p95": 22.0, "jitter": 2.0, "loss": 0.5}
+    }
+    assert sqlite.get_latency_averages(conn, since=3.0) == {}
+
+
+def test_get_columns_binds_parameters(database):
+    conn = sqlite.create_connection(database)
+
+    # run
+    city = sqlite.get_city(conn, "50.116667", "8.683333")
+    injected = sqlite.get_city(conn, "0 OR 1 = 1", "0")
+    rows = sqlite.get_columns(conn, columns="latitude, city")
+
+    # assert
+    assert city == "Frankfurt"
+    assert injected is None
+    assert rows[0]["city"]
+    assert conn.row_factory is None
+
+
+def test_get_locations_version():
+    conn = sqlite.create_connection(":memory:")
+    assert sqlite.get_locations_version(conn) is None
+    sqlite.create_location_table(conn)
+    empty_version = sqlite.get_locations_version(conn)
+
+    # run
+    sqlite.create_latency_tables(conn)
+    sqlite.replace_latency_averages(conn, [("de1", 1.0, 10.0, 20.0, 1.0, 0.0)])
+    unchanged_version = sqlite.get_locations_version(conn)
+    sqlite.create_locations(
+        conn, [("50", "8.5", "Frankfurt am Main", "Frankfurt", "Germany", "de", "")]
+    )
+
+    # assert
+    assert unchanged_version == empty_version == (0, None)
+    assert sqlite.get_locations_version(conn) == (1, 1)
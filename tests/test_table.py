@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# pylint: disable=redefined-outer-name
+
+import pytest
+from connord import servers
+from connord.table import ServerTable
+from main_test_module import get_servers_stub, get_expected_servers_by_domain
+
+
+@pytest.fixture
+def servers_stub():
+    return get_servers_stub()
+
+
+@pytest.fixture
+def table(servers_stub):
+    return servers.to_table(servers_stub)
+
+
+def test_from_servers_selects_all_rows(table, servers_stub):
+    assert len(table) == len(servers_stub)
+    assert list(table) == servers_stub
+    assert table.to_list() == servers_stub
+
+
+def test_getitem(table, servers_stub):
+    assert table[0] == servers_stub[0]
+    assert table[-1] == servers_stub[-1]
+
+    actual_slice = table[1:3]
+    assert isinstance(actual_slice, ServerTable)
+    assert list(actual_slice) == servers_stub[1:3]
+
+
+def test_column(table, servers_stub):
+    assert table.column("load") == [server["load"] for server in servers_stub]
+    assert table.column("flag") == [server["flag"].lower() for server in servers_stub]
+
+
+def test_filter_returns_view_on_same_records(table, servers_stub):
+    actual_table = table.filter("load", lambda load: load < 30)
+
+    expected_servers = [server for server in servers_stub if server["load"] < 30]
+    assert list(actual_table) == expected_servers
+    assert actual_table.records is table.records
+    assert len(table) == len(servers_stub)
+
+
+def test_filter_values(table):
+    actual_table = table.filter_values("flag", ["us"])
+
+    expected_servers = get_expected_servers_by_domain(["us-ca5", "us2853"])
+    assert list(actual_table) == expected_servers
+
+
+def test_filter_mask(table):
+    mask = servers.features.FEATURE_BITS["openvpn_xor_udp"]
+    actual_table = table.filter_mask("features", mask)
+
+    expected_servers = get_expected_servers_by_domain(["nl80", "nl81", "nl82"])
+    assert list(actual_table) == expected_servers
+
+
+def test_filter_columns(table, servers_stub):
+    actual_table = table.filter_columns(
+        ("latitude", "longitude"), lambda lat, lon: lat > 50 and lon > 8
+    )
+
+    expected_servers = [
+        server
+        for server in servers_stub
+        if server["location"]["lat"] > 50 and server["location"]["long"] > 8
+    ]
+    assert list(actual_table) == expected_servers
+
+
+def test_empty_table():
+    table = servers.to_table([])
+
+    assert not table
+    assert list(table.filter("load", lambda load: True)) == []
@@ -1,53 +1,23 @@
 #!/usr/bin/env python
 
+# pylint: disable=redefined-outer-name
+
+import io
+import json
+import os
+from zipfile import ZipFile
+import pytest
+from connord import archives
 from connord import update
 
+URL = "https://downloads.nordcdn.com/configs/archives/servers"
+
 
 def set_up(mocker):
     mocked_user = mocker.patch("connord.iptables.user.is_root")
     mocked_user.return_value = True
 
 
-def test_update_orig_when_zip_file_not_exists(mocker):
-    zippath = "/etc/openvpn/client/nordvpn/ovpn.zip"
-    set_up(mocker)
-
-    import importlib
-
-    importlib.reload(update)
-
-    mocked_shutil = mocker.patch("connord.update.move")
-    mocked_zip_file = mocker.patch("connord.update.resources.get_zip_file")
-    from connord import resources
-
-    mocked_zip_file.side_effect = resources.ResourceNotFoundError(zippath)
-
-    try:
-        update.update_orig("ovpn.zip")
-    except resources.ResourceNotFoundError:
-        assert False
-
-    mocked_shutil.assert_not_called()
-
-
-def test_update_orig_when_zip_file_exists(mocker):
-    zippath = "/etc/openvpn/client/nordvpn/ovpn.zip"
-    origpath = "/etc/openvpn/client/nordvpn/ovpn.zip.orig"
-    set_up(mocker)
-    import importlib
-
-    importlib.reload(update)
-
-    mocked_shutil = mocker.patch("connord.update.move")
-    mocked_zip_file = mocker.patch("connord.update.resources.get_zip_file")
-
-    mocked_zip_file.return_value = zippath
-
-    update.update_orig("ovpn.zip")
-
-    mocked_shutil.assert_called_once_with(zippath, origpath)
-
-
 # def test_get(requests_mock, mocker):
 #     url = "https://downloads.nordcdn.com/configs/archives/servers/ovpn.zip"
 #     zippath = "/etc/openvpn/client/nordvpn/ovpn.zip"
@@ -65,69 +35,6 @@ def test_update_orig_when_zip_file_exists(mocker):
 #     mocked_open.assert_called_with(zippath, "wb")
 
 
-def test_uptodate_when_orig_zipfile_not_exists(mocker):
-    origpath = "/etc/openvpn/client/nordvpn/ovpn.zip.orig"
-    zippath = "/etc/openvpn/client/nordvpn/ovpn.zip"
-    mocked_os = mocker.patch("connord.update.os")
-    mocked_os.path.exists.side_effect = [False, True]
-
-    retval = update.file_equals(origpath, zippath)
-
-    expected_calls = [mocker.call(origpath)]
-    actual_calls = mocked_os.path.exists.call_args_list
-    assert actual_calls == expected_calls
-    assert not retval
-
-
-def test_uptodate_when_orig_file_exists_zip_file_not_exists(mocker):
-    zippath = "/etc/openvpn/client/nordvpn/ovpn.zip"
-    origpath = "/etc/openvpn/client/nordvpn/ovpn.orig.zip"
-    mocked_os = mocker.patch("connord.update.os")
-    mocked_os.path.exists.side_effect = [True, False]
-
-    retval = update.file_equals(origpath, zippath)
-
-    expected_calls = [mocker.call(origpath), mocker.call(zippath)]
-    actual_calls = mocked_os.path.exists.call_args_list
-    assert actual_calls == expected_calls
-    assert not retval
-
-
-def test_uptodate_when_both_files_exist_sizes_are_not_equal(mocker):
-    zippath = "/etc/openvpn/client/nordvpn/ovpn.zip"
-    origpath = "/etc/openvpn/client/nordvpn/ovpn.zip.orig"
-    mocked_os = mocker.patch("connord.update.os")
-    mocked_os.path.exists.side_effect = [True, True]
-    mocked_os.path.getsize.side_effect = [100, 99]
-
-    retval = update.file_equals(origpath, zippath)
-
-    expected_calls = [mocker.call(origpath), mocker.call(zippath)]
-    actual_calls = mocked_os.path.getsize.call_args_list
-    assert actual_calls == expected_calls
-    assert not retval
-
-
-def test_uptodate_when_both_files_exist_sizes_are_equal(mocker):
-    zippath = "/etc/openvpn/client/nordvpn/ovpn.zip"
-    origpath = "/etc/openvpn/client/nordvpn/ovpn.orig.zip"
-    mocked_os = mocker.patch("connord.update.os")
-    mocked_os.path.exists.side_effect = [True, True]
-    mocked_os.path.getsize.side_effect = [100, 100]
-
-    retval = update.file_equals(origpath, zippath)
-
-    expected_exists_calls = [mocker.call(origpath), mocker.call(zippath)]
-    actual_exists_calls = mocked_os.path.exists.call_args_list
-
-    expected_getsize_calls = [mocker.call(origpath), mocker.call(zippath)]
-    actual_getsize_calls = mocked_os.path.getsize.call_args_list
-
-    assert actual_getsize_calls == expected_getsize_calls
-    assert actual_exists_calls == expected_exists_calls
-    assert retval
-
-
 # def test_update_needed_when_zipfile_not_exists(mocker):
 #     zippath = "/etc/openvpn/client/nordvpn/ovpn.zip"
 #     mocked_os = mocker.patch("connord.update.os")
@@ -168,11 +75,17 @@ def test_update_needed_when_zipfile_exists(mocker):
 def test_update_when_force_is_true(mocker):
     mocked_get = mocker.patch.object(update, "get")
     mocked_unzip = mocker.patch.object(update, "unzip")
+    mocked_unzip.return_value = (0, 0)
+    mocker.patch.object(update, "read_manifest")
+    mocker.patch.object(update, "write_manifest")
+    mocker.patch.object(update.resources, "clear_ovpn_cache")
+    mocked_database = mocker.patch.object(update.areas, "update_database")
 
     retval = update.update(True)
 
     mocked_get.assert_called_once()
     mocked_unzip.assert_called_once()
+    mocked_database.assert_called_once()
     assert retval
 
 
@@ -246,32 +159,423 @@ def test_update_when_force_is_true(mocker):
 #     assert retval
 
 
-class MockZipFile:
-    def __init__(self):
-        self.dir_ = ""
+@pytest.fixture
+def zip_dir(tmp_path, mocker):
+    def get_zip_path(zip_name=None):
+        return str(tmp_path / zip_name)
+
+    def get_zip_file(zip_name=None, create_dirs=True):
+        return str(tmp_path / zip_name)
+
+    mocker.patch("connord.update.resources.get_zip_dir", return_value=str(tmp_path))
+    mocker.patch("connord.update.resources.get_zip_path", get_zip_path)
+    mocker.patch("connord.update.resources.get_zip_file", get_zip_file)
+    mocker.patch(
+        "connord.update.resources.get_configurations_config",
+        return_value={"mode": "extract", "cache": 16},
+    )
+    mocker.patch("connord.update.resources.clear_ovpn_cache")
+    return tmp_path
+
+
+def make_zip(members):
+    buffer_ = io.BytesIO()
+    with ZipFile(buffer_, "w") as zip_stream:
+        for name, content in members.items():
+            zip_stream.writestr(name, content)
+    return buffer_.getvalue()
+
+
+def write_zips(zip_dir, standard, obfuscated=None):
+    (zip_dir / "ovpn.zip").write_bytes(make_zip(standard))
+    (zip_dir / "ovpn_xor.zip").write_bytes(make_zip(obfuscated or {}))
+
+
+def test_download_sends_conditional_headers(zip_dir, requests_mock):
+    (zip_dir / "ovpn.zip").write_bytes(b"old")
+    requests_mock.get(URL + "/ovpn.zip", status_code=304)
+    meta = {"etag": '"abc"', "last_modified": "Mon, 01 Jul 2019 00:00:00 GMT"}
+
+    # run
+    changed, actual_meta = update.download("standard", "ovpn.zip", meta)
+
+    # assert
+    headers = requests_mock.last_request.headers
+    assert headers["If-None-Match"] == '"abc"'
+    assert headers["If-Modified-Since"] == "Mon, 01 Jul 2019 00:00:00 GMT"
+    assert not changed
+    assert actual_meta == meta
+    assert (zip_dir / "ovpn.zip").read_bytes() == b"old"
+
+
+def test_download_when_archive_changed(zip_dir, requests_mock):
+    (zip_dir / "ovpn.zip").write_bytes(b"old")
+    requests_mock.get(
+        URL + "/ovpn.zip",
+        content=b"new",
+        headers={"ETag": '"def"', "Last-Modified": "Tue, 02 Jul 2019 00:00:00 GMT"},
+    )
+
+    # run
+    changed, actual_meta = update.download("standard", "ovpn.zip", {"etag": '"abc"'})
+
+    # assert
+    assert changed
+    assert actual_meta == {
+        "etag": '"def"',
+        "last_modified": "Tue, 02 Jul 2019 00:00:00 GMT",
+    }
+    assert (zip_dir / "ovpn.zip").read_bytes() == b"new"
+    assert not (zip_dir / "ovpn.zip.part").exists()
+
+
+def test_download_without_archive_is_unconditional(zip_dir, requests_mock):
+    requests_mock.get(URL + "/ovpn.zip", content=b"new")
+
+    # run
+    changed, _ = update.download("standard", "ovpn.zip", {"etag": '"abc"'})
+
+    # assert
+    assert changed
+    assert "If-None-Match" not in requests_mock.last_request.headers
+
+
+def test_download_resumes_partial_download(zip_dir, requests_mock):
+    (zip_dir / "ovpn.zip").write_bytes(b"old")
+    (zip_dir / "ovpn.zip.part").write_bytes(b"ne")
+    (zip_dir / "ovpn.zip.part.json").write_text('{"etag": "x", "last_modified": null}')
+    requests_mock.get(URL + "/ovpn.zip", status_code=206, content=b"w")
+
+    # run
+    changed, actual_meta = update.download("standard", "ovpn.zip", {"etag": "a"})
+
+    # assert
+    headers = requests_mock.last_request.headers
+    assert headers["Range"] == "bytes=2-"
+    assert headers["If-Range"] == "x"
+    assert changed
+    assert actual_meta == {"etag": "x", "last_modified": None}
+    assert (zip_dir / "ovpn.zip").read_bytes() == b"new"
+    assert sorted(p.name for p in zip_dir.iterdir()) == ["ovpn.zip"]
+
+
+def test_download_restarts_when_archive_changed_meanwhile(zip_dir, requests_mock):
+    (zip_dir / "ovpn.zip.part").write_bytes(b"stale")
+    (zip_dir / "ovpn.zip.part.json").write_text('{"etag": "x"}')
+    requests_mock.get(URL + "/ovpn.zip", content=b"new", headers={"ETag": "y"})
+
+    # run
+    changed, actual_meta = update.download("standard", "ovpn.zip")
+
+    # assert
+    assert changed
+    assert actual_meta["etag"] == "y"
+    assert (zip_dir / "ovpn.zip").read_bytes() == b"new"
+
+
+def test_download_when_range_is_not_satisfiable(zip_dir, requests_mock):
+    (zip_dir / "ovpn.zip.part").write_bytes(b"stale")
+    (zip_dir / "ovpn.zip.part.json").write_text('{"etag": "x"}')
+    requests_mock.get(
+        URL + "/ovpn.zip",
+        [{"status_code": 416}, {"content": b"new", "headers": {"ETag": "y"}}],
+    )
+
+    # run
+    changed, _ = update.download("standard", "ovpn.zip")
+
+    # assert
+    assert changed
+    assert "Range" not in requests_mock.last_request.headers
+    assert (zip_dir / "ovpn.zip").read_bytes() == b"new"
+
+
+class BrokenBody(io.BytesIO):
+    """Delivers the first read and then breaks like a dropped connection"""
+
+    def read(self, *args, **kwargs):
+        if self.tell():
+            raise ConnectionResetError
+        return super().read(3)
+
+
+def test_download_keeps_partial_download_on_error(zip_dir, requests_mock, mocker):
+    mocker.patch("connord.update.CHUNK_SIZE", 3)
+    requests_mock.get(
+        URL + "/ovpn.zip", body=BrokenBody(b"new..."), headers={"ETag": "y"}
+    )
+
+    # run
+    try:
+        update.download("standard", "ovpn.zip")
+        assert False
+    except (OSError, update.requests.RequestException):
+        pass
+
+    # assert
+    assert (zip_dir / "ovpn.zip.part").read_bytes() == b"new"
+    assert (zip_dir / "ovpn.zip.part.json").read_text() == (
+        '{"etag": "y", "last_modified": null}'
+    )
+    assert not (zip_dir / "ovpn.zip").exists()
+
+
+def test_get_updates_manifest_of_changed_archives(zip_dir, requests_mock):
+    (zip_dir / "ovpn.zip").write_bytes(b"old")
+    (zip_dir / "ovpn_xor.zip").write_bytes(b"old")
+    requests_mock.get(URL + "/ovpn.zip", status_code=304)
+    requests_mock.get(URL + "/ovpn_xor.zip", content=b"new", headers={"ETag": "x"})
+    manifest = {
+        "archives": {"ovpn.zip": {"etag": "a"}, "ovpn_xor.zip": {"etag": "b"}},
+        "members": {},
+    }
+
+    # run
+    actual_result = update.get(manifest)
+
+    # assert
+    assert actual_result == ["ovpn_xor.zip"]
+    assert manifest["archives"]["ovpn.zip"] == {"etag": "a"}
+    assert manifest["archives"]["ovpn_xor.zip"]["etag"] == "x"
+
+
+def test_unzip_writes_only_changed_files(zip_dir):
+    write_zips(
+        zip_dir,
+        {"ovpn_udp/a.ovpn": "a", "ovpn_udp/b.ovpn": "b2", "../evil.ovpn": "x"},
+        {"ovpn_xor_udp/c.ovpn": "c"},
+    )
+    (zip_dir / "ovpn_udp").mkdir()
+    (zip_dir / "ovpn_udp" / "a.ovpn").write_text("untouched")
+    (zip_dir / "ovpn_udp" / "gone.ovpn").write_text("gone")
+    members = update.get_members()
+    manifest = {
+        "archives": {},
+        "members": {
+            "ovpn_udp/a.ovpn": members["ovpn_udp/a.ovpn"][1],
+            "ovpn_udp/b.ovpn": 0,
+            "ovpn_udp/gone.ovpn": 0,
+        },
+    }
+
+    # run
+    actual_result = update.unzip(manifest)
+
+    # assert
+    assert actual_result == (2, 1)
+    assert (zip_dir / "ovpn_udp" / "a.ovpn").read_text() == "untouched"
+    assert (zip_dir / "ovpn_udp" / "b.ovpn").read_text() == "b2"
+    assert (zip_dir / "ovpn_xor_udp" / "c.ovpn").read_text() == "c"
+    assert not (zip_dir / "ovpn_udp" / "gone.ovpn").exists()
+    assert not (zip_dir.parent / "evil.ovpn").exists()
+    assert set(manifest["members"]) == {
+        "ovpn_udp/a.ovpn",
+        "ovpn_udp/b.ovpn",
+        "ovpn_xor_udp/c.ovpn",
+    }
+
+
+def test_unzip_when_forced_writes_all_files(zip_dir):
+    write_zips(zip_dir, {"ovpn_udp/a.ovpn": "a"})
+    manifest = {"archives": {}, "members": {}}
+    update.unzip(manifest)
+    (zip_dir / "ovpn_udp" / "a.ovpn").write_text("modified")
+
+    # run
+    actual_result = update.unzip(manifest, force=True)
+
+    # assert
+    assert actual_result == (1, 0)
+    assert (zip_dir / "ovpn_udp" / "a.ovpn").read_text() == "a"
+
 
-    def extractall(self, zdir):
-        self.dir_ = zdir
+def test_manifest_round_trip(zip_dir):
+    assert update.read_manifest() == {"archives": {}, "members": {}}
 
-    def extract(self, file_name, zdir):
-        self.dir_ = zdir
-        setattr(self, "file_name", file_name)
+    manifest = {"archives": {"ovpn.zip": {"etag": "a"}}, "members": {"a.ovpn": 1}}
+    update.write_manifest(manifest)
 
-    def namelist(self):
-        return ["ovpn_udp/test.nordvpn.com"]
+    assert update.read_manifest() == manifest
+
+
+def test_update_openvpn_conf_when_archives_are_unchanged(zip_dir, mocker):
+    write_zips(zip_dir, {"ovpn_udp/a.ovpn": "a"})
+    mocker.patch.object(update, "update_needed", return_value=True)
+    mocker.patch.object(update, "get", return_value=[])
+    mocked_unzip = mocker.patch.object(update, "unzip")
+
+    # run
+    update._update_openvpn_conf(False)
+
+    # assert
+    mocked_unzip.assert_not_called()
+    assert os.path.exists(str(zip_dir / "manifest.json"))
+
+
+def test_unzip_swaps_in_new_tree(zip_dir):
+    write_zips(zip_dir, {"ovpn_udp/a.ovpn": "a", "ovpn_tcp/a.ovpn": "a"})
+    (zip_dir / "ovpn_udp").mkdir()
+    (zip_dir / "ovpn_udp" / "stray.ovpn").write_text("stray")
+    (zip_dir / "ovpn_old").mkdir()
+    (zip_dir / "ovpn_old" / "b.ovpn").write_text("b")
+    manifest = {"archives": {}, "members": {"ovpn_old/b.ovpn": 0}}
+
+    # run
+    actual_result = update.unzip(manifest, workers=2)
+
+    # assert
+    assert actual_result == (2, 1)
+    assert sorted(p.name for p in zip_dir.iterdir()) == [
+        "ovpn.zip",
+        "ovpn_tcp",
+        "ovpn_udp",
+        "ovpn_xor.zip",
+    ]
+    assert sorted(p.name for p in (zip_dir / "ovpn_udp").iterdir()) == ["a.ovpn"]
+
+
+def test_unzip_extracts_concurrently(zip_dir):
+    standard = {"ovpn_udp/{}.ovpn".format(i): str(i) for i in range(20)}
+    write_zips(zip_dir, standard, {"ovpn_xor_udp/x.ovpn": "x"})
+    manifest = {"archives": {}, "members": {}}
+
+    # run
+    actual_result = update.unzip(manifest, workers=4)
+
+    # assert
+    assert actual_result == (21, 0)
+    for name, content in standard.items():
+        assert (zip_dir / name).read_text() == content
+    assert len(manifest["members"]) == 21
+
+
+def test_unzip_keeps_old_tree_on_error(zip_dir, mocker):
+    write_zips(zip_dir, {"ovpn_udp/a.ovpn": "new"})
+    (zip_dir / "ovpn_udp").mkdir()
+    (zip_dir / "ovpn_udp" / "a.ovpn").write_text("old")
+    mocker.patch("connord.update.shutil.copyfileobj", side_effect=OSError)
+    manifest = {"archives": {}, "members": {}}
+
+    # run
+    try:
+        update.unzip(manifest)
+        assert False
+    except OSError:
+        pass
+
+    # assert
+    assert (zip_dir / "ovpn_udp" / "a.ovpn").read_text() == "old"
+    assert manifest["members"] == {}
+    assert not any(p.name.startswith(".staging") for p in zip_dir.iterdir())
+
+
+def test_update_openvpn_conf_when_lazy(zip_dir, mocker):
+    write_zips(zip_dir, {"ovpn_udp/a.ovpn": "a"})
+    mocker.patch(
+        "connord.update.resources.get_configurations_config",
+        return_value={"mode": "lazy", "cache": 16},
+    )
+    mocker.patch.object(update, "get", return_value=["ovpn.zip"])
+    mocked_unzip = mocker.patch.object(update, "unzip")
+
+    # run
+    update._update_openvpn_conf(True)
+
+    # assert
+    mocked_unzip.assert_not_called()
+    update.resources.clear_ovpn_cache.assert_called_once_with()
+    assert not (zip_dir / "ovpn_udp").exists()
+
+
+def test_update_templates(zip_dir, mocker):
+    udp = "remote {} 1194\nverify-x509-name CN={}\n"
+    write_zips(
+        zip_dir,
+        {
+            "ovpn_udp/de{0}.nordvpn.com.udp.ovpn".format(i): udp.format(
+                "10.0.0.{}".format(i), "de{}.nordvpn.com".format(i)
+            )
+            for i in range(1, 4)
+        },
+    )
+    (zip_dir / "template.tcp.ovpn").write_text("stale")
+    (zip_dir / "template.tcp.json").write_text("[]")
+    mocker.patch(
+        "connord.update.resources.get_ovpn_template_file",
+        lambda protocol: str(zip_dir / "template.{}.ovpn".format(protocol)),
+    )
+    mocker.patch(
+        "connord.update.resources.get_ovpn_template_mismatches_file",
+        lambda protocol: str(zip_dir / "template.{}.json".format(protocol)),
+    )
+    archives.clear_cache()
+
+    # run
+    update.update_templates()
+
+    # assert
+    assert (zip_dir / "template.udp.ovpn").read_text() == (
+        "remote ${ip_address} 1194\nverify-x509-name CN=${domain}\n"
+    )
+    assert json.loads((zip_dir / "template.udp.json").read_text()) == []
+    assert not (zip_dir / "template.tcp.ovpn").exists()
+    assert not (zip_dir / "template.tcp.json").exists()
+
+
+def test_update_openvpn_conf_when_standard_archive_is_unchanged(zip_dir, mocker):
+    write_zips(zip_dir, {"ovpn_udp/a.ovpn": "a"})
+    mocker.patch(
+        "connord.update.resources.get_configurations_config",
+        return_value={"mode": "template", "cache": 16},
+    )
+    mocker.patch(
+        "connord.update.resources.get_ovpn_template_file",
+        lambda protocol: str(zip_dir / "template.{}.ovpn".format(protocol)),
+    )
+    mocker.patch(
+        "connord.update.resources.get_ovpn_template_mismatches_file",
+        lambda protocol: str(zip_dir / "template.{}.json".format(protocol)),
+    )
+    for protocol in ("udp", "tcp"):
+        (zip_dir / "template.{}.ovpn".format(protocol)).write_text("template")
+        (zip_dir / "template.{}.json".format(protocol)).write_text("[]")
+    mocker.patch.object(update, "update_needed", return_value=True)
+    mocker.patch.object(update, "get", return_value=["ovpn_xor.zip"])
+    mocked_update_templates = mocker.patch.object(update, "update_templates")
+
+    # run
+    update._update_openvpn_conf(False)
+
+    # assert
+    mocked_update_templates.assert_not_called()
+
+    # run
+    (zip_dir / "template.tcp.json").unlink()
+    update._update_openvpn_conf(False)
+
+    # assert
+    mocked_update_templates.assert_called_once_with()
 
 
-def test_unzip_when_non_verbose(capsys, mocker):
-    # setup
-    mocked_resources = mocker.patch("connord.update.resources")
-    mocked_resources.get_zip_dir.return_value = "/test"
-    mocked_resources.get_zip_file.return_value = "/test/ovpn.zip"
-    mocked_zip_file = mocker.patch("connord.update.ZipFile")
-    zip_file_mock = MockZipFile()
-    mocked_zip_file.return_value.__enter__.return_value = zip_file_mock
+def test_update_openvpn_conf_when_switched_to_lazy(zip_dir, mocker):
+    write_zips(zip_dir, {"ovpn_udp/a.ovpn": "a"}, {"ovpn_xor_udp/x.ovpn": "x"})
+    manifest = update.read_manifest()
+    update.unzip(manifest)
+    update.write_manifest(manifest)
+    mocker.patch(
+        "connord.update.resources.get_configurations_config",
+        return_value={"mode": "lazy", "cache": 16},
+    )
+    mocker.patch.object(update, "update_needed", return_value=True)
+    mocker.patch.object(update, "get", return_value=[])
 
     # run
-    update.unzip()
+    update._update_openvpn_conf(False)
 
     # assert
-    assert zip_file_mock.dir_ == "/test"
+    assert sorted(p.name for p in zip_dir.iterdir()) == [
+        "manifest.json",
+        "ovpn.zip",
+        "ovpn_xor.zip",
+    ]
+    assert update.read_manifest()["members"] == {}